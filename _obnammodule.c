@@ -65,6 +65,10 @@
     #define NO_NANOSECONDS 0
 #endif
 
+#if defined(__linux__)
+    #include <sys/syscall.h>
+#endif
+
 
 static PyObject *
 fadvise_dontneed(PyObject *self, PyObject *args)
@@ -305,6 +309,27 @@ lsetxattr_wrapper(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *
+syncfs_wrapper(PyObject *self, PyObject *args)
+{
+    int fd;
+    int ret;
+
+    if (!PyArg_ParseTuple(args, "i", &fd))
+        return NULL;
+#if defined(SYS_syncfs)
+    Py_BEGIN_ALLOW_THREADS
+    ret = syscall(SYS_syncfs, fd);
+    Py_END_ALLOW_THREADS
+    if (ret == -1)
+        ret = errno;
+#else
+    ret = ENOSYS;
+#endif
+    return Py_BuildValue("i", ret);
+}
+
+
 static PyMethodDef methods[] = {
     {"fadvise_dontneed",  fadvise_dontneed, METH_VARARGS,
      "Call posix_fadvise(2) with POSIX_FADV_DONTNEED argument."},
@@ -318,6 +343,8 @@ static PyMethodDef methods[] = {
      "lgetxattr(2) wrapper; arg is filename, returns tuple."},
     {"lsetxattr", lsetxattr_wrapper, METH_VARARGS,
      "lsetxattr(2) wrapper; arg is filename, returns errno."},
+    {"syncfs", syncfs_wrapper, METH_VARARGS,
+     "syncfs(2) wrapper; arg is file descriptor, returns errno."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -30,6 +30,9 @@ from .defaults import (
     DEFAULT_NAGIOS_CRIT_AGE,
     DEFAULT_DIR_OBJECT_CACHE_BYTES,
     DEFAULT_CHUNK_CACHE_BYTES,
+    DEFAULT_REPOSITORY_CACHE_SIZE,
+    DEFAULT_UPLOAD_SPOOL_SIZE,
+    DEFAULT_UPLOAD_THREADS,
 
     IDPATH_DEPTH,
     IDPATH_BITS,
@@ -60,6 +63,8 @@ from .encryption import (
     generate_symmetric_key,
     encrypt_symmetric,
     decrypt_symmetric,
+    encrypt_symmetric_stream,
+    decrypt_symmetric_stream,
     get_public_key,
     get_public_key_user_ids,
     Keyring,
@@ -75,12 +80,21 @@ from .hooks import (
 from .pluginbase import ObnamPlugin
 from .vfs import (
     VirtualFileSystem,
+    VfsWriter,
+    BufferedVfsWriter,
+    PieceReader,
     VfsFactory,
     VfsTests,
     LockFail,
     NEW_DIR_MODE,
     NEW_FILE_MODE)
 from .vfs_local import LocalFS
+from .vfs_cache import CachingFS
+from .vfs_spool import SpoolingFS, UploadFailedError
+from .worker_pool import WorkerPool, WorkerPoolJob
+from .chunk_read_ahead import ChunkReadAhead
+from .fsck_state import FsckState
+from .fsck_sampling import stratify_generations, wilson_upper_bound
 from .fsck_work_item import WorkItem
 from .repo_fs import RepositoryFS
 from .lockmgr import LockManager
@@ -91,7 +105,11 @@ from .chunkid_token_map import ChunkIdTokenMap
 from .pathname_excluder import PathnameExcluder
 from .splitpath import split_pathname
 
-from .obj_serialiser import serialise_object, deserialise_object
+from .obj_serialiser import (
+    serialise_object,
+    deserialise_object,
+    serialise_object_pieces,
+    deserialise_object_from_file)
 from .bag import Bag, BagIdNotSetError, make_object_id, parse_object_id
 from .bag_store import BagStore, serialise_bag, deserialise_bag
 from .blob_store import BlobStore
@@ -186,6 +204,8 @@ from .fmt_6.repo_tree import RepositoryTree
 from .fmt_6.chunklist import ChunkList
 from .fmt_6.clientlist import ClientList
 from .fmt_6.checksumtree import ChecksumTree
+from .fmt_6.pending_chunks import PendingChunks
+from .fmt_6.chunk_journal import ChunkJournal
 from .fmt_6.clientmetadatatree import ClientMetadataTree
 
 
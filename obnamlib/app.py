@@ -17,6 +17,7 @@
 import cliapp
 import larch
 import logging
+import os
 import socket
 import sys
 import time
@@ -140,6 +141,41 @@ class App(cliapp.Application):
             default=obnamlib.IDPATH_SKIP,
             group=perf_group)
 
+        self.settings.string(
+            ['repository-cache'],
+            'keep copies of files read from a remote repository in '
+            'DIR, so they need not be fetched again; '
+            'empty means no cache',
+            metavar='DIR',
+            group=perf_group)
+
+        self.settings.bytesize(
+            ['repository-cache-size'],
+            'maximum size of the repository cache',
+            default=obnamlib.DEFAULT_REPOSITORY_CACHE_SIZE,
+            group=perf_group)
+
+        self.settings.string(
+            ['upload-spool'],
+            'write files for a remote repository to DIR first, and '
+            'upload them in the background; empty means upload '
+            'directly',
+            metavar='DIR',
+            group=perf_group)
+
+        self.settings.bytesize(
+            ['upload-spool-size'],
+            'maximum amount of data waiting in the upload spool',
+            default=obnamlib.DEFAULT_UPLOAD_SPOOL_SIZE,
+            group=perf_group)
+
+        self.settings.integer(
+            ['upload-threads'],
+            'number of background uploads from the upload spool',
+            metavar='N',
+            default=obnamlib.DEFAULT_UPLOAD_THREADS,
+            group=perf_group)
+
         # Settings to help developers and development of Obnam.
 
         devel_group = obnamlib.option_group['devel']
@@ -228,12 +264,21 @@ class App(cliapp.Application):
         if self.settings['quiet']:
             self.ts.disable()
 
-    def get_repository_object(self, create=False, repofs=None):
-        '''Return an implementation of obnamlib.RepositoryInterface.'''
+    def get_repository_object(self, create=False, repofs=None, spool=True):
+        '''Return an implementation of obnamlib.RepositoryInterface.
+
+        If spool is false, writes are never spooled, even if an upload
+        spool is set. Extra repository objects that are only read from,
+        such as those of worker threads, should not each have a spool
+        of their own, with its own upload threads and recovery of
+        unfinished uploads.
+
+        '''
 
         logging.info('Opening repository: %s', self.settings['repository'])
         tracing.trace('create=%s', create)
         tracing.trace('repofs=%s', repofs)
+        tracing.trace('spool=%s', spool)
 
         repopath = self.settings['repository']
         if repofs is None:
@@ -241,6 +286,9 @@ class App(cliapp.Application):
             if self.settings['crash-limit'] > 0:
                 repofs.crash_limit = self.settings['crash-limit']
             repofs.connect()
+            repofs = self._maybe_cache_repository_fs(repofs)
+            if spool:
+                repofs = self._maybe_spool_repository_fs(repofs)
         else:
             repofs.reinit(repopath)
 
@@ -263,6 +311,26 @@ class App(cliapp.Application):
         else:
             return self.repo_factory.open_existing_repo(repofs, **kwargs)
 
+    def _maybe_cache_repository_fs(self, fs):
+        # There's no point in caching a local repository.
+        cache_dir = self.settings['repository-cache']
+        if not cache_dir or isinstance(fs, obnamlib.LocalFS):
+            return fs
+        logging.info('Using repository cache %s', cache_dir)
+        return obnamlib.CachingFS(
+            fs, os.path.expanduser(cache_dir),
+            self.settings['repository-cache-size'])
+
+    def _maybe_spool_repository_fs(self, fs):
+        spool_dir = self.settings['upload-spool']
+        if not spool_dir or isinstance(fs, obnamlib.LocalFS):
+            return fs
+        logging.info('Using upload spool %s', spool_dir)
+        return obnamlib.SpoolingFS(
+            fs, os.path.expanduser(spool_dir),
+            self.settings['upload-spool-size'],
+            self.settings['upload-threads'])
+
     def get_default_repository_class(self):
         classes = {
             '6': obnamlib.RepositoryFormat6,
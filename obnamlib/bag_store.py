@@ -16,6 +16,8 @@
 # =*= License: GPL-3+ =*=
 
 
+import errno
+import itertools
 import os
 import random
 
@@ -24,6 +26,8 @@ import obnamlib
 
 class BagStore(object):
 
+    _read_size = 64 * 1024
+
     def __init__(self):
         self._fs = None
         self._dirname = None
@@ -49,13 +53,48 @@ class BagStore(object):
 
     def put_bag(self, bag):
         filename = self._make_bag_filename(bag.get_id())
-        serialised = serialise_bag(bag)
-        self._fs.overwrite_file(filename, serialised)
+        pieces = obnamlib.serialise_object_pieces(_bag_to_object(bag))
+        with self._fs.open_writer(filename, overwrite=True) as writer:
+            for piece in pieces:
+                writer.write(piece)
 
     def get_bag(self, bag_id):
         filename = self._make_bag_filename(bag_id)
-        serialised = self._fs.cat(filename)
-        return deserialise_bag(serialised)
+        f = self._fs.open_reader(filename)
+        try:
+            obj = obnamlib.deserialise_object_from_file(f)
+        finally:
+            f.close()
+        return _bag_from_object(obj)
+
+    def find_bag(self, bag_id):
+        '''Return the bag with the given id, or None if it doesn't exist.
+
+        This is like has_bag followed by get_bag, but only needs to
+        access the filesystem once.
+
+        '''
+
+        filename = self._make_bag_filename(bag_id)
+        try:
+            f = self._fs.open_reader(filename)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise  # pragma: no cover
+            return None
+        try:
+            first = f.read(1)
+            if not first:
+                # An id reserved by IdInventor, but not yet used for a
+                # bag. Anything else that is too short is a broken bag,
+                # and deserialising it raises an error.
+                return None
+            rest = iter(lambda: f.read(self._read_size), '')
+            reader = obnamlib.PieceReader(itertools.chain([first], rest))
+            obj = obnamlib.deserialise_object_from_file(reader)
+        finally:
+            f.close()
+        return _bag_from_object(obj)
 
     def has_bag(self, bag_id):
         filename = self._make_bag_filename(bag_id)
@@ -84,51 +123,88 @@ class BagStore(object):
 
 class IdInventor(object):
 
+    '''Invent new, unused bag identifiers.
+
+    Identifiers are reserved in blocks of consecutive values. A block
+    is claimed by creating an empty placeholder file for its first
+    identifier, and the rest of the block is then handed out without
+    touching the filesystem. Blocks are aligned to the block size, so
+    two sessions can only collide on the placeholder file. This
+    means only one remote file creation for a whole block of bags,
+    instead of one per bag.
+
+    '''
+
+    default_block_size = 256
+
     def __init__(self):
         self.set_fs(None)
         self._filename_maker = None
+        self._block_size = self.default_block_size
 
     def set_fs(self, fs):
         self._fs = fs
         self._prev_id = None
+        self._block_end = None
 
     def set_filename_maker(self, maker):
         self._filename_maker = maker
 
+    def set_block_size(self, block_size):
+        assert block_size > 0
+        self._block_size = block_size
+        self._prev_id = None
+        self._block_end = None
+
     def reserve_id(self):
-        while True:
-            self._next_id()
-            if self._reserve_succeeds():
-                return self._prev_id
-            self._prev_id = None  # pragma: no cover
-
-    def _next_id(self):
-        if self._prev_id is None:
-            self._prev_id = random.randint(0, obnamlib.MAX_ID)
+        if self._block_is_exhausted():
+            self._reserve_new_block()
         else:
-            self._prev_id += 1  # pragma: no cover
+            self._prev_id += 1
+        return self._prev_id
+
+    def _block_is_exhausted(self):
+        return self._prev_id is None or self._prev_id + 1 >= self._block_end
 
-    def _reserve_succeeds(self):
-        filename = self._filename_maker(self._prev_id)
+    def _reserve_new_block(self):
+        while True:
+            block_start = self._random_block_start()
+            if self._reserve_succeeds(block_start):
+                self._prev_id = block_start
+                self._block_end = block_start + self._block_size
+                return
+
+    def _random_block_start(self):
+        num_blocks = (obnamlib.MAX_ID + 1) // self._block_size
+        return random.randint(0, num_blocks - 1) * self._block_size
+
+    def _reserve_succeeds(self, block_start):
+        filename = self._filename_maker(block_start)
         try:
             self._fs.write_file(filename, '')
         except OSError as e:  # pragma: no cover
-            if e.errno == e.EEXIST:
+            if e.errno == errno.EEXIST:
                 return False
             raise
         return True
 
 
 def serialise_bag(bag):
-    obj = {
+    return obnamlib.serialise_object(_bag_to_object(bag))
+
+
+def deserialise_bag(serialised):
+    return _bag_from_object(obnamlib.deserialise_object(serialised))
+
+
+def _bag_to_object(bag):
+    return {
         'bag-id': bag.get_id(),
         'blobs': [bag[i] for i in range(len(bag))],
     }
-    return obnamlib.serialise_object(obj)
 
 
-def deserialise_bag(serialised):
-    obj = obnamlib.deserialise_object(serialised)
+def _bag_from_object(obj):
     bag = obnamlib.Bag()
     bag.set_id(obj['bag-id'])
     for blob in obj['blobs']:
@@ -68,6 +68,29 @@ class BagStoreTests(unittest.TestCase):
         self.store.remove_bag(self.bag.get_id())
         self.assertFalse(self.store.has_bag(self.bag.get_id()))
 
+    def test_finds_a_put_bag(self):
+        self.bag.append('foo')
+        self.store.put_bag(self.bag)
+        new_bag = self.store.find_bag(self.bag.get_id())
+        self.assertEqualBags(new_bag, self.bag)
+
+    def test_does_not_find_a_removed_bag(self):
+        self.store.put_bag(self.bag)
+        self.store.remove_bag(self.bag.get_id())
+        self.assertEqual(self.store.find_bag(self.bag.get_id()), None)
+
+    def test_does_not_find_a_reserved_but_unused_bag(self):
+        self.assertEqual(self.store.find_bag(self.bag.get_id()), None)
+
+    def test_find_bag_raises_error_for_truncated_bag(self):
+        self.bag.append('foo')
+        self.store.put_bag(self.bag)
+        filename = self.store._make_bag_filename(self.bag.get_id())
+        data = self.fs.cat(filename)
+        self.fs.overwrite_file(filename, data[:-1])
+        self.assertRaises(
+            EOFError, self.store.find_bag, self.bag.get_id())
+
     def test_lists_bag_that_has_been_put(self):
         self.store.put_bag(self.bag)
         self.assertEqual(list(self.store.get_bag_ids()), [self.bag.get_id()])
@@ -76,3 +99,37 @@ class BagStoreTests(unittest.TestCase):
         self.store.put_bag(self.bag)
         self.store.remove_bag(self.bag.get_id())
         self.assertEqual(list(self.store.get_bag_ids()), [])
+
+
+class IdInventorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = WriteCountingFS()
+        self.inventor = obnamlib.bag_store.IdInventor()
+        self.inventor.set_fs(self.fs)
+        self.inventor.set_filename_maker(lambda bag_id: '%016x' % bag_id)
+        self.inventor.set_block_size(4)
+
+    def test_reserves_consecutive_ids_with_one_write(self):
+        ids = [self.inventor.reserve_id() for i in range(4)]
+        self.assertEqual(ids, range(ids[0], ids[0] + 4))
+        self.assertEqual(len(self.fs.written), 1)
+
+    def test_block_starts_at_aligned_id(self):
+        bag_id = self.inventor.reserve_id()
+        self.assertEqual(bag_id % 4, 0)
+        self.assertEqual(self.fs.written, ['%016x' % bag_id])
+
+    def test_reserves_new_block_when_exhausted(self):
+        ids = [self.inventor.reserve_id() for i in range(5)]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(len(self.fs.written), 2)
+
+
+class WriteCountingFS(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write_file(self, filename, data):
+        self.written.append(filename)
@@ -43,8 +43,8 @@ class BlobStore(object):
             return self._bag[index]
         if blob_id in self._cached_blobs:
             return self._cached_blobs.get(blob_id)
-        if self._bag_store.has_bag(bag_id):
-            bag = self._bag_store.get_bag(bag_id)
+        bag = self._bag_store.find_bag(bag_id)
+        if bag is not None:
             for i in range(len(bag)):
                 this_blob = bag[i]
                 this_id = obnamlib.make_object_id(bag_id, i)
@@ -118,5 +118,8 @@ class DummyBagStore(object):
     def has_bag(self, bag_id):
         return bag_id in self._bags
 
+    def find_bag(self, bag_id):
+        return self._bags.get(bag_id)
+
     def get_bag(self, bag_id):
         return self._bags[bag_id]
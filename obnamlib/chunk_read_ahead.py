@@ -0,0 +1,86 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import collections
+import sys
+import threading
+
+
+class ChunkReadAhead(object):
+
+    '''Fetch chunk contents in a background thread, in order.
+
+    Up to max_chunks chunks are fetched ahead of the caller, who
+    iterates over the contents. The repository is used by the
+    background thread only, so the caller must not use it until
+    close has been called.
+
+    If fetching a chunk fails, the exception is raised to the caller
+    when it gets to that chunk, and nothing after it is fetched. The
+    caller may stop iterating at any point, for example when it finds
+    that the data differs, and must then call close, which stops the
+    fetching.
+
+    '''
+
+    def __init__(self, repo, chunkids, max_chunks):
+        self._count = len(chunkids)
+        self._max_chunks = max_chunks
+        self._items = collections.deque()
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._fetch, args=(repo, chunkids))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch(self, repo, chunkids):
+        for chunkid in chunkids:
+            with self._cond:
+                while (len(self._items) >= self._max_chunks and
+                       not self._stopped):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            try:
+                item = (repo.get_chunk_content(chunkid), None)
+            except BaseException:
+                item = (None, sys.exc_info())
+            with self._cond:
+                self._items.append(item)
+                self._cond.notify_all()
+            if item[1] is not None:
+                return
+
+    def __iter__(self):
+        for i in range(self._count):
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                data, exc_info = self._items.popleft()
+                self._cond.notify_all()
+            if exc_info is not None:
+                exc_type, exc_value, exc_tb = exc_info
+                raise exc_type, exc_value, exc_tb
+            yield data
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
@@ -0,0 +1,120 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import threading
+import unittest
+
+import obnamlib
+
+
+class FakeRepository(object):
+
+    def __init__(self, num_chunks):
+        self.chunks = dict(
+            (chunkid, 'chunk %d' % chunkid) for chunkid in range(num_chunks))
+        self.fetched = []
+        self.broken = set()
+
+    def get_chunk_content(self, chunkid):
+        self.fetched.append(chunkid)
+        if chunkid in self.broken:
+            raise obnamlib.RepositoryChunkDoesNotExist(
+                chunk_id=chunkid, filename='chunks/%d' % chunkid)
+        return self.chunks[chunkid]
+
+
+class GatedRepository(FakeRepository):
+
+    # Each fetch waits for the test to let it through.
+
+    def __init__(self, num_chunks):
+        FakeRepository.__init__(self, num_chunks)
+        self.gate = threading.Semaphore(0)
+
+    def get_chunk_content(self, chunkid):
+        self.gate.acquire()
+        return FakeRepository.get_chunk_content(self, chunkid)
+
+
+class ChunkReadAheadTests(unittest.TestCase):
+
+    def test_returns_nothing_for_no_chunks(self):
+        repo = FakeRepository(0)
+        contents = obnamlib.ChunkReadAhead(repo, [], 4)
+        self.assertEqual(list(contents), [])
+        contents.close()
+
+    def test_returns_contents_in_order(self):
+        repo = FakeRepository(10)
+        chunkids = [3, 1, 4, 1, 5, 9, 2, 6]
+        contents = obnamlib.ChunkReadAhead(repo, chunkids, 2)
+        self.assertEqual(
+            list(contents), [repo.chunks[x] for x in chunkids])
+        contents.close()
+        self.assertEqual(repo.fetched, chunkids)
+
+    def test_fetches_at_most_max_chunks_ahead(self):
+        repo = FakeRepository(10)
+        contents = obnamlib.ChunkReadAhead(repo, range(10), 3)
+        it = iter(contents)
+        self.assertEqual(it.next(), repo.chunks[0])
+        contents.close()
+        # One chunk was taken by the caller, and at most three were
+        # waiting: the fourth may have been fetched after the first
+        # one was taken.
+        self.assertTrue(len(repo.fetched) <= 5)
+
+    def test_close_stops_fetching_after_early_stop(self):
+        # This is what happens when the caller finds that the data
+        # differs after the first chunk.
+        repo = GatedRepository(100)
+        contents = obnamlib.ChunkReadAhead(repo, range(100), 1)
+        repo.gate.release()
+        for data in contents:
+            self.assertEqual(data, repo.chunks[0])
+            break
+        repo.gate.release()
+        contents.close()
+        for i in range(100):
+            repo.gate.release()
+        self.assertTrue(len(repo.fetched) <= 2)
+
+    def test_close_returns_without_iterating(self):
+        repo = FakeRepository(100)
+        contents = obnamlib.ChunkReadAhead(repo, range(100), 4)
+        contents.close()
+        self.assertTrue(len(repo.fetched) <= 4)
+
+    def test_raises_fetch_error_in_caller(self):
+        repo = FakeRepository(10)
+        repo.broken.add(2)
+        contents = obnamlib.ChunkReadAhead(repo, range(10), 4)
+        it = iter(contents)
+        self.assertEqual(it.next(), repo.chunks[0])
+        self.assertEqual(it.next(), repo.chunks[1])
+        self.assertRaises(obnamlib.RepositoryChunkDoesNotExist, it.next)
+        contents.close()
+
+    def test_does_not_fetch_after_error(self):
+        repo = FakeRepository(10)
+        repo.broken.add(0)
+        contents = obnamlib.ChunkReadAhead(repo, range(10), 4)
+        self.assertRaises(
+            obnamlib.RepositoryChunkDoesNotExist, list, contents)
+        contents.close()
+        self.assertEqual(repo.fetched, [0])
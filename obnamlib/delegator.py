@@ -106,6 +106,7 @@ class RepositoryDelegator(obnamlib.RepositoryInterface):
     def commit_client_list(self):
         self._require_we_got_client_list_lock()
         self._client_list.commit()
+        self._fs.sync()
 
     def got_client_list_lock(self):
         dirname = self._client_list.get_dirname()
@@ -175,6 +176,7 @@ class RepositoryDelegator(obnamlib.RepositoryInterface):
         self._require_got_client_lock(client_name)
         client = self._lookup_client(client_name)
         client.commit()
+        self._fs.sync()
 
     def got_client_lock(self, client_name):
         client = self._lookup_client(client_name)
@@ -188,6 +190,10 @@ class RepositoryDelegator(obnamlib.RepositoryInterface):
     def get_client_generation_ids(self, client_name):
         return self._lookup_client(client_name).get_client_generation_ids()
 
+    def get_client_generation_summaries(self, client_name, keys=None):
+        return self._lookup_client(client_name).get_generation_summaries(
+            self._get_generation_summary_keys(keys))
+
     def create_generation(self, client_name):
         self._require_got_client_lock(client_name)
         return self._lookup_client(client_name).create_generation()
@@ -267,11 +273,16 @@ class RepositoryDelegator(obnamlib.RepositoryInterface):
         client = self._lookup_client_by_generation(generation_id)
         return client.get_file_chunk_ids(generation_id.gen_number, filename)
 
-    def append_file_chunk_id(self, generation_id, filename, chunk_id):
+    def get_file_chunk_sizes(self, generation_id, filename):
+        client = self._lookup_client_by_generation(generation_id)
+        return client.get_file_chunk_sizes(generation_id.gen_number, filename)
+
+    def append_file_chunk_id(self, generation_id, filename, chunk_id,
+                             chunk_size=None):
         self._require_got_client_lock(generation_id.client_name)
         client = self._lookup_client_by_generation(generation_id)
         return client.append_file_chunk_id(
-            generation_id.gen_number, filename, chunk_id)
+            generation_id.gen_number, filename, chunk_id, chunk_size)
 
     def clear_file_chunk_ids(self, generation_id, filename):
         self._require_got_client_lock(generation_id.client_name)
@@ -282,6 +293,28 @@ class RepositoryDelegator(obnamlib.RepositoryInterface):
         client = self._lookup_client_by_generation(generation_id)
         return client.get_file_children(generation_id.gen_number, filename)
 
+    def list_directory(self, generation_id, dirname):
+        client = self._lookup_client_by_generation(generation_id)
+        return client.list_directory(generation_id.gen_number, dirname)
+
+    def get_directory_metadata(self, generation_id, dirname):
+        client = self._lookup_client_by_generation(generation_id)
+        return client.get_directory_metadata(
+            generation_id.gen_number, dirname)
+
+    def walk_generation_files(self, generation_id, dirname):
+        client = self._lookup_client_by_generation(generation_id)
+        return client.walk_generation_files(
+            generation_id.gen_number, dirname)
+
+    def diff_generations(self, gen_id1, gen_id2, dirname):
+        if gen_id1.client_name != gen_id2.client_name:
+            return obnamlib.RepositoryInterface.diff_generations(
+                self, gen_id1, gen_id2, dirname)
+        client = self._lookup_client_by_generation(gen_id2)
+        return client.diff_generations(
+            gen_id1.gen_number, gen_id2.gen_number, dirname)
+
     #
     # Chunk storage methods.
     #
@@ -331,7 +364,13 @@ class RepositoryDelegator(obnamlib.RepositoryInterface):
 
     def commit_chunk_indexes(self):
         self._require_we_got_chunk_indexes_lock()
+        # The chunk indexes are written with open_writer, which
+        # doesn't wait for earlier uploads the way overwrite_file
+        # does, so the bags holding the chunks must be on disk
+        # first.
+        self._fs.sync()
         self._chunk_indexes.commit()
+        self._fs.sync()
 
     def got_chunk_indexes_lock(self):
         dirname = self._chunk_indexes.get_dirname()
@@ -17,7 +17,9 @@
 import os
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
 import tracing
 
 import obnamlib
@@ -112,8 +114,96 @@ def decrypt_symmetric(encrypted, key, gpghome=None):
     return _gpg_pipe(['-d'], encrypted, key, gpghome=gpghome)
 
 
-def _gpg(args, stdin='', gpghome=None):
-    '''Run gpg and return its output.'''
+def encrypt_symmetric_stream(pieces, key, gpghome=None):
+    '''Like encrypt_symmetric, but for data given as pieces.
+
+    pieces is an iterable of strings. The encrypted data is returned
+    as an iterator of strings.
+
+    '''
+
+    return _gpg_pipe_stream(['-c'], pieces, key, gpghome=gpghome)
+
+
+def decrypt_symmetric_stream(pieces, key, gpghome=None):
+    '''Like decrypt_symmetric, but for data given as pieces.'''
+    return _gpg_pipe_stream(['-d'], pieces, key, gpghome=gpghome)
+
+
+def _gpg_pipe_stream(args, pieces, passphrase, gpghome=None):
+    '''Pipe pieces of data through gpg, and yield pieces of its output.
+
+    This is like _gpg_pipe, except the data is fed to gpg from a
+    separate thread while its output is read, so that neither the
+    input nor the output needs to be in memory all at once.
+
+    '''
+
+    keypipe = os.pipe()
+    os.write(keypipe[1], passphrase + '\n')
+    os.close(keypipe[1])
+    try:
+        p = _start_gpg(
+            args + ['--passphrase-fd', str(keypipe[0])], gpghome=gpghome)
+    finally:
+        os.close(keypipe[0])
+
+    feed_errors = []
+    stderr = []
+
+    def feed():
+        try:
+            for piece in pieces:
+                p.stdin.write(piece)
+        except BaseException:  # pragma: no cover
+            feed_errors.append(sys.exc_info())
+        finally:
+            try:
+                p.stdin.close()
+            except IOError:  # pragma: no cover
+                pass
+
+    def read_stderr():
+        stderr.append(p.stderr.read())
+
+    threads = [
+        threading.Thread(target=feed),
+        threading.Thread(target=read_stderr),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = False
+    try:
+        while True:
+            data = p.stdout.read(_stream_piece_size)
+            if not data:
+                break
+            yield data
+        finished = True
+    finally:
+        if not finished:  # pragma: no cover
+            # Our caller gave up before reading everything.
+            p.kill()
+        p.stdout.close()
+        for thread in threads:
+            thread.join()
+        p.wait()
+
+    if feed_errors:  # pragma: no cover
+        exc_type, exc_value, exc_tb = feed_errors[0]
+        raise exc_type, exc_value, exc_tb
+    if p.returncode:  # pragma: no cover
+        raise GpgError(returncode=p.returncode, stderr=''.join(stderr))
+
+
+# How much of gpg's output to read at a time when streaming.
+_stream_piece_size = 1024**2
+
+
+def _start_gpg(args, gpghome=None):
+    '''Start gpg, with pipes for stdin, stdout, and stderr.'''
 
     env = dict()
     env.update(os.environ)
@@ -123,8 +213,15 @@ def _gpg(args, stdin='', gpghome=None):
 
     argv = ['gpg', '-q', '--batch', '--no-textmode'] + args
     tracing.trace('argv=%s', repr(argv))
-    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE, env=env)
+    return subprocess.Popen(
+        argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env=env)
+
+
+def _gpg(args, stdin='', gpghome=None):
+    '''Run gpg and return its output.'''
+
+    p = _start_gpg(args, gpghome=gpghome)
     out, err = p.communicate(stdin)
 
     # Return output data, or deal with errors.
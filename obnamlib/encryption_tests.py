@@ -69,6 +69,24 @@ class SymmetricEncryptionTests(unittest.TestCase):
                                                gpghome=self.gpghome)
         self.assertEqual(decrypted, cleartext)
 
+    def test_streaming_encrypt_decrypt_round_trip(self):
+        pieces = ['hello', ', ', 'world']
+        key = 'sekr1t'
+        encrypted = obnamlib.encrypt_symmetric_stream(
+            pieces, key, gpghome=self.gpghome)
+        decrypted = obnamlib.decrypt_symmetric_stream(
+            encrypted, key, gpghome=self.gpghome)
+        self.assertEqual(''.join(decrypted), 'hello, world')
+
+    def test_streaming_decrypts_non_streaming_encryption(self):
+        key = 'sekr1t'
+        encrypted = obnamlib.encrypt_symmetric(
+            'hello, world', key, gpghome=self.gpghome)
+        pieces = [encrypted[:10], encrypted[10:]]
+        decrypted = obnamlib.decrypt_symmetric_stream(
+            pieces, key, gpghome=self.gpghome)
+        self.assertEqual(''.join(decrypted), 'hello, world')
+
 
 class SymmetricKeyCacheTests(unittest.TestCase):
 
@@ -0,0 +1,150 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import errno
+import logging
+import os
+import random
+
+import tracing
+
+import obnamlib
+
+
+class ChunkJournal(object):
+
+    '''Chunks waiting to be put into the chunk indexes.
+
+    Changing the chunk indexes requires locking them, and when many
+    clients make backups at the same time, they end up waiting for
+    each other to get the lock. Instead, a client can write the chunks
+    it wants to add to the indexes into a journal file of its own,
+    without locking anything but the client. Whoever locks the chunk
+    indexes next reads all the journal files, puts their chunks into
+    the indexes, and removes the files once the indexes have been
+    committed. If the indexes get unlocked without a commit, the
+    files stay, and get read again next time.
+
+    Each journal file is written in one go, with a random name, so
+    that clients never need to coordinate with each other when
+    writing them. A file is written under a temporary name first, and
+    renamed to end in the journal suffix once it is complete, so that
+    whoever reads the journal never sees a partly written file. A
+    file that can't be read anyway is left for later.
+
+    '''
+
+    suffix = '.journal'
+    temp_suffix = '.new'
+
+    def __init__(self, fs, dirname):
+        self._fs = fs
+        self.dirname = dirname
+        self.clear()
+
+    def clear(self):
+        '''Forget which journal files have been read.'''
+        self._read = []
+
+    def write(self, chunks, client_id):
+        '''Write a new journal file.
+
+        chunks is a list of (chunk id, token) pairs, to be put into
+        the indexes for the given client.
+
+        '''
+
+        data = {
+            'client-id': client_id,
+            'chunks': [[chunk_id, token] for chunk_id, token in chunks],
+        }
+        blob = obnamlib.serialise_object(data)
+
+        while True:
+            basename = '%016x' % random.getrandbits(64)
+            filename = os.path.join(self.dirname, basename)
+            try:
+                self._fs.write_file(filename + self.temp_suffix, blob)
+            except OSError, e:  # pragma: no cover
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            else:
+                self._fs.rename(
+                    filename + self.temp_suffix, filename + self.suffix)
+                tracing.trace('wrote %d chunks to %s', len(chunks), filename)
+                return filename + self.suffix
+
+    def read_new(self):
+        '''Read the journal files that haven't been read yet.
+
+        Return a list of (chunk id, token, client id) tuples.
+
+        '''
+
+        # Other clients write journal files without holding the lock
+        # we have, so we can't rely on the cached knowledge of whether
+        # the directory exists.
+        try:
+            basenames = self._fs.listdir(self.dirname)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise  # pragma: no cover
+            return []
+
+        result = []
+        basenames = sorted(
+            basename
+            for basename in basenames
+            if basename.endswith(self.suffix))
+        for basename in basenames:
+            filename = os.path.join(self.dirname, basename)
+            if filename not in self._read:
+                chunks = self._read_file(filename)
+                if chunks is not None:
+                    result.extend(chunks)
+                    self._read.append(filename)
+        return result
+
+    def _read_file(self, filename):
+        # A broken file must not stop whoever holds the chunk index
+        # lock from doing their work. It is not marked as read, so it
+        # is neither removed nor forgotten: it is tried again next
+        # time, and in the meantime the chunks in it are only missing
+        # from the indexes, which means they can't be re-used.
+        try:
+            data = obnamlib.deserialise_object(self._fs.cat(filename))
+            client_id = data['client-id']
+            return [
+                (chunk_id, token, client_id)
+                for chunk_id, token in data['chunks']]
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning(
+                'Ignoring chunk journal file %s for now: %s', filename, e)
+            return None
+
+    def commit(self):
+        '''Remove the journal files that have been read.
+
+        Call this only after the chunks read from them are safely in
+        the committed chunk indexes.
+
+        '''
+
+        for filename in self._read:
+            tracing.trace('removing %s', filename)
+            self._fs.remove(filename)
+        self.clear()
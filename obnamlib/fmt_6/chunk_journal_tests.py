@@ -0,0 +1,112 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class ChunkJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        hooks = obnamlib.HookManager()
+        hooks.new_filter('repository-data')
+        self.fs = obnamlib.RepositoryFS(
+            self, obnamlib.LocalFS(self.tempdir), hooks)
+        self.journal = self.new_journal()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_journal(self):
+        return obnamlib.ChunkJournal(self.fs, 'journal')
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.journal.read_new(), [])
+
+    def test_reads_written_chunks(self):
+        self.journal.write([(1, 'token1'), (2, 'token2')], 42)
+        self.assertEqual(
+            self.journal.read_new(),
+            [(1, 'token1', 42), (2, 'token2', 42)])
+
+    def test_reads_chunks_from_all_files(self):
+        self.journal.write([(1, 'token1')], 42)
+        self.journal.write([(2, 'token2')], 43)
+        self.assertEqual(
+            sorted(self.journal.read_new()),
+            [(1, 'token1', 42), (2, 'token2', 43)])
+
+    def test_does_not_read_same_file_twice(self):
+        self.journal.write([(1, 'token1')], 42)
+        self.journal.read_new()
+        self.assertEqual(self.journal.read_new(), [])
+
+    def test_reads_file_written_after_previous_read(self):
+        self.journal.write([(1, 'token1')], 42)
+        self.journal.read_new()
+        self.journal.write([(2, 'token2')], 43)
+        self.assertEqual(self.journal.read_new(), [(2, 'token2', 43)])
+
+    def test_ignores_other_files(self):
+        self.fs.write_file('journal/lock', '')
+        self.assertEqual(self.journal.read_new(), [])
+
+    def test_leaves_no_temporary_file(self):
+        filename = self.journal.write([(1, 'token1')], 42)
+        self.assertEqual(
+            self.fs.listdir('journal'), [os.path.basename(filename)])
+
+    def test_ignores_file_being_written(self):
+        self.fs.write_file('journal/0123.journal.new', '')
+        self.assertEqual(self.journal.read_new(), [])
+
+    def test_skips_broken_file(self):
+        self.fs.write_file('journal/0123.journal', '')
+        self.journal.write([(1, 'token1')], 42)
+        self.assertEqual(self.journal.read_new(), [(1, 'token1', 42)])
+
+    def test_reads_broken_file_again_once_it_is_fixed(self):
+        self.fs.write_file('journal/0123.journal', 'garbage')
+        self.assertEqual(self.journal.read_new(), [])
+        self.journal.commit()
+        self.fs.overwrite_file(
+            'journal/0123.journal',
+            obnamlib.serialise_object(
+                {'client-id': 42, 'chunks': [[1, 'token1']]}))
+        self.assertEqual(self.journal.read_new(), [(1, 'token1', 42)])
+
+    def test_commit_removes_read_files(self):
+        self.journal.write([(1, 'token1')], 42)
+        self.journal.read_new()
+        self.journal.commit()
+        self.assertEqual(self.new_journal().read_new(), [])
+
+    def test_commit_keeps_files_that_were_not_read(self):
+        self.journal.write([(1, 'token1')], 42)
+        self.journal.commit()
+        self.assertEqual(self.new_journal().read_new(), [(1, 'token1', 42)])
+
+    def test_clear_keeps_files(self):
+        self.journal.write([(1, 'token1')], 42)
+        self.journal.read_new()
+        self.journal.clear()
+        self.journal.commit()
+        self.assertEqual(self.journal.read_new(), [(1, 'token1', 42)])
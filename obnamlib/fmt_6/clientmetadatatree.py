@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import bisect
 import hashlib
 import os
 import random
@@ -61,6 +62,31 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
     GEN_FILE_COUNT = 4      # subkey type for count of files+dirs in a gen
     GEN_TOTAL_DATA = 5      # subkey type for sum of all file sizes in gen
     GEN_TEST_DATA = 6       # subkey type for REPO_GENERATION_TEST_KEY
+    GEN_LIFETIMES = 7       # subkey type for generations in lifetimes
+
+    # Lifetimes of the chunks the client uses. A lifetime is the range
+    # of generation ids, from first to last, of generations that use
+    # a chunk. If the newest generation uses the chunk, the last
+    # generation id is OPEN_GEN. A chunk may have several lifetimes,
+    # if it stops being used and then gets used again.
+    #
+    # The lifetimes are kept in a forest of their own, in the
+    # "lifetimes" sub-directory of the client's directory. They must
+    # not be in the same forest as the generations: older versions of
+    # Obnam base a new generation on the last tree in that forest,
+    # whatever it is. Each lifetime is stored twice: once with the
+    # last generation id as the main key and the chunk id as the
+    # subkey, with the first generation id as the value, and once with
+    # the chunk id as the main key and the first generation id as the
+    # subkey, with the last generation id as the value. The
+    # GEN_LIFETIMES key has a checksum of the ids of the generations
+    # the lifetimes are up to date with. The two forests are committed
+    # separately, and any generation changed without updating the
+    # lifetimes, by a crash between the commits or by an older
+    # version of Obnam, makes the checksum not match.
+    PREFIX_LIFETIME_BY_END = 3
+    PREFIX_LIFETIME_BY_CHUNK = 4
+    OPEN_GEN = obnamlib.MAX_ID
 
     # Maximum values for the subkey type field, and the subkey field.
     # Both have a minimum value of 0.
@@ -79,6 +105,10 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         self.chunkids_per_key = max(1,
                                     int(node_size / 4 / struct.calcsize('Q')))
         self.init_caches()
+        self._chunk_changes = {}
+        self._lifetimes = ChunkLifetimesForest(
+            fs, os.path.join(client_dir, 'lifetimes'), key_bytes,
+            node_size, upload_queue_size, lru_size, repo)
 
     def init_caches(self):
         self.known_generations = {}
@@ -215,7 +245,10 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
     def commit(self):
         tracing.trace('committing ClientMetadataTree')
+        if self.tree is not None:
+            self._update_chunk_lifetimes()
         obnamlib.RepositoryTree.commit(self)
+        self._lifetimes.commit()
 
     def init_forest(self, *args, **kwargs):
         self.init_caches()
@@ -257,6 +290,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
     def start_generation(self):
         tracing.trace('start new generation')
         self.start_changes()
+        self._chunk_changes = {}
         gen_id = self.forest.new_id()
         self._insert_int(self.tree, self.genkey(self.GEN_ID), gen_id)
 
@@ -276,6 +310,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         tree = self.find_generation(genid)
         if tree == self.tree:
             self.tree = None
+            self._chunk_changes = {}
         self.forest.remove_tree(tree)
 
     def get_generation_id(self, tree):
@@ -409,8 +444,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
         # Remove chunk refs.
         for chunkid in self.get_file_chunks(genid, filename):
-            key = self.chunk_key(chunkid, file_id)
-            self.tree.remove_range(key, key)
+            self._remove_chunk_ref(chunkid, file_id)
 
         # Remove this file's metadata.
         minkey = self.fskey(file_id, 0, 0)
@@ -443,6 +477,95 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
             basenames.append(value)
         return basenames
 
+    def listdir_metadata(self, genid, dirname):
+        '''List a directory, with the encoded metadata of each file.
+
+        Return a list of (basename, encoded metadata) pairs, in the
+        same order as listdir. The children's file ids are in the
+        directory's contents, so each child costs one lookup. Files
+        without metadata are skipped, as in walk.
+
+        '''
+
+        tree = self.find_generation(genid)
+        try:
+            dir_id = self.get_file_id(tree, dirname)
+        except KeyError:  # pragma: no cover
+            return []
+        minkey = self.fskey(dir_id, self.DIR_CONTENTS, 0)
+        maxkey = self.fskey(dir_id, self.DIR_CONTENTS, self.SUBKEY_MAX)
+        result = []
+        for key, basename in tree.lookup_range(minkey, maxkey):
+            _, child_id = self.fs_unkey(key)
+            key = self.fskey(
+                child_id, self.FILE_METADATA, self.FILE_METADATA_ENCODED)
+            try:
+                result.append((basename, tree.lookup(key)))
+            except KeyError:  # pragma: no cover
+                pass
+        return result
+
+    def walk(self, genid, filename):
+        '''Walk the files in a generation, starting at filename.
+
+        This is a generator. Each return value is a tuple of pathname,
+        encoded metadata, list of chunk ids, and whether the file has
+        in-tree data. Children come before their parent, in the same
+        order as listdir returns them. Files without metadata don't
+        exist, as far as the repository is concerned, and are skipped.
+
+        All the keys of one file share the file's id as their main
+        hash, and each directory's contents list the file ids of the
+        children, so every file only costs one range lookup.
+
+        '''
+
+        tree = self.find_generation(genid)
+        file_id = self.get_file_id(tree, filename)
+        return self._walk(tree, filename, file_id)
+
+    def _walk(self, tree, pathname, file_id):
+        # This uses an explicit stack rather than recursion, so that
+        # deep trees don't cost a generator per level or hit the
+        # recursion limit. Each entry on the stack is a file whose
+        # keys have been read, and an iterator over its children that
+        # haven't been walked yet.
+        stack = [self._walk_entry(tree, pathname, file_id)]
+        while stack:
+            pathname, result, children = stack[-1]
+            for basename, child_id in children:
+                child = os.path.join(pathname, basename)
+                stack.append(self._walk_entry(tree, child, child_id))
+                break
+            else:
+                stack.pop()
+                if result is not None:
+                    yield result
+
+    def _walk_entry(self, tree, pathname, file_id):
+        encoded_metadata = None
+        chunkids = []
+        has_data = False
+        children = []
+
+        minkey = self.fskey(file_id, 0, 0)
+        maxkey = self.fskey(file_id, self.TYPE_MAX, self.SUBKEY_MAX)
+        for key, value in tree.lookup_range(minkey, maxkey):
+            _, _, subtype, subkey = struct.unpack('!B8sB8s', key)
+            if subtype == self.FILE_METADATA:
+                encoded_metadata = value
+            elif subtype == self.FILE_CHUNKS:
+                chunkids.extend(self._decode_chunks(value))
+            elif subtype == self.DIR_CONTENTS:
+                children.append((value, subkey))
+            elif subtype == self.FILE_DATA:  # pragma: no cover
+                has_data = True
+
+        result = None
+        if encoded_metadata is not None:
+            result = (pathname, encoded_metadata, chunkids, has_data)
+        return pathname, result, iter(children)
+
     def get_file_chunks(self, genid, filename):
         tree = self.find_generation(genid)
         try:
@@ -482,8 +605,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
         for _, value in self.tree.lookup_range(minkey, maxkey):
             for chunkid in self._decode_chunks(value):
-                k = self.chunk_key(chunkid, file_id)
-                self.tree.remove_range(k, k)
+                self._remove_chunk_ref(chunkid, file_id)
 
         self.tree.remove_range(minkey, maxkey)
 
@@ -503,26 +625,297 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
             some = chunkids[:self.chunkids_per_key]
             self._insert_chunks(self.tree, file_id, i, some)
             for chunkid in some:
-                self.tree.insert(self.chunk_key(chunkid, file_id), '')
+                self._add_chunk_ref(chunkid, file_id)
             i += 1
             chunkids = chunkids[self.chunkids_per_key:]
 
-    def chunk_in_use(self, gen_id, chunk_id):
-        '''Is a chunk used by a generation?'''
+    def _add_chunk_ref(self, chunk_id, file_id):
+        if not self._tree_uses_chunk(self.tree, chunk_id):
+            self._note_chunk_change(chunk_id, True)
+        self.tree.insert(self.chunk_key(chunk_id, file_id), '')
+
+    def _remove_chunk_ref(self, chunk_id, file_id):
+        key = self.chunk_key(chunk_id, file_id)
+        if not self.tree.range_is_empty(key, key):
+            self.tree.remove_range(key, key)
+            if not self._tree_uses_chunk(self.tree, chunk_id):
+                self._note_chunk_change(chunk_id, False)
+
+    def _note_chunk_change(self, chunk_id, added):
+        # Remember if the current generation started or stopped using
+        # a chunk, compared to the generation it was based on. Doing
+        # one and then the other is no change at all.
+        if self._chunk_changes.get(chunk_id, added) == added:
+            self._chunk_changes[chunk_id] = added
+        else:
+            del self._chunk_changes[chunk_id]
 
+    def _tree_uses_chunk(self, tree, chunk_id):
         minkey = self.chunk_key(chunk_id, 0)
         maxkey = self.chunk_key(chunk_id, obnamlib.MAX_ID)
-        t = self.find_generation(gen_id)
-        return not t.range_is_empty(minkey, maxkey)
+        return not tree.range_is_empty(minkey, maxkey)
+
+    def chunk_in_use(self, gen_id, chunk_id):
+        '''Is a chunk used by a generation?'''
+        return self._tree_uses_chunk(self.find_generation(gen_id), chunk_id)
 
     def list_chunks_in_generation(self, gen_id):
         '''Return list of chunk ids used in a given generation.'''
+        return list(self.iter_chunks_in_generation(gen_id))
+
+    def iter_chunks_in_generation(self, gen_id):
+        '''Generate chunk ids used in a generation, in increasing order.
+
+        Each chunk id is generated only once, even if several files
+        use it.
+
+        '''
 
         minkey = self.chunk_key(0, 0)
         maxkey = self.chunk_key(obnamlib.MAX_ID, obnamlib.MAX_ID)
         t = self.find_generation(gen_id)
-        return list(set(self.chunk_unkey(key)[0]
-                        for key, value in t.lookup_range(minkey, maxkey)))
+        prev = None
+        for key, value in t.lookup_range(minkey, maxkey):
+            chunk_id = self.chunk_unkey(key)[0]
+            if chunk_id != prev:
+                yield chunk_id
+                prev = chunk_id
+
+    def find_unused_chunks(self, gen_ids):
+        '''Return chunks that are unused once some generations are gone.
+
+        Only chunks this client no longer uses in any other generation
+        are returned. This must be called just before the generations
+        are removed, in the same commit, since it updates the chunk
+        lifetimes as if they had been removed already.
+
+        '''
+
+        tracing.trace('gen_ids=%s', gen_ids)
+        current = None
+        if self.tree is not None:
+            current = self.get_generation_id(self.tree)
+        committed = sorted(
+            g for g in self.list_generations() if g != current)
+        lifetimes = self._get_chunk_lifetimes(committed)
+
+        removed = set(gen_ids)
+        remaining = [g for g in committed if g not in removed]
+        newest = remaining[-1] if remaining else 0
+        self._set_lifetimes_generations(lifetimes, remaining)
+        keep_current = current is not None and current not in removed
+        if keep_current:
+            # The generation being made is based on the newest
+            # committed one, so the open lifetimes are what it uses,
+            # until its own changes are applied when it's committed.
+            remaining.append(current)
+
+        # A lifetime has ended if there's no remaining generation
+        # within it. Only lifetimes that end between the removed
+        # generations and the next remaining one need to be looked at.
+        gaps = set()
+        for gen_id in removed.intersection(committed):
+            i = bisect.bisect_left(remaining, gen_id)
+            prev_gen = remaining[i - 1] if i > 0 else None
+            next_gen = remaining[i] if i < len(remaining) else None
+            gaps.add((prev_gen, next_gen))
+
+        dead = []
+        for prev_gen, next_gen in gaps:
+            lo = 0 if prev_gen is None else prev_gen + 1
+            hi = self.OPEN_GEN if next_gen is None else next_gen - 1
+            minkey = self._lifetime_end_key(lo, 0)
+            maxkey = self._lifetime_end_key(hi, obnamlib.MAX_ID)
+            for key, value in lifetimes.lookup_range(minkey, maxkey):
+                last, chunk_id = self._unkey_ints(key)
+                first = struct.unpack('!Q', value)[0]
+                if prev_gen is None or first > prev_gen:
+                    dead.append((chunk_id, first, last))
+
+        if keep_current:
+            # Chunks the generation being made has stopped using are
+            # still in open lifetimes. Those lifetimes end just before
+            # it, once it's committed.
+            for chunk_id, added in sorted(self._chunk_changes.items()):
+                key = self._lifetime_end_key(self.OPEN_GEN, chunk_id)
+                first = self._lookup_int(lifetimes, key)
+                if not added and first is not None and first > newest:
+                    dead.append((chunk_id, first, self.OPEN_GEN))
+                    del self._chunk_changes[chunk_id]
+
+        for chunk_id, first, last in dead:
+            self._remove_lifetime(lifetimes, chunk_id, first, last)
+
+        # If the newest generations are removed, the newest remaining
+        # one becomes the one that uses the chunks in open lifetimes.
+        # Unless a generation is being made: it's based on the removed
+        # one, and its changes are relative to that.
+        if newest and not keep_current:
+            self._reopen_lifetimes(lifetimes, newest)
+
+        # Chunks the generation being made has started using don't
+        # have lifetimes until it's committed.
+        new_chunks = set(
+            chunk_id
+            for chunk_id, added in self._chunk_changes.items()
+            if added)
+        unused = set(chunk_id for chunk_id, first, last in dead)
+        if keep_current:
+            unused.difference_update(new_chunks)
+        elif current is not None:
+            unused.update(new_chunks)
+        return sorted(
+            chunk_id for chunk_id in unused
+            if not self._has_lifetimes(lifetimes, chunk_id))
+
+    def _lifetime_end_key(self, last, chunk_id):
+        return self.hashkey(
+            self.PREFIX_LIFETIME_BY_END, self.int2bin(last), 0, chunk_id)
+
+    def _lifetime_chunk_key(self, chunk_id, first):
+        return self.hashkey(
+            self.PREFIX_LIFETIME_BY_CHUNK, self.int2bin(chunk_id), 0, first)
+
+    def _unkey_ints(self, key):
+        parts = struct.unpack('!BQBQ', key)
+        return parts[1], parts[3]
+
+    def _find_lifetimes_tree(self):
+        # Return the tree with the lifetimes, ready for changes, or
+        # None if there are no lifetimes. A tree with a generation id
+        # is never taken to have lifetimes, whatever else it has.
+        self._lifetimes.start_changes()
+        t = self._lifetimes.tree
+        if self.get_generation_id(t) is not None:
+            return None
+        try:
+            t.lookup(self.genkey(self.GEN_LIFETIMES))
+        except KeyError:
+            return None
+        return t
+
+    def _new_lifetimes_tree(self):
+        # Replace any lifetimes there are with an empty tree.
+        forest = self._lifetimes
+        forest.start_changes(create_tree=False)
+        if forest.tree is not None:
+            forest.forest.remove_tree(forest.tree)
+        forest.tree = forest.forest.new_tree()
+        return forest.tree
+
+    def _generations_checksum(self, gen_ids):
+        return hashlib.md5(
+            ''.join(self.int2bin(g) for g in sorted(gen_ids))).digest()
+
+    def _set_lifetimes_generations(self, lifetimes, gen_ids):
+        lifetimes.insert(
+            self.genkey(self.GEN_LIFETIMES),
+            self._generations_checksum(gen_ids))
+
+    def _lifetimes_are_up_to_date(self, lifetimes, gen_ids):
+        try:
+            value = lifetimes.lookup(self.genkey(self.GEN_LIFETIMES))
+        except KeyError:  # pragma: no cover
+            return False
+        return value == self._generations_checksum(gen_ids)
+
+    def _has_lifetimes(self, lifetimes, chunk_id):
+        minkey = self._lifetime_chunk_key(chunk_id, 0)
+        maxkey = self._lifetime_chunk_key(chunk_id, obnamlib.MAX_ID)
+        return not lifetimes.range_is_empty(minkey, maxkey)
+
+    def _open_lifetime(self, lifetimes, chunk_id, first):
+        self._insert_int(
+            lifetimes, self._lifetime_end_key(self.OPEN_GEN, chunk_id), first)
+        self._insert_int(
+            lifetimes, self._lifetime_chunk_key(chunk_id, first),
+            self.OPEN_GEN)
+
+    def _close_lifetime(self, lifetimes, chunk_id, last):
+        # Return False if there's no open lifetime to close.
+        key = self._lifetime_end_key(self.OPEN_GEN, chunk_id)
+        first = self._lookup_int(lifetimes, key)
+        if first is None:
+            return False
+        lifetimes.remove_range(key, key)
+        self._insert_int(
+            lifetimes, self._lifetime_end_key(last, chunk_id), first)
+        self._insert_int(
+            lifetimes, self._lifetime_chunk_key(chunk_id, first), last)
+        return True
+
+    def _remove_lifetime(self, lifetimes, chunk_id, first, last):
+        key = self._lifetime_end_key(last, chunk_id)
+        lifetimes.remove_range(key, key)
+        key = self._lifetime_chunk_key(chunk_id, first)
+        lifetimes.remove_range(key, key)
+
+    def _reopen_lifetimes(self, lifetimes, newest):
+        minkey = self._lifetime_end_key(newest, 0)
+        maxkey = self._lifetime_end_key(self.OPEN_GEN - 1, obnamlib.MAX_ID)
+        for key, value in list(lifetimes.lookup_range(minkey, maxkey)):
+            last, chunk_id = self._unkey_ints(key)
+            first = struct.unpack('!Q', value)[0]
+            self._remove_lifetime(lifetimes, chunk_id, first, last)
+            self._open_lifetime(lifetimes, chunk_id, first)
+
+    def _update_chunk_lifetimes(self):
+        # Apply the changes in chunk use made by the current generation
+        # to the lifetimes. If there are no lifetimes yet, for a client
+        # that already has generations, they get computed when they're
+        # first needed, by _get_chunk_lifetimes.
+
+        changes = self._chunk_changes
+        self._chunk_changes = {}
+
+        gen_id = self.get_generation_id(self.tree)
+        if gen_id is None:  # pragma: no cover
+            return
+        prev_gens = [g for g in self.list_generations() if g != gen_id]
+
+        lifetimes = self._find_lifetimes_tree()
+        if lifetimes is None:
+            if prev_gens:
+                return
+            lifetimes = self._new_lifetimes_tree()
+        elif not self._lifetimes_are_up_to_date(lifetimes, prev_gens):
+            # Generations have been changed without updating the
+            # lifetimes, perhaps by an older version of Obnam. Throw
+            # them away, so they get computed again.
+            self._new_lifetimes_tree()
+            return
+
+        for chunk_id in sorted(changes):
+            if changes[chunk_id]:
+                self._open_lifetime(lifetimes, chunk_id, gen_id)
+            elif not self._close_lifetime(lifetimes, chunk_id, gen_id - 1):
+                self._new_lifetimes_tree()  # pragma: no cover
+                return  # pragma: no cover
+        self._set_lifetimes_generations(lifetimes, prev_gens + [gen_id])
+
+    def _get_chunk_lifetimes(self, committed):
+        # Return the lifetimes tree, computing it first from the
+        # committed generations, if it's missing or out of date.
+        # committed is the sorted list of committed generation ids.
+
+        lifetimes = self._find_lifetimes_tree()
+        if lifetimes is not None:
+            if self._lifetimes_are_up_to_date(lifetimes, committed):
+                return lifetimes
+
+        tracing.trace('computing chunk lifetimes')
+        lifetimes = self._new_lifetimes_tree()
+        prev = []
+        for gen_id in committed:
+            chunk_ids = list(self.iter_chunks_in_generation(gen_id))
+            added, dropped = _compare_sorted(prev, chunk_ids)
+            for chunk_id in dropped:
+                self._close_lifetime(lifetimes, chunk_id, gen_id - 1)
+            for chunk_id in added:
+                self._open_lifetime(lifetimes, chunk_id, gen_id)
+            prev = chunk_ids
+        self._set_lifetimes_generations(lifetimes, committed)
+        return lifetimes
 
     def set_file_data(self, filename, contents):  # pragma: no cover
         '''Store contents of file, if small, in B-tree instead of chunk.
@@ -547,3 +940,55 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
             return tree.lookup(key)
         except KeyError:
             return None
+
+
+class ChunkLifetimesForest(obnamlib.RepositoryTree):
+
+    '''The forest with a client's chunk lifetimes.
+
+    It has just one tree. The forest is in a sub-directory of the
+    client's directory, which is already initialised as a toplevel
+    directory, so unlike other RepositoryTrees it doesn't initialise
+    its directory when it creates it.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        obnamlib.RepositoryTree.__init__(self, *args, **kwargs)
+        self.keep_just_one_tree = True
+
+    def start_changes(self, create_tree=True):
+        if self.forest is None or not self.forest_allows_writes:
+            if not self.fs.exists(self.dirname):
+                tracing.trace('create %s', self.dirname)
+                self.fs.mkdir(self.dirname)
+            self.forest = None
+            self.init_forest(allow_writes=True)
+
+        if self.tree is None and create_tree:
+            self.tree = self.forest.new_tree(self.get_newest_tree())
+
+
+def _compare_sorted(old, new):
+    '''Return items only in new, and items only in old.
+
+    Both lists must be sorted and without duplicates.
+
+    '''
+
+    added = []
+    dropped = []
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            dropped.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    dropped.extend(old[i:])
+    added.extend(new[j:])
+    return added, dropped
@@ -324,3 +324,147 @@ class ClientMetadataTreeFileOpsTests(unittest.TestCase):
         self.client.set_file_chunks('/foo', [0])
         self.client.set_file_chunks('/bar', [0])
         self.assertEqual(self.client.list_chunks_in_generation(gen_id), [0])
+
+    def test_iterates_chunks_in_generation_in_order(self):
+        gen_id = self.client.get_generation_id(self.client.tree)
+        self.client.set_file_chunks('/foo', [2, 0])
+        self.client.set_file_chunks('/bar', [1, 2])
+        self.assertEqual(
+            list(self.client.iter_chunks_in_generation(gen_id)), [0, 1, 2])
+
+
+class ClientMetadataTreeChunkLifetimeTests(unittest.TestCase):
+
+    def current_time(self):
+        return time.time()
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fs = obnamlib.LocalFS(self.tempdir)
+        self.hooks = obnamlib.HookManager()
+        self.hooks.new('repository-toplevel-init')
+        self.client = self.new_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_client(self):
+        return obnamlib.ClientMetadataTree(
+            self.fs, 'clientid', obnamlib.DEFAULT_NODE_SIZE,
+            obnamlib.DEFAULT_UPLOAD_QUEUE_SIZE, obnamlib.DEFAULT_LRU_SIZE,
+            self)
+
+    def start(self, chunk_ids):
+        self.client.start_generation()
+        self.client.set_file_chunks('/foo', chunk_ids)
+        return self.client.get_generation_id(self.client.tree)
+
+    def backup(self, chunk_ids):
+        gen_id = self.start(chunk_ids)
+        self.client.commit()
+        return gen_id
+
+    def forget(self, gen_ids):
+        if self.client.tree is None:
+            self.client.start_changes(create_tree=False)
+        unused = self.client.find_unused_chunks(gen_ids)
+        for gen_id in gen_ids:
+            self.client.remove_generation(gen_id)
+        self.client.commit()
+        return unused
+
+    def test_finds_chunks_used_only_by_removed_generation(self):
+        gen1 = self.backup([1, 2])
+        self.backup([2, 3])
+        self.assertEqual(self.forget([gen1]), [1])
+
+    def test_finds_no_chunks_used_by_newer_generation(self):
+        self.backup([1, 2])
+        gen2 = self.backup([2, 3])
+        self.assertEqual(self.forget([gen2]), [3])
+
+    def test_finds_chunk_used_again_only_when_all_users_are_removed(self):
+        gen1 = self.backup([1])
+        self.backup([])
+        gen3 = self.backup([1])
+        self.assertEqual(self.forget([gen3]), [])
+        self.assertEqual(self.forget([gen1]), [1])
+
+    def test_finds_chunks_of_several_generations_at_once(self):
+        gen1 = self.backup([1, 2])
+        gen2 = self.backup([2, 3])
+        self.backup([3])
+        self.assertEqual(self.forget([gen1, gen2]), [1, 2])
+
+    def test_finds_all_chunks_when_all_generations_are_removed(self):
+        gen1 = self.backup([1, 2])
+        gen2 = self.backup([2, 3])
+        self.assertEqual(self.forget([gen1, gen2]), [1, 2, 3])
+
+    def test_keeps_lifetimes_across_instances(self):
+        gen1 = self.backup([1, 2])
+        self.backup([2])
+        self.client = self.new_client()
+        self.client.init_forest()
+        self.assertEqual(self.forget([gen1]), [1])
+
+    def test_keeps_lifetimes_out_of_generation_forest(self):
+        self.backup([1, 2])
+        self.backup([2])
+        self.assertEqual(
+            len(self.client.forest.trees),
+            len(self.client.list_generations()))
+
+    def test_does_not_take_generation_for_lifetimes(self):
+        self.backup([1, 2])
+        lifetimes = self.client._find_lifetimes_tree()
+        self.client._insert_int(
+            lifetimes, self.client.genkey(self.client.GEN_ID), 1)
+        self.assertEqual(self.client._find_lifetimes_tree(), None)
+
+    def test_computes_missing_lifetimes(self):
+        gen1 = self.backup([1, 2])
+        self.backup([2])
+        self.client.start_changes(create_tree=False)
+        self.client._new_lifetimes_tree()
+        self.client.commit()
+        self.backup([2, 3])
+        self.assertEqual(self.forget([gen1]), [1])
+
+    def test_recomputes_lifetimes_not_committed_with_generations(self):
+        gen1 = self.backup([1, 2])
+        self.backup([2])
+        self.client.start_generation()
+        self.client.set_file_chunks('/foo', [3])
+        self.client._update_chunk_lifetimes()
+        obnamlib.RepositoryTree.commit(self.client)
+        self.client = self.new_client()
+        self.client.init_forest()
+        self.assertEqual(self.forget([gen1]), [1])
+
+    def test_recomputes_outdated_lifetimes(self):
+        gen1 = self.backup([1, 2])
+        gen2 = self.backup([2, 3])
+        self.client.start_changes(create_tree=False)
+        self.client.remove_generation(gen2)
+        self.client.commit()
+        self.backup([2])
+        self.assertEqual(self.forget([gen1]), [1])
+
+    def test_finds_new_chunks_of_removed_current_generation(self):
+        self.backup([1, 2])
+        gen2 = self.start([2, 3])
+        self.assertEqual(self.forget([gen2]), [3])
+
+    def test_finds_chunks_dropped_by_current_generation(self):
+        gen1 = self.backup([1, 2])
+        gen2 = self.start([2, 3])
+        self.assertEqual(self.forget([gen1]), [1])
+        self.assertEqual(self.forget([gen2]), [2, 3])
+
+    def test_finds_no_chunks_used_again_by_current_generation(self):
+        gen1 = self.backup([1, 2])
+        self.backup([])
+        gen3 = self.start([1])
+        self.assertEqual(self.forget([gen1]), [2])
+        self.assertEqual(self.forget([gen3]), [1])
@@ -0,0 +1,151 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import tracing
+
+import obnamlib
+
+
+class PendingChunks(object):
+
+    '''Chunks that are waiting to be removed from the repository.
+
+    A backup finds chunks it can re-use by looking them up in the
+    chunk indexes, without holding a lock, and adds its own use of
+    them to the indexes only when it commits. Meanwhile, a forget
+    for another client may find that nobody uses a chunk, and remove
+    it from the indexes. If the chunk file was removed right away,
+    the backup would end up using a chunk that no longer exists.
+
+    Instead, such chunks are put on this list, and removed later, in
+    a sweep, once every backup that could have found them has
+    finished. Backups register when they start, and the list keeps
+    count of epochs: each commit that adds chunks to the list starts
+    a new epoch. A chunk added in an epoch can be removed once every
+    backup still running registered in a later epoch, since those
+    backups started after the chunk was gone from the indexes. If no
+    backup is running at all, every chunk on the list can be removed,
+    even those added since the last commit. A
+    backup that does end up using a chunk on the list takes it off
+    the list when its chunks are put into the indexes. A backup's
+    registration is replaced when the client starts its next backup.
+
+    The list is stored in one file, which must only be changed while
+    the chunk indexes are locked.
+
+    '''
+
+    def __init__(self, fs, filename):
+        self._fs = fs
+        self._filename = filename
+        self.clear()
+
+    def clear(self):
+        '''Forget changes since the previous commit.'''
+        self._epoch = None
+        self._pending = None
+        self._backups = None
+        self._dirty = False
+        self._added = False
+
+    def _load(self):
+        if self._pending is not None:
+            return
+        blob = self._fs.cat_if_exists(self._filename)
+        if blob is None:
+            data = {}
+        else:
+            data = obnamlib.deserialise_object(blob)
+        self._epoch = data.get('epoch', 0)
+        self._pending = dict(data.get('pending', []))
+        self._backups = data.get('backups', {})
+
+    def commit(self):
+        '''Write out the changes, if there are any.'''
+        if self._dirty:
+            if self._added:
+                self._epoch += 1
+            data = {
+                'epoch': self._epoch,
+                'pending': [list(pair) for pair in self._pending.items()],
+                'backups': self._backups,
+            }
+            self._fs.overwrite_file(
+                self._filename, obnamlib.serialise_object(data))
+        self.clear()
+
+    def register_backup(self, client_name):
+        self._load()
+        self._backups[client_name] = self._epoch
+        self._dirty = True
+
+    def add(self, chunk_id):
+        tracing.trace('chunk_id=%s', chunk_id)
+        self._load()
+        self._pending[chunk_id] = self._epoch
+        self._dirty = True
+        self._added = True
+
+    def remove(self, chunk_id):
+        '''Take a chunk off the list, because it's in use after all.'''
+        self._load()
+        if chunk_id in self._pending:
+            tracing.trace('chunk_id=%s', chunk_id)
+            del self._pending[chunk_id]
+            self._dirty = True
+
+    def __contains__(self, chunk_id):
+        self._load()
+        return chunk_id in self._pending
+
+    def get_chunk_ids(self):
+        '''Return the chunks on the list, in sorted order.'''
+        self._load()
+        return sorted(self._pending)
+
+    def sweep(self, running):
+        '''Take the chunks that can be removed now off the list.
+
+        running is the list of the names of the clients that might be
+        running a backup. A client that is running but hasn't
+        registered might have started any time, so nothing on the list
+        can be removed then. If no client is running, everything on
+        the list can be removed.
+
+        Return the chunks that were taken off the list.
+
+        '''
+
+        self._load()
+        if not self._pending:
+            return []
+
+        if running:
+            oldest = self._epoch
+            for client_name in running:
+                oldest = min(oldest, self._backups.get(client_name, -1))
+        else:
+            oldest = self._epoch + 1
+
+        removable = sorted(
+            chunk_id
+            for chunk_id, epoch in self._pending.iteritems()
+            if epoch < oldest)
+        for chunk_id in removable:
+            del self._pending[chunk_id]
+        if removable:
+            self._dirty = True
+        return removable
@@ -0,0 +1,122 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class PendingChunksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        hooks = obnamlib.HookManager()
+        hooks.new_filter('repository-data')
+        self.fs = obnamlib.RepositoryFS(
+            self, obnamlib.LocalFS(self.tempdir), hooks)
+        self.pending = self.new_pending()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_pending(self):
+        return obnamlib.PendingChunks(self.fs, 'pending')
+
+    def test_is_empty_initially(self):
+        self.assertFalse(0 in self.pending)
+        self.assertEqual(self.pending.sweep([]), [])
+
+    def test_adds_chunk(self):
+        self.pending.add(0)
+        self.assertTrue(0 in self.pending)
+
+    def test_removes_chunk(self):
+        self.pending.add(0)
+        self.pending.remove(0)
+        self.assertFalse(0 in self.pending)
+
+    def test_removing_unknown_chunk_is_ok(self):
+        self.pending.remove(0)
+        self.assertFalse(0 in self.pending)
+
+    def test_commit_makes_changes_persistent(self):
+        self.pending.add(0)
+        self.pending.commit()
+        self.assertTrue(0 in self.new_pending())
+
+    def test_clear_forgets_changes(self):
+        self.pending.add(0)
+        self.pending.clear()
+        self.assertFalse(0 in self.pending)
+
+    def test_lists_chunks(self):
+        self.pending.add(1)
+        self.pending.add(0)
+        self.assertEqual(self.pending.get_chunk_ids(), [0, 1])
+
+    def test_sweeps_chunk_added_since_commit_if_no_backups_run(self):
+        self.pending.add(0)
+        self.assertEqual(self.pending.sweep([]), [0])
+
+    def test_does_not_sweep_chunk_added_since_commit_while_backup_runs(self):
+        self.pending.register_backup('foo')
+        self.pending.add(0)
+        self.assertEqual(self.pending.sweep(['foo']), [])
+
+    def test_sweeps_chunk_when_no_backups_are_running(self):
+        self.pending.add(0)
+        self.pending.commit()
+        self.assertEqual(self.pending.sweep([]), [0])
+        self.assertFalse(0 in self.pending)
+
+    def test_sweeps_chunk_after_backup_started_later(self):
+        self.pending.add(0)
+        self.pending.commit()
+        self.pending.register_backup('foo')
+        self.pending.commit()
+        self.assertEqual(self.pending.sweep(['foo']), [0])
+
+    def test_keeps_chunk_while_earlier_backup_runs(self):
+        self.pending.register_backup('foo')
+        self.pending.commit()
+        self.pending.add(0)
+        self.pending.commit()
+        self.assertEqual(self.pending.sweep(['foo']), [])
+
+    def test_sweeps_chunk_after_earlier_backup_is_started_again(self):
+        self.pending.register_backup('foo')
+        self.pending.commit()
+        self.pending.add(0)
+        self.pending.commit()
+        self.pending.register_backup('foo')
+        self.pending.commit()
+        self.assertEqual(self.pending.sweep(['foo']), [0])
+
+    def test_ignores_registration_of_backup_that_is_not_running(self):
+        self.pending.register_backup('foo')
+        self.pending.commit()
+        self.pending.add(0)
+        self.pending.commit()
+        self.assertEqual(self.pending.sweep([]), [0])
+
+    def test_keeps_everything_while_unregistered_backup_runs(self):
+        self.pending.add(0)
+        self.pending.commit()
+        self.pending.add(1)
+        self.pending.commit()
+        self.assertEqual(self.pending.sweep(['foo']), [])
@@ -136,6 +136,7 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
                 'repository-add-client', self, client_name)
         self._added_clients = []
         self._client_list.commit()
+        self._fs.sync()
 
     def got_client_list_lock(self):
         return self._lockmgr.got_lock('.')
@@ -333,47 +334,61 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
             open_client_info.generations_removed)
         if need_to_commit:
             open_client_info.client.commit()
+            self._fs.sync()
 
     def _remove_chunks_from_removed_generations(
             self, client_name, remove_gen_nos):
 
-        def find_chunkids_in_gens(gen_nos):
-            chunkids = set()
-            for gen_number in gen_nos:
-                gen_id = self._construct_gen_id(client_name, gen_number)
-                x = self.get_generation_chunk_ids(gen_id)
-                chunkids = chunkids.union(set(x))
-            return chunkids
-
-        def find_gens_to_keep():
-            keep = []
-            for gen_id in self.get_client_generation_ids(client_name):
-                _, gen_number = self._unpack_gen_id(gen_id)
-                if gen_number not in remove_gen_nos:
-                    keep.append(gen_number)
-            return keep
-
-        def remove_chunks(chunk_ids):  # pragma: no cover
-            for chunk_id in chunk_ids:
-                try:
-                    checksum = self._chunklist.get_checksum(chunk_id)
-                except KeyError:
-                    # No checksum, therefore it can't be shared, therefore
-                    # we can remove it.
-                    self._unused_chunks.append(chunk_id)
-                else:
-                    self.remove_chunk_from_indexes(chunk_id, client_name)
-                    can_be_removed = (
-                        self.has_chunk(chunk_id) and
-                        not self._chunksums.chunk_is_used(checksum, chunk_id))
-                    if can_be_removed:
-                        self._unused_chunks.append(chunk_id)
-
-        keep_gen_nos = find_gens_to_keep()
-        keep_chunkids = find_chunkids_in_gens(keep_gen_nos)
-        maybe_remove_chunkids = find_chunkids_in_gens(remove_gen_nos)
-        remove_chunkids = maybe_remove_chunkids.difference(keep_chunkids)
-        remove_chunks(remove_chunkids)
+        # The client keeps track of the lifetimes of the chunks it
+        # uses, so it can tell which chunks the removed generations
+        # were the last ones to use, without looking at the other
+        # generations. Those chunks may still be used by other
+        # clients, so that still needs to be checked.
+
+        client = self._open_client(client_name)
+        unused = client.find_unused_chunks(remove_gen_nos)
+        for chunk_id in unused:  # pragma: no cover
+            try:
+                checksum = self._chunklist.get_checksum(chunk_id)
+            except KeyError:
+                # No checksum, therefore it can't be shared, therefore
+                # we can remove it.
+                self._unused_chunks.append(chunk_id)
+            else:
+                self.remove_chunk_from_indexes(chunk_id, client_name)
+                can_be_removed = (
+                    self.has_chunk(chunk_id) and
+                    not self._chunksums.chunk_is_used(checksum, chunk_id))
+                if can_be_removed:
+                    # A backup that is running right now may have
+                    # found the chunk in the indexes already, so it
+                    # can only be removed later.
+                    self._pending_chunks.add(chunk_id)
+
+    def _sweep_pending_chunks(self):
+        # Find the chunks that were waiting for running backups to
+        # finish, and can now be removed. Clients we've locked aren't
+        # running a backup, so they don't count.
+        running = [
+            client_name
+            for client_name in self.get_client_names()
+            if not self.got_client_lock(client_name) and
+            self.client_is_locked(client_name)]
+
+        # A backup writes its journal before it unlocks its client.
+        # Merging the journal only now, after finding out which clients
+        # are running, means that the chunks used by every backup that
+        # has finished are in the indexes.
+        self._merge_chunk_journal()
+
+        for chunk_id in self._pending_chunks.sweep(running):
+            # If some backup that doesn't know about the pending
+            # chunks has put the chunk back into the indexes, it's
+            # in use again.
+            try:
+                self._chunklist.get_checksum(chunk_id)
+            except KeyError:
+                self._unused_chunks.append(chunk_id)
 
     def get_allowed_client_keys(self):
         return []
@@ -546,22 +561,43 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         return str(gen_number)
 
     def remove_generation(self, gen_id):
-        tracing.trace('gen_id=%s' % repr(gen_id))
-        client_name, gen_number = self._unpack_gen_id(gen_id)
-        self._require_client_lock(client_name)
-        self._require_existing_generation(gen_id)
+        self.remove_generations([gen_id])
 
-        self._open_client(client_name)  # Ensure client is open
-        open_client_info = self._open_client_infos[client_name]
-        if gen_number == open_client_info.current_generation_number:
-            open_client_info.current_generation_number = None
-        open_client_info.generations_removed = True
-        self._forget_open_client_info_cached_generation(
-            open_client_info, gen_id)
+    def remove_generations(self, gen_ids):
+        tracing.trace('gen_ids=%s' % repr(gen_ids))
 
-        self._remove_chunks_from_removed_generations(client_name, [gen_number])
-        open_client_info.client.start_changes(create_tree=False)
-        open_client_info.client.remove_generation(gen_number)
+        # Check everything before removing anything.
+        by_client = {}
+        for gen_id in gen_ids:
+            client_name, gen_number = self._unpack_gen_id(gen_id)
+            self._require_client_lock(client_name)
+            self._require_existing_generation(gen_id)
+            client_gen_ids = by_client.setdefault(client_name, [])
+            if gen_id not in client_gen_ids:
+                client_gen_ids.append(gen_id)
+
+        for client_name, client_gen_ids in by_client.items():
+            self._open_client(client_name)  # Ensure client is open
+            open_client_info = self._open_client_infos[client_name]
+            gen_numbers = []
+            for gen_id in client_gen_ids:
+                _, gen_number = self._unpack_gen_id(gen_id)
+                if gen_number == open_client_info.current_generation_number:
+                    open_client_info.current_generation_number = None
+                self._forget_open_client_info_cached_generation(
+                    open_client_info, gen_id)
+                gen_numbers.append(gen_number)
+            open_client_info.generations_removed = True
+
+            client = open_client_info.client
+            client.start_changes(create_tree=False)
+            self._remove_chunks_from_removed_generations(
+                client_name, gen_numbers)
+            for gen_number in gen_numbers:
+                client.remove_generation(gen_number)
+
+        if gen_ids and self.got_chunk_indexes_lock():
+            self._sweep_pending_chunks()
 
     def get_generation_chunk_ids(self, generation_id):
         # This intentionally doesn't construct chunk ids for in-tree
@@ -711,6 +747,10 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._chunksums = obnamlib.ChecksumTree(
             self._fs, 'chunksums', len(self._checksum('')), self._node_size,
             self._upload_queue_size, self._lru_size, self)
+        self._pending_chunks = obnamlib.PendingChunks(
+            self._fs, os.path.join(self._chunklist.dirname, 'pending'))
+        self._chunk_journal = obnamlib.ChunkJournal(
+            self._fs, os.path.join(self._chunklist.dirname, 'journal'))
 
     def _chunk_index_dirs_to_lock(self):
         return [
@@ -722,11 +762,11 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         if not self.got_chunk_indexes_lock():
             raise obnamlib.RepositoryChunkIndexesNotLocked()
 
-    def _raw_lock_chunk_indexes(self):
+    def _raw_lock_chunk_indexes(self, timeout=None):
         if self.got_chunk_indexes_lock():
             raise obnamlib.RepositoryChunkIndexesLockingFailed()
 
-        self._lockmgr.lock(self._chunk_index_dirs_to_lock())
+        self._lockmgr.lock(self._chunk_index_dirs_to_lock(), timeout=timeout)
 
         tracing.trace('starting changes in chunksums and chunklist')
         self._chunksums.start_changes()
@@ -739,6 +779,8 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         if filenames == [] or filenames == ['lock']:
             self.hooks.call('repository-toplevel-init', self, dirname)
 
+        self._merge_chunk_journal()
+
     def _raw_unlock_chunk_indexes(self):
         self._require_chunk_indexes_lock()
         self._lockmgr.unlock(self._chunk_index_dirs_to_lock())
@@ -766,8 +808,20 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
     def commit_chunk_indexes(self):
         tracing.trace('committing chunk indexes')
         self._require_chunk_indexes_lock()
+        self._pending_chunks.commit()
         self._chunklist.commit()
         self._chunksums.commit()
+        self._fs.sync()
+        self._chunk_journal.commit()
+
+    def get_pending_chunk_ids(self):
+        return self._pending_chunks.get_chunk_ids()
+
+    def register_backup(self, client_name):
+        tracing.trace('client_name=%s', client_name)
+        self._require_existing_client(client_name)
+        self._require_chunk_indexes_lock()
+        self._pending_chunks.register_backup(client_name)
 
     def prepare_chunk_for_indexes(self, data):
         return self._checksum(data)
@@ -781,8 +835,42 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         tracing.trace('client_id=%s', client_id)
 
         self._require_chunk_indexes_lock()
+        self._add_chunk_to_indexes(chunk_id, token, client_id)
+
+    def _add_chunk_to_indexes(self, chunk_id, token, client_id):
         self._chunklist.add(chunk_id, token)
         self._chunksums.add(token, chunk_id, client_id)
+        self._pending_chunks.remove(chunk_id)
+
+    def queue_chunks_for_indexes(self, chunks, client_name):
+        tracing.trace('client_name=%s', client_name)
+        self._require_client_lock(client_name)
+        client_id = self._get_client_id(client_name)
+
+        if self.got_chunk_indexes_lock():
+            for chunk_id, token in chunks:
+                self._add_chunk_to_indexes(chunk_id, token, client_id)
+            return
+
+        if not chunks:
+            return
+        self._chunk_journal.write(chunks, client_id)
+
+        # If nobody is using the chunk indexes right now, merge the
+        # journal into them at once, so other clients can find the
+        # chunks sooner. Otherwise, whoever has the lock, or gets it
+        # next, will merge it.
+        try:
+            self._raw_lock_chunk_indexes(timeout=0)
+        except obnamlib.LockFail:
+            tracing.trace('chunk indexes are locked, not merging journal')
+        else:
+            self.commit_chunk_indexes()
+            self._raw_unlock_chunk_indexes()
+
+    def _merge_chunk_journal(self):
+        for chunk_id, token, client_id in self._chunk_journal.read_new():
+            self._add_chunk_to_indexes(chunk_id, token, client_id)
 
     def remove_chunk_from_indexes(self, chunk_id, client_name):
         tracing.trace('chunk_id=%s', chunk_id)
@@ -961,11 +1049,7 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         dirty, metadata = self._file_key_cache[cache_key]
 
         if key in self._file_keys:
-            value = getattr(metadata, self._file_keys[key])
-            if key in obnamlib.REPO_FILE_INTEGER_KEYS:
-                return value or 0
-            else:
-                return value or ''
+            return self._get_file_key_value(metadata, key)
         else:
             client_name, gen_number = self._unpack_gen_id(generation_id)
             raise obnamlib.RepositoryFileKeyNotAllowed(
@@ -973,6 +1057,13 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
                 client_name=client_name,
                 key_name=obnamlib.repo_key_name(key))
 
+    def _get_file_key_value(self, metadata, key):
+        value = getattr(metadata, self._file_keys[key])
+        if key in obnamlib.REPO_FILE_INTEGER_KEYS:
+            return value or 0
+        else:
+            return value or ''
+
     def set_file_key(self, generation_id, filename, key, value):
         client_name, gen_number = self._unpack_gen_id(generation_id)
         self._require_client_lock(client_name)
@@ -1011,7 +1102,9 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         client = self._open_client(client_name)
         client.set_file_chunks(filename, [])  # FIXME: current gen only
 
-    def append_file_chunk_id(self, generation_id, filename, chunk_id):
+    def append_file_chunk_id(self, generation_id, filename, chunk_id,
+                             chunk_size=None):
+        # Format 6 has no place to store chunk sizes, so we ignore it.
         assert not self._is_in_tree_chunk_id(chunk_id)
         self._require_existing_file(generation_id, filename)
         client_name, gen_number = self._unpack_gen_id(generation_id)
@@ -1026,6 +1119,62 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         return [os.path.join(filename, basename)
                 for basename in client.listdir(gen_number, filename)]
 
+    def list_directory(self, generation_id, dirname):
+        self._require_existing_file(generation_id, dirname)
+        # We read the client directly, as in walk_generation_files.
+        self._flush_file_key_cache()
+        client_name, gen_number = self._unpack_gen_id(generation_id)
+        client = self._open_client(client_name)
+        result = []
+        for basename, encoded_metadata in client.listdir_metadata(
+                gen_number, dirname):
+            stored = obnamlib.fmt_6.metadata_codec.decode_metadata(
+                encoded_metadata)
+            result.append(
+                (os.path.join(dirname, basename),
+                 stat.S_ISDIR(stored.st_mode or 0)))
+        return result
+
+    def get_directory_metadata(self, generation_id, dirname):
+        self._require_existing_file(generation_id, dirname)
+        # We read the client directly, as in walk_generation_files.
+        self._flush_file_key_cache()
+        client_name, gen_number = self._unpack_gen_id(generation_id)
+        client = self._open_client(client_name)
+        return [
+            (os.path.join(dirname, basename),
+             self._decode_metadata(encoded_metadata))
+            for basename, encoded_metadata in client.listdir_metadata(
+                gen_number, dirname)]
+
+    def walk_generation_files(self, generation_id, dirname):
+        self._require_existing_file(generation_id, dirname)
+        # Changed file keys only get written to the client when the
+        # cache is flushed, and we read the client directly.
+        self._flush_file_key_cache()
+        client_name, gen_number = self._unpack_gen_id(generation_id)
+        client = self._open_client(client_name)
+        return self._walk_generation_files(
+            generation_id, client.walk(gen_number, dirname))
+
+    def _walk_generation_files(self, generation_id, walker):
+        for pathname, encoded_metadata, chunk_ids, has_data in walker:
+            metadata = self._decode_metadata(encoded_metadata)
+            if has_data:  # pragma: no cover
+                chunk_ids = [
+                    self._construct_in_tree_chunk_id(generation_id, pathname)]
+            yield pathname, metadata, chunk_ids
+
+    def _decode_metadata(self, encoded_metadata):
+        stored = obnamlib.fmt_6.metadata_codec.decode_metadata(
+            encoded_metadata)
+        metadata = obnamlib.Metadata()
+        for key, field in obnamlib.metadata_file_key_mapping:
+            if key in self._file_keys:
+                value = self._get_file_key_value(stored, key)
+                setattr(metadata, field, value)
+        return metadata
+
     # Fsck.
 
     def get_fsck_work_items(self):  # pragma: no cover
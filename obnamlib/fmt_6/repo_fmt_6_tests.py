@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import shutil
 import tempfile
 
@@ -24,11 +25,157 @@ class RepositoryFormat6Tests(obnamlib.RepositoryInterfaceTests):
 
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
+        self.repo = self.new_repo()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_repo(self):
         fs = obnamlib.LocalFS(self.tempdir)
         self.hooks = obnamlib.HookManager()
         obnamlib.RepositoryFormat6.setup_hooks(self.hooks)
-        self.repo = obnamlib.RepositoryFormat6(hooks=self.hooks)
-        self.repo.set_fs(fs)
+        repo = obnamlib.RepositoryFormat6(hooks=self.hooks)
+        repo.set_fs(fs)
+        return repo
 
-    def tearDown(self):
-        shutil.rmtree(self.tempdir)
+    def queue_chunk(self, repo, data, client_name):
+        chunk_id = repo.put_chunk_content(data)
+        token = repo.prepare_chunk_for_indexes(data)
+        repo.queue_chunks_for_indexes([(chunk_id, token)], client_name)
+        return chunk_id
+
+    def journaled_chunks(self):
+        journal = obnamlib.ChunkJournal(
+            self.repo._fs, self.repo._chunk_journal.dirname)
+        return journal.read_new()
+
+    def test_registering_backup_without_chunk_indexes_lock_fails(self):
+        self.setup_client()
+        self.assertRaises(
+            obnamlib.RepositoryChunkIndexesNotLocked,
+            self.repo.register_backup, 'fooclient')
+
+    def test_registers_backup(self):
+        self.setup_client()
+        self.repo.lock_chunk_indexes()
+        self.repo.register_backup('fooclient')
+        self.repo.commit_chunk_indexes()
+        self.repo.unlock_chunk_indexes()
+
+    def test_using_pending_chunk_keeps_it(self):
+        self.setup_client()
+        self.repo.lock_chunk_indexes()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        self.repo._pending_chunks.add(chunk_id)
+        token = self.repo.prepare_chunk_for_indexes('foochunk')
+        self.repo.put_chunk_into_indexes(chunk_id, token, 'fooclient')
+        self.assertFalse(chunk_id in self.repo._pending_chunks)
+
+    def test_removing_generation_removes_swept_chunks(self):
+        self.setup_client()
+        self.repo.lock_client('fooclient')
+        self.repo.lock_chunk_indexes()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        self.repo._pending_chunks.add(chunk_id)
+        self.repo.commit_chunk_indexes()
+
+        gen_id = self.repo.create_generation('fooclient')
+        self.repo.remove_generation(gen_id)
+        self.repo.commit_client('fooclient')
+        self.repo.commit_chunk_indexes()
+        self.repo.remove_unused_chunks()
+        self.assertFalse(self.repo.has_chunk(chunk_id))
+
+    def test_removing_generation_removes_new_pending_chunks_at_once(self):
+        self.setup_client()
+        self.repo.lock_client('fooclient')
+        self.repo.lock_chunk_indexes()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        self.repo._pending_chunks.add(chunk_id)
+
+        gen_id = self.repo.create_generation('fooclient')
+        self.repo.remove_generation(gen_id)
+        self.repo.commit_client('fooclient')
+        self.repo.commit_chunk_indexes()
+        self.repo.remove_unused_chunks()
+        self.assertFalse(self.repo.has_chunk(chunk_id))
+        self.assertEqual(self.repo.get_pending_chunk_ids(), [])
+
+    def test_lists_pending_chunks(self):
+        self.setup_client()
+        self.repo.lock_chunk_indexes()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        self.repo._pending_chunks.add(chunk_id)
+        self.repo.commit_chunk_indexes()
+        self.assertEqual(self.repo.get_pending_chunk_ids(), [chunk_id])
+
+    def test_merges_queued_chunks_at_once_if_indexes_are_not_locked(self):
+        self.setup_client()
+        self.repo.lock_client('fooclient')
+        chunk_id = self.queue_chunk(self.repo, 'foochunk', 'fooclient')
+        self.assertFalse(self.repo.got_chunk_indexes_lock())
+        self.assertEqual(
+            self.repo.find_chunk_ids_by_content('foochunk'), [chunk_id])
+        self.assertEqual(self.journaled_chunks(), [])
+
+    def test_merges_queued_chunks_when_indexes_are_locked_next(self):
+        self.setup_two_clients()
+        other = self.new_repo()
+        other.lock_chunk_indexes()
+
+        self.repo.lock_client('fooclient')
+        chunk_id = self.queue_chunk(self.repo, 'foochunk', 'fooclient')
+        self.assertNotEqual(self.journaled_chunks(), [])
+
+        other.commit_chunk_indexes()
+        other.unlock_chunk_indexes()
+        self.repo.lock_chunk_indexes()
+        self.assertEqual(
+            self.repo.find_chunk_ids_by_content('foochunk'), [chunk_id])
+        self.repo.commit_chunk_indexes()
+        self.assertEqual(self.journaled_chunks(), [])
+
+    def test_queueing_no_chunks_writes_no_journal(self):
+        self.setup_client()
+        other = self.new_repo()
+        other.lock_chunk_indexes()
+        self.repo.lock_client('fooclient')
+        self.repo.queue_chunks_for_indexes([], 'fooclient')
+        dirname = self.repo._chunk_journal.dirname
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, dirname)))
+
+    def test_keeps_journal_if_indexes_are_not_committed(self):
+        self.setup_client()
+        other = self.new_repo()
+        other.lock_chunk_indexes()
+        self.repo.lock_client('fooclient')
+        self.queue_chunk(self.repo, 'foochunk', 'fooclient')
+        other.unlock_chunk_indexes()
+
+        other.lock_chunk_indexes()
+        other.unlock_chunk_indexes()
+        self.assertNotEqual(self.journaled_chunks(), [])
+
+    def test_queued_chunk_is_not_swept(self):
+        self.setup_two_clients()
+        self.repo.lock_client('fooclient')
+        self.repo.lock_chunk_indexes()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        self.repo._pending_chunks.add(chunk_id)
+        self.repo.commit_chunk_indexes()
+
+        other = self.new_repo()
+        other.lock_client('barclient')
+        token = other.prepare_chunk_for_indexes('foochunk')
+        other.queue_chunks_for_indexes([(chunk_id, token)], 'barclient')
+        other.commit_client('barclient')
+        other.unlock_client('barclient')
+
+        gen_id = self.repo.create_generation('fooclient')
+        self.repo.remove_generation(gen_id)
+        self.repo.commit_client('fooclient')
+        self.repo.commit_chunk_indexes()
+        self.repo.remove_unused_chunks()
+        self.assertTrue(self.repo.has_chunk(chunk_id))
+        self.assertEqual(
+            self.repo.find_chunk_ids_by_content('foochunk'), [chunk_id])
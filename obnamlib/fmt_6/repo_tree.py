@@ -18,6 +18,29 @@ import larch
 import tracing
 
 
+class SyncBeforeOverwriteFS(object):
+
+    '''Pass calls to a VFS, but sync before overwriting any file.
+
+    larch writes the nodes of a forest as new files, and then
+    overwrites the forest's metadata file, which refers to them. The
+    metadata file is the commit record, so everything written before
+    it must be on stable storage first, or a crash may leave it
+    pointing at nodes that were never stored.
+
+    '''
+
+    def __init__(self, fs):
+        self._fs = fs
+
+    def __getattr__(self, name):
+        return getattr(self._fs, name)
+
+    def overwrite_file(self, *args, **kwargs):
+        self._fs.sync()
+        return self._fs.overwrite_file(*args, **kwargs)
+
+
 class RepositoryTree(object):
 
     '''A B-tree within an obnamlib.Repository.
@@ -59,7 +82,7 @@ class RepositoryTree(object):
                                             dirname=self.dirname,
                                             upload_max=self.upload_queue_size,
                                             lru_size=self.lru_size,
-                                            vfs=self.fs,
+                                            vfs=SyncBeforeOverwriteFS(self.fs),
                                             allow_writes=allow_writes)
             self.forest_allows_writes = allow_writes
         return True
@@ -88,8 +111,9 @@ class RepositoryTree(object):
             'it is "%s"' % repr(self.forest_allows_writes)
 
         if self.tree is None and create_tree:
-            if self.forest.trees:
-                self.tree = self.forest.new_tree(self.forest.trees[-1])
+            newest = self.get_newest_tree()
+            if newest is not None:
+                self.tree = self.forest.new_tree(newest)
                 tracing.trace(
                     'use newest tree %s (of %d)',
                     self.tree.root.id,
@@ -98,6 +122,12 @@ class RepositoryTree(object):
                 self.tree = self.forest.new_tree()
                 tracing.trace('new tree root id %s', self.tree.root.id)
 
+    def get_newest_tree(self):
+        '''Return the tree that a new tree should be based on, or None.'''
+        if self.forest.trees:
+            return self.forest.trees[-1]
+        return None
+
     def commit(self):
         tracing.trace('committing')
         if self.forest:
@@ -36,6 +36,7 @@ class GAClient(object):
         self._blob_store = None
         self._client_keys = GAKeys()
         self._generations = GAGenerationList()
+        self._generations_are_loaded = False
         self._data_is_loaded = False
 
     def set_current_time(self, current_time):
@@ -64,6 +65,9 @@ class GAClient(object):
 
     def _save_data(self):
         self._save_file_metadata()
+        # Everything the per-client data file refers to must be on
+        # disk before the file itself is.
+        self._fs.sync()
         self._save_per_client_data()
 
     def _save_file_metadata(self):
@@ -93,17 +97,27 @@ class GAClient(object):
         filename = self._get_filename()
         self._fs.overwrite_file(filename, blob)
 
-    def _load_data(self):
-        if not self._data_is_loaded:
+    # The per-client data file has the keys of all generations, and
+    # the object ids of their file metadata. Reading generation keys
+    # only needs the file, so the file metadata is set up separately,
+    # when something first needs it.
+
+    def _load_generations(self):
+        if not self._generations_are_loaded:
             self.clear()
             self._load_per_client_data()
+            self._generations_are_loaded = True
+
+    def _load_data(self):
+        self._load_generations()
+        if not self._data_is_loaded:
             self._load_file_metadata()
             self._data_is_loaded = True
 
     def _load_per_client_data(self):
         filename = self._get_filename()
-        if self._fs.exists(filename):
-            blob = self._fs.cat(filename)
+        blob = self._fs.cat_if_exists(filename)
+        if blob is not None:
             data = obnamlib.deserialise_object(blob)
             self._client_keys.set_from_dict(data['keys'])
             for gen_dict in data['generations']:
@@ -122,11 +136,19 @@ class GAClient(object):
             metadata.set_root_object_id(gen.get_root_object_id())
 
     def get_client_generation_ids(self):
-        self._load_data()
+        self._load_generations()
         return [
             obnamlib.GenerationId(self._client_name, gen.get_number())
             for gen in self._generations]
 
+    def get_generation_summaries(self, keys):
+        self._load_generations()
+        return [
+            (obnamlib.GenerationId(self._client_name, gen.get_number()),
+             dict((key, self.get_generation_key(gen.get_number(), key))
+                  for key in keys))
+            for gen in self._generations]
+
     def create_generation(self):
         self._load_data()
         self._require_previous_generation_is_finished()
@@ -193,7 +215,7 @@ class GAClient(object):
         self._generations.set_generations(remaining)
 
     def get_generation_key(self, gen_number, key):
-        self._load_data()
+        self._load_generations()
         generation = self._lookup_generation_by_gen_number(gen_number)
         key_name = obnamlib.repo_key_name(key)
         if key in obnamlib.REPO_GENERATION_INTEGER_KEYS:
@@ -303,11 +325,19 @@ class GAClient(object):
                 filename=filename)
         return result
 
-    def append_file_chunk_id(self, gen_number, filename, chunk_id):
+    def get_file_chunk_sizes(self, gen_number, filename):
+        self._load_data()
+        self._require_file_exists(gen_number, filename)
+        generation = self._lookup_generation_by_gen_number(gen_number)
+        metadata = generation.get_file_metadata()
+        return metadata.get_file_chunk_sizes(filename)
+
+    def append_file_chunk_id(self, gen_number, filename, chunk_id,
+                             chunk_size=None):
         self._load_data()
         generation = self._lookup_generation_by_gen_number(gen_number)
         metadata = generation.get_file_metadata()
-        if not metadata.append_file_chunk_id(filename, chunk_id):
+        if not metadata.append_file_chunk_id(filename, chunk_id, chunk_size):
             raise obnamlib.RepositoryFileDoesNotExistInGeneration(
                 client_name=self._client_name,
                 genspec=gen_number,
@@ -345,6 +375,44 @@ class GAClient(object):
                 filename=filename)
         return result
 
+    def list_directory(self, gen_number, filename):
+        self._load_data()
+        generation = self._lookup_generation_by_gen_number(gen_number)
+        metadata = generation.get_file_metadata()
+        result = metadata.list_directory(filename)
+        if result is None:
+            raise obnamlib.RepositoryFileDoesNotExistInGeneration(
+                client_name=self._client_name,
+                genspec=gen_number,
+                filename=filename)
+        return result
+
+    def get_directory_metadata(self, gen_number, filename):
+        self._load_data()
+        generation = self._lookup_generation_by_gen_number(gen_number)
+        metadata = generation.get_file_metadata()
+        result = metadata.get_directory_metadata(filename)
+        if result is None:
+            raise obnamlib.RepositoryFileDoesNotExistInGeneration(
+                client_name=self._client_name,
+                genspec=gen_number,
+                filename=filename)
+        return result
+
+    def walk_generation_files(self, gen_number, filename):
+        self._load_data()
+        self._require_file_exists(gen_number, filename)
+        generation = self._lookup_generation_by_gen_number(gen_number)
+        metadata = generation.get_file_metadata()
+        return metadata.walk(filename)
+
+    def diff_generations(self, gen_number1, gen_number2, dirname):
+        self._load_data()
+        generation1 = self._lookup_generation_by_gen_number(gen_number1)
+        generation2 = self._lookup_generation_by_gen_number(gen_number2)
+        return generation1.get_file_metadata().diff(
+            generation2.get_file_metadata(), dirname)
+
     def _is_direct_child_of(self, child, parent):
         return os.path.dirname(child) == parent and child != parent
 
@@ -392,7 +460,8 @@ class GAGenerationList(object):
 
     def set_generations(self, generations):
         self._generations = generations
-        self._by_number = dict((gen.get_number, gen) for gen in generations)
+        self._by_number = dict(
+            (gen.get_number(), gen) for gen in generations)
 
 
 class GAGeneration(object):
@@ -557,6 +626,64 @@ class GAFileMetadata(object):
             return self._make_metadata(
                 lambda key: dir_obj.get_file_key(basename, key))
 
+    def walk(self, filename):
+        '''Walk files, like RepositoryInterface.walk_generation_files.
+
+        Each directory object holds the keys and chunk ids of all the
+        files in the directory, so they come from one object.
+
+        '''
+
+        if filename in self._added_files:
+            yield (
+                filename,
+                self.get_metadata_from_file_keys(filename),
+                self._added_files.get_file_chunk_ids(filename))
+            return
+
+        dir_obj, dir_path, basename = self._get_dir_obj(filename)
+        if basename == '.':
+            for x in self._walk_dir(dir_obj, dir_path):
+                yield x
+        else:
+            yield self._walk_result(dir_obj, filename, basename)
+
+    def _walk_dir(self, dir_obj, dir_path):
+        # A directory's files come first, then its sub-directories,
+        # then the directory itself. This uses an explicit stack of
+        # directories, and iterators over the sub-directories not yet
+        # walked, rather than recursion, so that deep trees don't hit
+        # the recursion limit.
+        for x in self._walk_dir_files(dir_obj, dir_path):
+            yield x
+        stack = [(dir_obj, dir_path, iter(dir_obj.get_subdir_basenames()))]
+        while stack:
+            dir_obj, dir_path, subdirs = stack[-1]
+            for basename in subdirs:
+                subdir_path = os.path.join(dir_path, basename)
+                subdir_obj = self._tree.get_directory(subdir_path)
+                if subdir_obj:
+                    for x in self._walk_dir_files(subdir_obj, subdir_path):
+                        yield x
+                    stack.append(
+                        (subdir_obj, subdir_path,
+                         iter(subdir_obj.get_subdir_basenames())))
+                    break
+            else:
+                stack.pop()
+                yield self._walk_result(dir_obj, dir_path, '.')
+
+    def _walk_dir_files(self, dir_obj, dir_path):
+        for basename in dir_obj.get_file_basenames():
+            if basename != '.':
+                pathname = os.path.join(dir_path, basename)
+                yield self._walk_result(dir_obj, pathname, basename)
+
+    def _walk_result(self, dir_obj, pathname, basename):
+        metadata = self._make_metadata(
+            lambda key: dir_obj.get_file_key(basename, key))
+        return pathname, metadata, dir_obj.get_file_chunk_ids(basename)
+
     def _make_metadata(self, get_value):
         metadata = obnamlib.Metadata()
 
@@ -577,22 +704,42 @@ class GAFileMetadata(object):
                 filename, obnamlib.REPO_FILE_MODE, file_metadata.st_mode)
             self._flush_added_file(filename)
 
+        keys = [
+            (key, getattr(file_metadata, field))
+            for key, field in obnamlib.metadata_file_key_mapping]
+        if self._file_has_keys(filename, keys):
+            return True
+
         dir_obj, basename = self._get_mutable_dir_obj(filename)
         if not dir_obj:
             return False
 
-        for key, field in obnamlib.metadata_file_key_mapping:
-            value = getattr(file_metadata, field)
+        for key, value in keys:
             dir_obj.set_file_key(basename, key, value)
 
         return True
 
+    def _file_has_keys(self, filename, keys):
+        # Setting keys to the values they already have must not copy
+        # the directory object. That way, a directory whose files have
+        # not changed keeps its object id in the next generation, and
+        # diff can skip it.
+        dir_obj, _, basename = self._get_dir_obj(filename)
+        if dir_obj is None or basename not in dir_obj.get_file_basenames():
+            return False
+        for key, value in keys:
+            if dir_obj.get_file_key(basename, key) != value:
+                return False
+        return True
+
     def set_file_key(self, filename, key, value):
         if filename in self._added_files:
             self._added_files.set_file_key(filename, key, value)
             if key == obnamlib.REPO_FILE_MODE:
                 self._flush_added_file(filename)
             return True
+        elif self._file_has_keys(filename, [(key, value)]):
+            return True
         else:
             dir_obj, basename = self._get_mutable_dir_obj(filename)
             if not dir_obj:
@@ -642,8 +789,11 @@ class GAFileMetadata(object):
             parent_obj.add_file(basename)
             for key, value in file_dict['keys'].items():
                 parent_obj.set_file_key(basename, key, value)
-            for chunk_id in file_dict['chunks']:
-                parent_obj.append_file_chunk_id(basename, chunk_id)
+            sizes = file_dict['chunk-sizes']
+            if sizes is None:
+                sizes = [None] * len(file_dict['chunks'])
+            for chunk_id, chunk_size in zip(file_dict['chunks'], sizes):
+                parent_obj.append_file_chunk_id(basename, chunk_id, chunk_size)
             self._tree.set_directory(parent_path, parent_obj)
 
         self._added_files.remove_file(filename)
@@ -660,13 +810,23 @@ class GAFileMetadata(object):
         else:
             return None
 
-    def append_file_chunk_id(self, filename, chunk_id):
+    def get_file_chunk_sizes(self, filename):
+        if filename in self._added_files:
+            return self._added_files.get_file_chunk_sizes(filename)
+
+        dir_obj, _, basename = self._get_dir_obj(filename)
+        if dir_obj and basename != '.':
+            return dir_obj.get_file_chunk_sizes(basename)
+        return None
+
+    def append_file_chunk_id(self, filename, chunk_id, chunk_size=None):
         if filename in self._added_files:
-            self._added_files.append_file_chunk_id(filename, chunk_id)
+            self._added_files.append_file_chunk_id(
+                filename, chunk_id, chunk_size)
             return True
         dir_obj, basename = self._get_mutable_dir_obj(filename)
         if dir_obj:
-            dir_obj.append_file_chunk_id(basename, chunk_id)
+            dir_obj.append_file_chunk_id(basename, chunk_id, chunk_size)
             return True
         return False
 
@@ -681,6 +841,59 @@ class GAFileMetadata(object):
             return True
         return False
 
+    def diff(self, other, dirname):
+        '''Compare with other, like RepositoryInterface.diff_generations.
+
+        Directory objects are never changed, so a directory with the
+        same object id in both generations has the same files, and
+        can be skipped without loading it. Otherwise, the keys of all
+        the files in the directory come from its directory object.
+
+        '''
+
+        stack = [dirname]
+        while stack:
+            dir_path = stack.pop()
+            dir_id = self._tree.get_directory_id(dir_path)
+            if (dir_id is not None and
+                    dir_id == other._tree.get_directory_id(dir_path)):
+                continue
+
+            dir_obj1 = self._tree.get_directory(dir_path)
+            dir_obj2 = other._tree.get_directory(dir_path)
+            old = self._list_directory(dir_obj1)
+            new = other._list_directory(dir_obj2)
+            subdirs = []
+            md5 = obnamlib.REPO_FILE_MD5
+            for basename in sorted(new):
+                pathname = os.path.join(dir_path, basename)
+                if basename not in old:
+                    yield '+', pathname
+                elif old[basename] != new[basename]:
+                    yield '*', pathname
+                elif new[basename]:
+                    subdirs.append(pathname)
+                elif (dir_obj1.get_file_key(basename, md5) !=
+                      dir_obj2.get_file_key(basename, md5)):
+                    yield '*', pathname
+            for basename in sorted(set(old) - set(new)):
+                yield '-', os.path.join(dir_path, basename)
+            stack.extend(reversed(subdirs))
+
+    def _list_directory(self, dir_obj):
+        # Return a dict that maps the basename of each file in the
+        # directory to whether it is a directory.
+        result = {}
+        if dir_obj is not None:
+            for basename in dir_obj.get_file_basenames():
+                if basename != '.':
+                    mode = dir_obj.get_file_key(
+                        basename, obnamlib.REPO_FILE_MODE)
+                    result[basename] = stat.S_ISDIR(mode or 0)
+            for basename in dir_obj.get_subdir_basenames():
+                result[basename] = True
+        return result
+
     def get_file_children(self, filename):
         assert filename not in self._added_files
         dir_obj, dirname, basename = self._get_dir_obj(filename)
@@ -692,6 +905,57 @@ class GAFileMetadata(object):
             return [os.path.join(dirname, x) for x in files + subdirs]
         return None
 
+    def list_directory(self, filename):
+        # The modes of the files in a directory are all in its
+        # directory object, and subdirectories are always directories,
+        # so this needs no other directory objects.
+        assert filename not in self._added_files
+        dir_obj, dirname, basename = self._get_dir_obj(filename)
+        if basename != '.':
+            return []
+        if dir_obj is None:
+            return None
+        result = []
+        for basename in dir_obj.get_file_basenames():
+            if basename != '.':
+                pathname = os.path.join(dirname, basename)
+                if pathname in self._added_files:
+                    mode = self._added_files.get_file_key(
+                        pathname, obnamlib.REPO_FILE_MODE)
+                else:
+                    mode = dir_obj.get_file_key(
+                        basename, obnamlib.REPO_FILE_MODE)
+                result.append((pathname, stat.S_ISDIR(mode or 0)))
+        for basename in dir_obj.get_subdir_basenames():
+            result.append((os.path.join(dirname, basename), True))
+        return result
+
+    def get_directory_metadata(self, filename):
+        # The keys of the files in a directory are all in its
+        # directory object. Those of a subdirectory are in the
+        # subdirectory's own object, as its "." entry.
+        assert filename not in self._added_files
+        dir_obj, dirname, basename = self._get_dir_obj(filename)
+        if basename != '.':
+            return []
+        if dir_obj is None:
+            return None
+        result = []
+        for basename in dir_obj.get_file_basenames():
+            if basename != '.':
+                pathname = os.path.join(dirname, basename)
+                if pathname in self._added_files:
+                    metadata = self.get_metadata_from_file_keys(pathname)
+                else:
+                    metadata = self._make_metadata(
+                        lambda key, b=basename: dir_obj.get_file_key(b, key))
+                result.append((pathname, metadata))
+        for basename in dir_obj.get_subdir_basenames():
+            pathname = os.path.join(dirname, basename)
+            result.append(
+                (pathname, self.get_metadata_from_file_keys(pathname)))
+        return result
+
 
 class AddedFiles(object):
 
@@ -719,6 +983,7 @@ class AddedFiles(object):
         self._files[filename] = {
             'keys': {},
             'chunks': [],
+            'chunk-sizes': [],
         }
 
     def remove_file(self, filename):
@@ -734,8 +999,18 @@ class AddedFiles(object):
     def get_file_chunk_ids(self, filename):
         return self._files[filename]['chunks']
 
-    def append_file_chunk_id(self, filename, chunk_id):
-        self._files[filename]['chunks'].append(chunk_id)
+    def get_file_chunk_sizes(self, filename):
+        return self._files[filename]['chunk-sizes']
+
+    def append_file_chunk_id(self, filename, chunk_id, chunk_size=None):
+        file_dict = self._files[filename]
+        file_dict['chunks'].append(chunk_id)
+        if file_dict['chunk-sizes'] is not None:
+            if chunk_size is None:
+                file_dict['chunk-sizes'] = None
+            else:
+                file_dict['chunk-sizes'].append(chunk_size)
 
     def clear_file_chunk_ids(self, filename):
         self._files[filename]['chunks'] = []
+        self._files[filename]['chunk-sizes'] = []
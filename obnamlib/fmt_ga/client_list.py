@@ -80,8 +80,8 @@ class GAClientList(object):
             assert self._data is None
         if not self._data_is_loaded:
             filename = self._get_filename()
-            if self._fs.exists(filename):
-                blob = self._fs.cat(filename)
+            blob = self._fs.cat_if_exists(filename)
+            if blob is not None:
                 self._data = obnamlib.deserialise_object(blob)
                 assert self._data is not None
             else:
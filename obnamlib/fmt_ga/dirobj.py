@@ -41,6 +41,7 @@ class GADirectory(object):
         self._require_mutable()
         self._dict['metadata'][basename] = {
             'chunk-ids': [],
+            'chunk-sizes': [],
         }
 
     def _require_mutable(self):
@@ -67,13 +68,30 @@ class GADirectory(object):
     def get_file_chunk_ids(self, basename):
         return self._dict['metadata'][basename]['chunk-ids']
 
-    def append_file_chunk_id(self, basename, chunk_id):
+    def get_file_chunk_sizes(self, basename):
+        # Directory objects written by older versions don't have chunk
+        # sizes. Neither do files for which any chunk was appended
+        # without a size. In both cases we return None.
+        file_dict = self._dict['metadata'][basename]
+        sizes = file_dict.get('chunk-sizes')
+        if sizes is None or len(sizes) != len(file_dict['chunk-ids']):
+            return None
+        return sizes
+
+    def append_file_chunk_id(self, basename, chunk_id, chunk_size=None):
         self._require_mutable()
-        self._dict['metadata'][basename]['chunk-ids'].append(chunk_id)
+        file_dict = self._dict['metadata'][basename]
+        sizes = self.get_file_chunk_sizes(basename)
+        file_dict['chunk-ids'].append(chunk_id)
+        if sizes is None or chunk_size is None:
+            file_dict['chunk-sizes'] = None
+        else:
+            sizes.append(chunk_size)
 
     def clear_file_chunk_ids(self, basename):
         self._require_mutable()
         self._dict['metadata'][basename]['chunk-ids'] = []
+        self._dict['metadata'][basename]['chunk-sizes'] = []
 
     def get_subdir_basenames(self):
         return self._dict['subdirs'].keys()
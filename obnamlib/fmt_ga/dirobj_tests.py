@@ -116,6 +116,31 @@ class GADirectoryTests(unittest.TestCase):
         dir_obj.clear_file_chunk_ids('README')
         self.assertEqual(dir_obj.get_file_chunk_ids('README'), [])
 
+    def test_stores_file_chunk_sizes(self):
+        dir_obj = obnamlib.GADirectory()
+        dir_obj.add_file('README')
+        dir_obj.append_file_chunk_id('README', 'chunk-1', 10)
+        dir_obj.append_file_chunk_id('README', 'chunk-2', 20)
+        self.assertEqual(dir_obj.get_file_chunk_sizes('README'), [10, 20])
+
+    def test_file_chunk_sizes_are_unknown_if_one_is_missing(self):
+        dir_obj = obnamlib.GADirectory()
+        dir_obj.add_file('README')
+        dir_obj.append_file_chunk_id('README', 'chunk-1')
+        dir_obj.append_file_chunk_id('README', 'chunk-2', 20)
+        self.assertEqual(dir_obj.get_file_chunk_sizes('README'), None)
+
+    def test_file_chunk_sizes_are_unknown_for_old_directory_objects(self):
+        dir_obj = obnamlib.create_gadirectory_from_dict({
+            'metadata': {
+                'README': {
+                    'chunk-ids': ['chunk-1'],
+                },
+            },
+            'subdirs': {},
+        })
+        self.assertEqual(dir_obj.get_file_chunk_sizes('README'), None)
+
     def test_raises_error_if_mutable_and_file_chunk_id_is_appended(self):
         dir_obj = obnamlib.GADirectory()
         dir_obj.add_file('README')
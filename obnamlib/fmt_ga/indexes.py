@@ -47,9 +47,12 @@ class GAChunkIndexes(object):
         self._save_data()
 
     def _save_data(self):
-        blob = obnamlib.serialise_object(self._data)
+        # The index can be very large, so we write it out piece by
+        # piece rather than serialising it into one big string.
         filename = self._get_filename()
-        self._fs.overwrite_file(filename, blob)
+        with self._fs.open_writer(filename, overwrite=True) as writer:
+            for piece in obnamlib.serialise_object_pieces(self._data):
+                writer.write(piece)
 
     def _get_filename(self):
         return os.path.join(self.get_dirname(), 'data.dat')
@@ -69,9 +72,12 @@ class GAChunkIndexes(object):
     def _load_data(self):
         if not self._data_is_loaded:
             filename = self._get_filename()
-            if self._fs.exists(filename):
-                blob = self._fs.cat(filename)
-                self._data = obnamlib.deserialise_object(blob)
+            f = self._fs.open_reader_if_exists(filename)
+            if f is not None:
+                try:
+                    self._data = obnamlib.deserialise_object_from_file(f)
+                finally:
+                    f.close()
                 assert self._data is not None
             else:
                 self._data = {}
@@ -73,6 +73,25 @@ class GATree(object):
 
         return dir_obj
 
+    def get_directory_id(self, pathname):
+        '''Return the object id of a directory.
+
+        None is returned if the directory does not exist, or if it has
+        been changed and so has no object id yet. The directory object
+        itself is not loaded.
+
+        '''
+
+        dir_obj = self._cache.get(pathname)
+        if dir_obj is not None and dir_obj.is_mutable():
+            return None
+        if pathname == '/':
+            return self._root_dir_id
+        parent_obj = self._get_containing_dir_obj(pathname)
+        if parent_obj is None:
+            return None
+        return parent_obj.get_subdir_object_id(os.path.basename(pathname))
+
     def _get_dir_obj(self, dir_id):
         blob = self._blob_store.get_blob(dir_id)
         if blob is None:  # pragma: no cover
@@ -131,7 +150,10 @@ class GATree(object):
             self.set_directory(parent_path, parent_obj)
 
     def flush(self):
-        if '/' in self._cache:
+        # Changing any directory makes its parents mutable, all the
+        # way up, so if the root has not changed, nothing has.
+        root_obj = self._cache.get('/')
+        if root_obj is not None and root_obj.is_mutable():
             self._root_dir_id = self._fixup_subdir_refs('/')
         self._blob_store.flush()
         self._cache.clear()
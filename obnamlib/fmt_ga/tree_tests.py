@@ -77,6 +77,58 @@ class GATreeTests(unittest.TestCase):
         subdir = tree3.get_directory('/foo/bar')
         self.assertIn('README', subdir.get_file_basenames())
 
+    def test_directory_has_no_id_before_flush(self):
+        self.tree.set_directory('/foo/bar', obnamlib.GADirectory())
+        self.assertEqual(self.tree.get_directory_id('/'), None)
+        self.assertEqual(self.tree.get_directory_id('/foo/bar'), None)
+
+    def test_nonexistent_directory_has_no_id(self):
+        self.tree.set_directory('/foo', obnamlib.GADirectory())
+        self.tree.flush()
+        self.assertEqual(self.tree.get_directory_id('/bar'), None)
+        self.assertEqual(self.tree.get_directory_id('/bar/baz'), None)
+
+    def test_flushed_directory_has_id(self):
+        self.tree.set_directory('/foo', obnamlib.GADirectory())
+        self.tree.flush()
+        self.assertEqual(
+            self.tree.get_directory_id('/'),
+            self.tree.get_root_directory_id())
+        self.assertNotEqual(self.tree.get_directory_id('/foo'), None)
+
+    def test_unchanged_directory_keeps_its_id(self):
+        self.tree.set_directory('/foo/bar', obnamlib.GADirectory())
+        self.tree.set_directory('/foo/baz', obnamlib.GADirectory())
+        self.tree.flush()
+
+        tree2 = obnamlib.GATree()
+        tree2.set_blob_store(self.blob_store)
+        tree2.set_root_directory_id(self.tree.get_root_directory_id())
+        new_subdir = obnamlib.GADirectory()
+        new_subdir.add_file('README')
+        tree2.set_directory('/foo/bar', new_subdir)
+        tree2.flush()
+
+        self.assertEqual(
+            tree2.get_directory_id('/foo/baz'),
+            self.tree.get_directory_id('/foo/baz'))
+        self.assertNotEqual(
+            tree2.get_directory_id('/foo/bar'),
+            self.tree.get_directory_id('/foo/bar'))
+
+    def test_flush_does_not_store_unchanged_tree_again(self):
+        self.tree.set_directory('/foo/bar', obnamlib.GADirectory())
+        self.tree.flush()
+
+        tree2 = obnamlib.GATree()
+        tree2.set_blob_store(self.blob_store)
+        tree2.set_root_directory_id(self.tree.get_root_directory_id())
+        tree2.get_directory('/foo/bar')
+        tree2.flush()
+        self.assertEqual(
+            tree2.get_root_directory_id(),
+            self.tree.get_root_directory_id())
+
     def test_removes_root_directory(self):
         dir_obj = obnamlib.GADirectory()
         self.tree.set_directory('/', dir_obj)
@@ -153,5 +205,8 @@ class DummyBagStore(object):
     def has_bag(self, bag_id):
         return bag_id in self._bags
 
+    def find_bag(self, bag_id):
+        return self._bags.get(bag_id)
+
     def get_bag(self, bag_id):
         return self._bags[bag_id]
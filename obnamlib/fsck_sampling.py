@@ -0,0 +1,64 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import math
+
+
+def stratify_generations(genids):
+    '''Group a client's generations by age, for sampling.
+
+    genids is a list of generation ids, oldest first, as returned by
+    RepositoryInterface.get_client_generation_ids. Return a list of
+    lists of generation ids, newest group first. The newest
+    generation is a group of its own, as is the one before it, then
+    the next two, the next four, and so on, doubling each time. This
+    way, sampling an equal number of files from each group checks
+    recent backups the most, but still reaches back to the oldest.
+
+    '''
+
+    newest_first = list(reversed(genids))
+    groups = []
+    start = 0
+    size = 1
+    while start < len(newest_first):
+        groups.append(newest_first[start:start + size])
+        start += size
+        if start > 1:
+            size *= 2
+    return groups
+
+
+def wilson_upper_bound(failures, samples, z=1.96):
+    '''Return upper end of a confidence interval for a failure rate.
+
+    Given that failures of samples random samples failed, return the
+    largest failure rate, between 0 and 1, for the whole population
+    that is consistent with the samples, using the Wilson score
+    interval. The default z gives a 95% confidence interval.
+
+    '''
+
+    if samples == 0:
+        return 1.0
+    n = float(samples)
+    p = failures / n
+    z2 = z * z
+    centre = p + z2 / (2 * n)
+    margin = z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n))
+    return min(1.0, (centre + margin) / (1 + z2 / n))
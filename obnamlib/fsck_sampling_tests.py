@@ -0,0 +1,61 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import unittest
+
+import obnamlib
+
+
+class StratifyGenerationsTests(unittest.TestCase):
+
+    def test_returns_nothing_for_no_generations(self):
+        self.assertEqual(obnamlib.stratify_generations([]), [])
+
+    def test_returns_single_generation_as_group(self):
+        self.assertEqual(obnamlib.stratify_generations([1]), [[1]])
+
+    def test_doubles_group_size_going_back_in_time(self):
+        self.assertEqual(
+            obnamlib.stratify_generations(range(1, 12)),
+            [[11], [10], [9, 8], [7, 6, 5, 4], [3, 2, 1]])
+
+    def test_includes_every_generation_once(self):
+        genids = range(100)
+        groups = obnamlib.stratify_generations(genids)
+        self.assertEqual(sorted(sum(groups, [])), genids)
+
+
+class WilsonUpperBoundTests(unittest.TestCase):
+
+    def test_knows_nothing_without_samples(self):
+        self.assertEqual(obnamlib.wilson_upper_bound(0, 0), 1.0)
+
+    def test_is_about_four_over_n_for_no_failures(self):
+        bound = obnamlib.wilson_upper_bound(0, 1000)
+        self.assertTrue(0.0038 < bound < 0.0039)
+
+    def test_is_above_observed_rate(self):
+        self.assertTrue(obnamlib.wilson_upper_bound(10, 100) > 0.1)
+
+    def test_shrinks_with_more_samples(self):
+        self.assertTrue(
+            obnamlib.wilson_upper_bound(1, 1000) <
+            obnamlib.wilson_upper_bound(1, 100))
+
+    def test_is_one_when_all_fail(self):
+        self.assertAlmostEqual(obnamlib.wilson_upper_bound(10, 10), 1.0)
@@ -0,0 +1,120 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import hashlib
+import os
+import tempfile
+import time
+
+import obnamlib
+
+
+class FsckState(object):
+
+    '''Remember what fsck has verified, from one run to the next.
+
+    Finished generations never change, and neither do chunks, so once
+    fsck has verified something, a later run can skip it. The state
+    is a local file, with a timestamp for each generation, file
+    content, and chunk that has been verified, each kind in a
+    separate namespace. Keys are strings or integers.
+
+    Verified things should still be re-checked now and then, in case
+    the storage has gone bad since. Each run has a slice of all keys
+    that are due to be re-checked: a key is in the slice of every
+    cycle'th run, chosen by a hash of the key, so that after cycle
+    runs every key has been due once. is_verified returns false for
+    keys that are due. If a key that is due does not get marked as
+    verified again during the run, it is dropped from the state: it
+    has either failed, or is no longer in the repository.
+
+    Changes are kept in memory until save is called. mark_verified
+    may be called from several threads at once.
+
+    '''
+
+    kinds = ('generations', 'contents', 'chunks')
+
+    def __init__(self, filename, cycle, current_time=time.time):
+        self.filename = filename
+        self._cycle = max(1, cycle)
+        self._current_time = current_time
+        self._load()
+
+    def _load(self):
+        self.run = 0
+        self._verified = dict((kind, {}) for kind in self.kinds)
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                data = obnamlib.deserialise_object(f.read())
+            self.run = data['run'] + 1
+            for kind in self.kinds:
+                self._verified[kind] = dict(
+                    (key, timestamp) for key, timestamp in data[kind])
+        self._new = dict((kind, set()) for kind in self.kinds)
+
+    def is_due(self, key):
+        '''Is key due for re-checking in this run?'''
+        digest = hashlib.md5(str(key)).hexdigest()
+        return int(digest[:8], 16) % self._cycle == self.run % self._cycle
+
+    def is_verified(self, kind, key):
+        '''Has key been verified, and is not due for re-checking?'''
+        return key in self._verified[kind] and not self.is_due(key)
+
+    def get_verification_time(self, kind, key):
+        '''Return time key was last verified, or None if never.'''
+        return self._verified[kind].get(key)
+
+    def mark_verified(self, kind, key):
+        '''Remember that key has been verified in this run.'''
+        self._new[kind].add(key)
+
+    def forget_verified(self, kind):
+        '''Forget everything of a kind marked verified in this run.'''
+        self._new[kind] = set()
+
+    def save(self):
+        '''Write the state to the file.'''
+
+        # Keys may be integers, so each kind is stored as a list of
+        # pairs, rather than a dict.
+        now = int(self._current_time())
+        verified = {}
+        data = {'run': self.run}
+        for kind in self.kinds:
+            verified[kind] = dict(
+                (key, timestamp)
+                for key, timestamp in self._verified[kind].iteritems()
+                if not self.is_due(key))
+            for key in self._new[kind]:
+                verified[kind][key] = now
+            data[kind] = [
+                [key, timestamp]
+                for key, timestamp in verified[kind].iteritems()]
+
+        dirname = os.path.dirname(self.filename) or '.'
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, obnamlib.NEW_DIR_MODE)
+        fd, tempname = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(obnamlib.serialise_object(data))
+        os.rename(tempname, self.filename)
+
+        self._verified = verified
+        self._new = dict((kind, set()) for kind in self.kinds)
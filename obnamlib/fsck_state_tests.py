@@ -0,0 +1,139 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class FsckStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'state', 'repo')
+        self.now = 1000
+        self.state = self.new_state()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_state(self, cycle=3):
+        return obnamlib.FsckState(
+            self.filename, cycle, current_time=lambda: self.now)
+
+    def find_key(self, state, due):
+        for i in range(1000):
+            key = 'key-%d' % i
+            if state.is_due(key) == due:
+                return key
+
+    def test_nothing_is_verified_initially(self):
+        self.assertEqual(self.state.run, 0)
+        self.assertFalse(self.state.is_verified('chunks', 1))
+        self.assertEqual(self.state.get_verification_time('chunks', 1), None)
+
+    def test_marking_does_not_take_effect_before_save(self):
+        key = self.find_key(self.state, False)
+        self.state.mark_verified('chunks', key)
+        self.assertFalse(self.state.is_verified('chunks', key))
+
+    def test_remembers_verified_key_with_time(self):
+        key = self.find_key(self.state, False)
+        self.state.mark_verified('chunks', key)
+        self.state.save()
+        self.assertTrue(self.state.is_verified('chunks', key))
+        self.assertEqual(self.state.get_verification_time('chunks', key), 1000)
+
+    def test_kinds_are_separate(self):
+        key = self.find_key(self.state, False)
+        self.state.mark_verified('chunks', key)
+        self.state.save()
+        self.assertFalse(self.state.is_verified('contents', key))
+
+    def test_next_run_sees_saved_state(self):
+        self.state.mark_verified('generations', 'gen')
+        self.state.mark_verified('chunks', 123)
+        self.state.save()
+        state = self.new_state()
+        self.assertEqual(state.run, 1)
+        self.assertEqual(
+            state.get_verification_time('generations', 'gen'), 1000)
+        self.assertEqual(state.get_verification_time('chunks', 123), 1000)
+
+    def test_forgets_marks_of_one_kind(self):
+        self.state.mark_verified('generations', 'gen')
+        self.state.mark_verified('chunks', 123)
+        self.state.forget_verified('generations')
+        self.state.save()
+        self.assertEqual(
+            self.state.get_verification_time('generations', 'gen'), None)
+        self.assertEqual(
+            self.state.get_verification_time('chunks', 123), 1000)
+
+    def test_every_key_is_due_once_per_cycle(self):
+        keys = ['key-%d' % i for i in range(100)]
+        due = []
+        for i in range(3):
+            state = self.new_state()
+            due.extend(key for key in keys if state.is_due(key))
+            state.save()
+        self.assertEqual(sorted(due), sorted(keys))
+
+    def test_key_that_is_due_is_not_verified(self):
+        key = self.find_key(self.state, True)
+        self.state.mark_verified('chunks', key)
+        self.state.save()
+        self.assertFalse(self.state.is_verified('chunks', key))
+
+    def test_updates_time_of_key_verified_again(self):
+        self.state.mark_verified('chunks', 123)
+        self.state.save()
+        self.now = 2000
+        state = self.new_state()
+        state.mark_verified('chunks', 123)
+        state.save()
+        self.assertEqual(state.get_verification_time('chunks', 123), 2000)
+
+    def test_drops_key_that_is_due_but_not_verified_again(self):
+        key = self.find_key(self.state, True)
+        other = self.find_key(self.state, False)
+        self.state.mark_verified('chunks', key)
+        self.state.mark_verified('chunks', other)
+        self.state.save()
+        state = self.new_state(cycle=1)
+        state.save()
+        self.assertEqual(state.get_verification_time('chunks', key), None)
+        self.assertEqual(state.get_verification_time('chunks', other), None)
+
+    def test_keeps_keys_that_are_not_due_without_verifying_again(self):
+        keys = ['key-%d' % i for i in range(100)]
+        for key in keys:
+            self.state.mark_verified('chunks', key)
+        self.state.save()
+        state = self.new_state()
+        state.save()
+        for key in keys:
+            if state.is_due(key):
+                self.assertEqual(
+                    state.get_verification_time('chunks', key), None)
+            else:
+                self.assertEqual(
+                    state.get_verification_time('chunks', key), 1000)
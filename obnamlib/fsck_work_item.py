@@ -27,8 +27,18 @@ class WorkItem(larch.fsck.WorkItem):
     that other modules (specifically, repository interface
     implementations) can provide work items.
 
+    A work item with parallel set to true may be run in a worker
+    thread, with a repository object of its own as repo, while other
+    work items run. It must not yield further work items, and it
+    must not use chunkids_seen.
+
+    fsck_state is an obnamlib.FsckState, or None if fsck is not
+    remembering what it has verified.
+
     '''
 
     repo = None
     chunkids_seen = None
     settings = None
+    fsck_state = None
+    parallel = False
@@ -26,6 +26,8 @@ application) will register callbacks.
 '''
 
 
+import itertools
+
 import tracing
 
 import obnamlib
@@ -144,6 +146,81 @@ class FilterHook(Hook):
         tracing.trace('done')
         return data
 
+    def run_filter_read_stream(self, pieces, *args, **kwargs):
+        '''Like run_filter_read, but for data given as pieces.
+
+        pieces is an iterable of strings, and the filtered data is
+        returned as an iterator of strings, so that the whole data
+        never needs to be in memory at once. Filters with a
+        filter_read_stream method are given an iterator of pieces,
+        and return one. Other filters get all the data at once, via
+        their filter_read method.
+
+        '''
+
+        pieces = iter(pieces)
+        while True:
+            tag, pieces = self._split_tag(pieces)
+            if tag == '':
+                for piece in pieces:
+                    yield piece
+                return
+            if tag not in self.bytag:
+                raise MissingFilterError(tagname=repr(tag))
+            callback = self.bytag[tag]
+            if hasattr(callback, 'filter_read_stream'):
+                pieces = iter(
+                    callback.filter_read_stream(pieces, *args, **kwargs))
+            else:
+                data = callback.filter_read(''.join(pieces), *args, **kwargs)
+                pieces = iter([data])
+
+    def _split_tag(self, pieces):
+        # Return the tag at the start of the data in pieces, and an
+        # iterator for the rest of the data.
+        prefix = ''
+        for piece in pieces:
+            prefix += piece
+            if '\0' in prefix:
+                tag, remaining = prefix.split('\0', 1)
+                return tag, itertools.chain([remaining], pieces)
+        raise NoFilterTagError()
+
+    def run_filter_write_stream(self, pieces, *args, **kwargs):
+        '''Like run_filter_write, but for data given as pieces.
+
+        See run_filter_read_stream for what pieces are. A filter with
+        a filter_write_stream method is given an iterator of pieces,
+        and returns a tuple (changed, pieces), where changed says
+        whether the filter changed the data at all, and pieces is an
+        iterable of the resulting data. If changed is False, pieces
+        must give the original data. Other filters get all the data at
+        once, via their filter_write method.
+
+        '''
+
+        tracing.trace('called')
+        pieces = itertools.chain(['\0'], pieces)
+        for filt in self.callbacks:
+            tracing.trace('calling %s' % filt)
+            if hasattr(filt, 'filter_write_stream'):
+                changed, new_pieces = filt.filter_write_stream(
+                    pieces, *args, **kwargs)
+            else:
+                data = ''.join(pieces)
+                new_data = filt.filter_write(data, *args, **kwargs)
+                assert new_data is not None, \
+                    filt.tag + ": Returned None from filter_write()"
+                changed = data != new_data
+                new_pieces = [new_data]
+            if changed:
+                tracing.trace('filt.tag=%s' % filt.tag)
+                pieces = itertools.chain([filt.tag, '\0'], new_pieces)
+            else:
+                pieces = iter(new_pieces)
+        tracing.trace('done')
+        return pieces
+
 
 class HookManager(object):
 
@@ -193,3 +270,11 @@ class HookManager(object):
     def filter_write(self, name, *args, **kwargs):
         '''Run writer filter for named filter, using given arguments.'''
         return self.filters[name].run_filter_write(*args, **kwargs)
+
+    def filter_read_stream(self, name, *args, **kwargs):
+        '''Run streaming reader filter for named filter.'''
+        return self.filters[name].run_filter_read_stream(*args, **kwargs)
+
+    def filter_write_stream(self, name, *args, **kwargs):
+        '''Run streaming writer filter for named filter.'''
+        return self.filters[name].run_filter_write_stream(*args, **kwargs)
@@ -108,6 +108,24 @@ class Base64Filter(object):
         return base64.b64encode(data)
 
 
+class StreamingReverseFilter(object):
+
+    def __init__(self):
+        self.tag = "reverse"
+
+    def filter_read(self, data, *args, **kwargs):
+        return data[::-1]
+
+    def filter_write(self, data, *args, **kwargs):
+        return data[::-1]
+
+    def filter_read_stream(self, pieces, *args, **kwargs):
+        return [''.join(pieces)[::-1]]
+
+    def filter_write_stream(self, pieces, *args, **kwargs):
+        return True, [''.join(pieces)[::-1]]
+
+
 class FilterHookTests(unittest.TestCase):
 
     def setUp(self):
@@ -150,6 +168,42 @@ class FilterHookTests(unittest.TestCase):
     def test_call_callbacks_raises(self):
         self.assertRaises(NotImplementedError, self.hook.call_callbacks, "")
 
+    def test_streaming_write_without_filters_adds_empty_tag(self):
+        pieces = self.hook.run_filter_write_stream(['fo', 'o'])
+        self.assertEqual(''.join(pieces), '\0foo')
+
+    def test_streaming_write_uses_non_streaming_filter(self):
+        self.hook.add_callback(Base64Filter())
+        pieces = self.hook.run_filter_write_stream(['O', 'K'])
+        self.assertEqual(''.join(pieces), 'base64\0AE9L')
+
+    def test_streaming_write_uses_streaming_filter(self):
+        self.hook.add_callback(StreamingReverseFilter())
+        pieces = self.hook.run_filter_write_stream(['ab', 'c'])
+        self.assertEqual(''.join(pieces), 'reverse\0cba\0')
+
+    def test_streaming_read_handles_tag_split_across_pieces(self):
+        self.hook.add_callback(Base64Filter())
+        pieces = self.hook.run_filter_read_stream(['bas', 'e64', '\0AE', '9L'])
+        self.assertEqual(''.join(pieces), 'OK')
+
+    def test_streaming_read_uses_streaming_filter(self):
+        self.hook.add_callback(StreamingReverseFilter())
+        pieces = self.hook.run_filter_read_stream(['reverse\0cba', '\0'])
+        self.assertEqual(''.join(pieces), 'abc')
+
+    def test_streaming_roundtrip_with_two_filters(self):
+        self.hook.add_callback(Base64Filter())
+        self.hook.add_callback(StreamingReverseFilter())
+        written = ''.join(self.hook.run_filter_write_stream(['hello']))
+        self.assertEqual(written, self.hook.run_filter_write('hello'))
+        pieces = self.hook.run_filter_read_stream([written])
+        self.assertEqual(''.join(pieces), 'hello')
+
+    def test_streaming_read_without_tag_raises_error(self):
+        pieces = self.hook.run_filter_read_stream(['no NUL', ' bytes'])
+        self.assertRaises(obnamlib.NoFilterTagError, list, pieces)
+
 
 class HookManagerTests(unittest.TestCase):
 
@@ -43,14 +43,14 @@ class LockManager(object):
     def get_lock_name(self, dirname):
         return os.path.join(dirname, 'lock')
 
-    def _lock_one(self, dirname):
+    def _lock_one(self, dirname, timeout):
         started = self._time()
         while True:
             lock_name = self.get_lock_name(dirname)
             try:
                 self._fs.lock(lock_name)
             except obnamlib.LockFail:
-                if self._time() - started >= self.timeout:
+                if self._time() - started >= timeout:
                     raise obnamlib.LockFail(
                         lock_name=lock_name,
                         reason='timeout')
@@ -77,12 +77,21 @@ class LockManager(object):
         '''Does this lock manager hold the lock for a directory?'''
         return dirname in self._got_locks
 
-    def lock(self, dirnames):
-        '''Lock ALL the directories.'''
+    def lock(self, dirnames, timeout=None):
+        '''Lock ALL the directories.
+
+        If timeout is given, it is used instead of the lock manager's
+        own timeout. A timeout of zero means giving up right away if
+        any of the directories is already locked.
+
+        '''
+
+        if timeout is None:
+            timeout = self.timeout
         we_locked = []
         for dirname in self.sort(dirnames):
             try:
-                self._lock_one(dirname)
+                self._lock_one(dirname, timeout)
             except obnamlib.LockFail:
                 self.unlock(we_locked)
                 raise
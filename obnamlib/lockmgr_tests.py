@@ -70,6 +70,12 @@ class LockManagerTests(unittest.TestCase):
                           self.lm.lock, [self.dirnames[0]])
         self.assertTrue(self.now >= self.timeout)
 
+    def test_gives_up_at_once_with_zero_timeout(self):
+        self.lm.lock([self.dirnames[0]])
+        self.assertRaises(obnamlib.LockFail,
+                          self.lm.lock, [self.dirnames[0]], timeout=0)
+        self.assertTrue(self.now < self.timeout)
+
     def test_notices_when_preexisting_lock_goes_away(self):
         self.lm.lock([self.dirnames[0]])
         self.lm._sleep = lambda: os.remove(
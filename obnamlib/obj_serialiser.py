@@ -52,6 +52,33 @@ def deserialise_object(serialised):
     return func(value)
 
 
+def serialise_object_pieces(obj):
+    '''Serialise obj into a list of strings.
+
+    Joining the strings gives the same result as serialise_object, but
+    large objects don't need to be copied into one big string, which
+    saves a lot of memory when the pieces are written out one by one.
+
+    '''
+
+    pieces = []
+    _serialise_pieces(obj, pieces)
+    return pieces
+
+
+def deserialise_object_from_file(f):
+    '''De-serialise an object by reading it from a file-like object.
+
+    This reads the serialised form piece by piece, and never needs to
+    have all of it in memory at once. EOFError is raised if the file
+    ends before the object does.
+
+    '''
+
+    obj, _ = _read_object(f)
+    return obj
+
+
 # The length of a value.
 
 _length_fmt = '!Q'
@@ -168,6 +195,79 @@ def _deserialise_prefix(serialised, pos):
     return deserialise_object(serialised[pos:end]), end
 
 
+# Serialising into pieces, and de-serialising from files.
+
+def _serialise_pieces(obj, pieces):
+    # Append the serialised form of obj to pieces, and return its
+    # length.
+    if type(obj) is list:
+        return _serialise_container_pieces(_LIST, obj, pieces)
+    elif type(obj) is dict:
+        return _serialise_container_pieces(_DICT, obj.iteritems(), pieces)
+    elif type(obj) is str:
+        pieces.append(_STR + _serialise_length(len(obj)))
+        pieces.append(obj)
+        return 1 + _length_size + len(obj)
+    else:
+        serialised = serialise_object(obj)
+        pieces.append(serialised)
+        return len(serialised)
+
+
+def _serialise_container_pieces(type_byte, items, pieces):
+    header_index = len(pieces)
+    pieces.append(None)
+    length = 0
+    for item in items:
+        if type_byte == _DICT:
+            key, value = item
+            length += _serialise_pieces(key, pieces)
+            length += _serialise_pieces(value, pieces)
+        else:
+            length += _serialise_pieces(item, pieces)
+    pieces[header_index] = type_byte + _serialise_length(length)
+    return 1 + _length_size + length
+
+
+def _read_exactly(f, num_bytes):
+    parts = []
+    remaining = num_bytes
+    while remaining > 0:
+        data = f.read(remaining)
+        if not data:
+            raise EOFError()
+        parts.append(data)
+        remaining -= len(data)
+    return ''.join(parts)
+
+
+def _read_object(f):
+    # Read one serialised object from f, and return it and the size of
+    # its serialised form.
+    header = _read_exactly(f, 1 + _length_size)
+    type_byte = header[0]
+    length = _deserialise_length(header[1:])
+    if type_byte == _LIST:
+        obj = []
+        pos = 0
+        while pos < length:
+            item, size = _read_object(f)
+            obj.append(item)
+            pos += size
+    elif type_byte == _DICT:
+        obj = {}
+        pos = 0
+        while pos < length:
+            key, key_size = _read_object(f)
+            value, value_size = _read_object(f)
+            obj[key] = value
+            pos += key_size + value_size
+    else:
+        func = _deserialisers[type_byte]
+        obj = func(_read_exactly(f, length))
+    return obj, 1 + _length_size + length
+
+
 # A lookup table for serialisation functions for each type.
 
 _serialisers = {
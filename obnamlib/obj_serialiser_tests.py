@@ -16,6 +16,7 @@
 # =*= License: GPL-3+ =*=
 
 
+import StringIO
 import unittest
 
 import obnamlib
@@ -75,3 +76,41 @@ class ObjectSerialisationRoundtripTests(unittest.TestCase):
         }
         blob = obnamlib.serialise_object(obj)
         self.assertEqual(obnamlib.deserialise_object(blob), obj)
+
+
+class StreamingSerialisationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = {
+            'zero': 0,
+            'none': None,
+            'string': 'abc\0def',
+            'list': ['foo', [], {}],
+            'dict': {
+                'one': 1,
+                'false': False,
+            },
+        }
+
+    def test_pieces_join_to_serialised_object(self):
+        pieces = obnamlib.serialise_object_pieces(self.obj)
+        self.assertEqual(
+            ''.join(pieces), obnamlib.serialise_object(self.obj))
+
+    def test_deserialises_from_file(self):
+        blob = obnamlib.serialise_object(self.obj)
+        f = StringIO.StringIO(blob)
+        self.assertEqual(
+            obnamlib.deserialise_object_from_file(f), self.obj)
+        self.assertEqual(f.read(), '')
+
+    def test_raises_eoferror_for_truncated_file(self):
+        blob = obnamlib.serialise_object(self.obj)
+        f = StringIO.StringIO(blob[:-1])
+        self.assertRaises(
+            EOFError, obnamlib.deserialise_object_from_file, f)
+
+    def test_raises_eoferror_for_empty_file(self):
+        f = StringIO.StringIO('')
+        self.assertRaises(
+            EOFError, obnamlib.deserialise_object_from_file, f)
@@ -233,9 +233,12 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         self.repo.lock_client(self.client_name)
 
         # Need to lock the shared stuff briefly, so encryption etc
-        # gets initialized.
+        # gets initialized, and so that a concurrent forget knows we're
+        # about to re-use chunks we find in the chunk indexes.
         self.progress.what('initialising shared directories')
         self.repo.lock_chunk_indexes()
+        self.repo.register_backup(self.client_name)
+        self.repo.commit_chunk_indexes()
         self.repo.unlock_chunk_indexes()
 
     def start_generation(self):
@@ -245,12 +248,6 @@ class BackupPlugin(obnamlib.ObnamPlugin):
     def finish_generation(self):
         prefix = 'committing changes to repository: '
 
-        self.progress.what(prefix + 'locking shared B-trees')
-        self.repo.lock_chunk_indexes()
-
-        self.progress.what(prefix + 'adding chunks to shared B-trees')
-        self.add_chunks_to_shared()
-
         self.progress.what(prefix + 'updating generation metadata')
         self.repo.set_generation_key(
             self.new_generation,
@@ -265,15 +262,15 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             obnamlib.REPO_GENERATION_IS_CHECKPOINT,
             False)
 
-        self.progress.what(prefix + 'committing client')
         self.repo.flush_chunks()
+
+        self.progress.what(prefix + 'adding chunks to shared B-trees')
+        self.add_chunks_to_shared()
+
+        self.progress.what(prefix + 'committing client')
         self.repo.commit_client(self.client_name)
         self.repo.unlock_client(self.client_name)
 
-        self.progress.what(prefix + 'committing shared B-trees')
-        self.repo.commit_chunk_indexes()
-        self.repo.unlock_chunk_indexes()
-
     def should_remove_checkpoints(self):
         return (not self.progress.errors and
                 not self.app.settings['leave-checkpoints'])
@@ -282,24 +279,25 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         prefix = 'removing checkpoints'
         self.progress.what(prefix)
 
-        self.repo.lock_everything()
+        self.repo.lock_client(self.client_name)
+        self.repo.lock_chunk_indexes()
 
         for gen in self.checkpoint_manager.checkpoints:
             self.progress.update_progress_with_removed_checkpoint(gen)
-            self.repo.remove_generation(gen)
+        self.repo.remove_generations(self.checkpoint_manager.checkpoints)
 
         self.progress.what(prefix + ': committing client')
         self.repo.commit_client(self.client_name)
-        self.repo.unlock_client(self.client_name)
 
         self.progress.what(prefix + ': commiting shared B-trees')
         self.repo.commit_chunk_indexes()
-        self.repo.unlock_chunk_indexes()
 
+        # Unlocking forgets which chunks are unused, so they need to
+        # be removed first.
         self.progress.what(prefix + ': removing unused chunks')
         self.repo.remove_unused_chunks()
-
-        self.repo.unlock_everything()
+        self.repo.unlock_client(self.client_name)
+        self.repo.unlock_chunk_indexes()
 
     def finish_backup(self, args):
         self.progress.what('closing connection to repository')
@@ -338,8 +336,11 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             logging.info('Successfully unlocked')
 
     def add_chunks_to_shared(self):
-        for chunkid, token in self.chunkid_token_map:
-            self.repo.put_chunk_into_indexes(chunkid, token, self.client_name)
+        # This only needs the client lock: the repository may put the
+        # chunks into the shared B-trees later, so that clients backing
+        # up at the same time don't queue up on the shared lock.
+        self.repo.queue_chunks_for_indexes(
+            list(self.chunkid_token_map), self.client_name)
         self.chunkid_token_map.clear()
 
     def add_client(self, client_name):
@@ -517,9 +518,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             self.progress.what('making checkpoint: backing up parents')
             self.backup_parents('.')
 
-            self.progress.what('making checkpoint: locking shared B-trees')
-            self.repo.lock_chunk_indexes()
-
+            self.repo.flush_chunks()
             self.progress.what(
                 'making checkpoint: adding chunks to shared B-trees')
             self.add_chunks_to_shared()
@@ -529,13 +528,8 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             self.repo.set_generation_key(
                 self.new_generation,
                 obnamlib.REPO_GENERATION_IS_CHECKPOINT, 1)
-            self.repo.flush_chunks()
             self.repo.commit_client(self.client_name)
             self.repo.unlock_client(self.client_name)
-
-            self.progress.what('making checkpoint: committing shared B-trees')
-            self.repo.commit_chunk_indexes()
-            self.repo.unlock_chunk_indexes()
             self.last_checkpoint = self.repo.get_fs().bytes_written
 
             self.progress.what('making checkpoint: re-opening repository')
@@ -743,7 +737,8 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             if not self.pretend:
                 chunk_id = self.backup_file_chunk(data)
                 self.repo.append_file_chunk_id(
-                    self.new_generation, filename, chunk_id)
+                    self.new_generation, filename, chunk_id,
+                    chunk_size=len(data))
             else:
                 self.progress.update_progress_with_upload(len(data))
 
@@ -29,26 +29,64 @@ class DeflateCompressionFilter(object):
     def filter_read(self, data, repo, toplevel):
         return zlib.decompress(data)
 
-    def filter_write(self, data, repo, toplevel):
+    def filter_read_stream(self, pieces, repo, toplevel):
+        decompressor = zlib.decompressobj()
+        for piece in pieces:
+            data = decompressor.decompress(piece)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def _want_compression(self):
         how = self.app.settings['compress-with']
-        compressed = None
-        if how == 'deflate':
-            compressed = zlib.compress(data)
-        elif how == 'gzip':
-            if not self.warned:
-                self.app.ts.notify("--compress-with=gzip is deprecated.  " +
-                                   "Use --compress-with=deflate instead")
-                self.warned = True
-            compressed = zlib.compress(data)
+        if how == 'gzip' and not self.warned:
+            self.app.ts.notify("--compress-with=gzip is deprecated.  " +
+                               "Use --compress-with=deflate instead")
+            self.warned = True
+        return how in ('deflate', 'gzip')
 
+    def _worth_it(self, compressed_size, original_size):
         # If the compression result, the tag and the separator byte taken
         # together are longer than the uncompressed input, let's store the
         # uncompressed data to avoid waste upon transfer, storage and read.
-        if compressed and len(compressed) + len(self.tag) + 1 < len(data):
-            return compressed
+        return compressed_size + len(self.tag) + 1 < original_size
 
+    def filter_write(self, data, repo, toplevel):
+        if self._want_compression():
+            compressed = zlib.compress(data)
+            if compressed and self._worth_it(len(compressed), len(data)):
+                return compressed
         return data
 
+    def filter_write_stream(self, pieces, repo, toplevel):
+        if not self._want_compression():
+            return False, pieces
+
+        # We can only tell whether compression was worth it at the end,
+        # so we keep the original pieces around until then. They're
+        # kept as they are, not joined, so this costs no copies.
+        compressor = zlib.compressobj()
+        originals = []
+        original_size = 0
+        compressed = []
+        compressed_size = 0
+        for piece in pieces:
+            originals.append(piece)
+            original_size += len(piece)
+            data = compressor.compress(piece)
+            if data:
+                compressed.append(data)
+                compressed_size += len(data)
+        data = compressor.flush()
+        compressed.append(data)
+        compressed_size += len(data)
+
+        if self._worth_it(compressed_size, original_size):
+            return True, compressed
+        return False, originals
+
 
 class CompressionPlugin(obnamlib.ObnamPlugin):
 
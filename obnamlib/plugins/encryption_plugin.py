@@ -148,6 +148,18 @@ class EncryptionPlugin(obnamlib.ObnamPlugin):
         return obnamlib.encrypt_symmetric(cleartext, symmetric_key,
                                           gpghome=self.gnupghome)
 
+    def filter_read_stream(self, pieces, repo, toplevel):
+        symmetric_key = self.get_symmetric_key(repo, toplevel)
+        return obnamlib.decrypt_symmetric_stream(
+            pieces, symmetric_key, gpghome=self.gnupghome)
+
+    def filter_write_stream(self, pieces, repo, toplevel):
+        if not self.keyid:
+            return False, pieces
+        symmetric_key = self.get_symmetric_key(repo, toplevel)
+        return True, obnamlib.encrypt_symmetric_stream(
+            pieces, symmetric_key, gpghome=self.gnupghome)
+
     def get_symmetric_key(self, repo, toplevel):
         key = self._symkeys.get(repo, toplevel)
         if key is None:
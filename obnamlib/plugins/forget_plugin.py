@@ -15,6 +15,7 @@
 
 
 import datetime
+import time
 
 import obnamlib
 
@@ -31,6 +32,17 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
             'policy for what generations to keep '
             'when forgetting')
 
+        perf_group = obnamlib.option_group['perf']
+        self.app.settings.integer(
+            ['forget-checkpoint'],
+            'when forgetting generations, commit the removals done so '
+            'far after SECONDS have passed since the previous commit; '
+            'by default (0), all generations are removed together and '
+            'committed once, at the end',
+            metavar='SECONDS',
+            default=0,
+            group=perf_group)
+
     def forget(self, args):
         '''Forget (remove) specified backup generations.'''
         self.app.settings.require('repository')
@@ -40,10 +52,9 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
 
         self.repo = self.app.get_repository_object()
 
-        # We lock everything. This is to avoid a race condition
-        # between different clients doing backup and forget at the
-        # same time. If we only lock the client we care about, plus
-        # the chunk indexes, the following scenario is possible:
+        # We only lock the client we care about, plus the chunk
+        # indexes, so that other clients can keep doing backups while
+        # we run. That opens up a race condition:
         #
         #       1. Client A locks itself, plus chunk indexes, and
         #          starts running forget, but slowly.
@@ -58,22 +69,18 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
         #       4. A commits its changes.
         #       5. B gains lock to chunk indexes, and commits its changes.
         #
-        # At this point, the chunk indexes indicate that B uses some chunks,
-        # but A already removed the chunks.
-        #
-        # By locking all clients during a forget, we prevent this race
-        # condition: nobody else can be running a backup while anyone is
-        # running a forget. We also lock the client list to prevent a new
-        # client from being added.
-        #
-        # This is not a great solution, as it means that during a
-        # forget (which currently can be quite slow) nobody can do a
-        # backup. However, correctness trumps speed.
+        # The repository prevents this by not removing chunks right
+        # away in step 3. Backups register themselves when they start,
+        # and the chunks are only removed by a later forget, once all
+        # backups that might be using them have finished. A backup that
+        # does use them keeps them. See RepositoryInterface's
+        # register_backup.
 
-        self.repo.lock_everything()
+        client_name = self.app.settings['client-name']
+        self.repo.lock_client(client_name)
+        self.repo.lock_chunk_indexes()
 
         self.app.dump_memory_profile('at beginning')
-        client_name = self.app.settings['client-name']
         if args:
             removeids = self.get_genids_to_remove_from_args(client_name, args)
         elif self.app.settings['keep']:
@@ -83,21 +90,22 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
             removeids = []
 
         self.app.ts['gens'] = removeids
-        for genid in removeids:
-            self.app.ts['gen'] = genid
-            self.remove(genid)
-            self.repo.commit_client(client_name)
-            self.repo.commit_chunk_indexes()
-            self.repo.remove_unused_chunks()
+        checkpoint_interval = self.app.settings['forget-checkpoint']
+        if checkpoint_interval > 0:
+            self.remove_with_checkpoints(
+                client_name, removeids, checkpoint_interval)
+        elif removeids:
+            self.app.ts['gen'] = removeids[-1]
+            self.remove(removeids)
             self.app.dump_memory_profile(
-                'after removing %s' %
-                self.repo.make_generation_spec(genid))
+                'after removing %d generations' % len(removeids))
 
-        # Commit or unlock everything.
+        # Commit and unlock.
         self.repo.commit_client(client_name)
         self.repo.commit_chunk_indexes()
-        self.repo.unlock_everything()
         self.repo.remove_unused_chunks()
+        self.repo.unlock_client(client_name)
+        self.repo.unlock_chunk_indexes()
         self.app.dump_memory_profile('after committing')
 
         self.repo.close()
@@ -116,9 +124,10 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
     def get_all_generations(self, client_name):
         genlist = []
         dt = datetime.datetime(1970, 1, 1, 0, 0, 0)
-        for genid in self.repo.get_client_generation_ids(client_name):
-            end = self.repo.get_generation_key(
-                genid, obnamlib.REPO_GENERATION_ENDED)
+        summaries = self.repo.get_client_generation_summaries(
+            client_name, [obnamlib.REPO_GENERATION_ENDED])
+        for genid, keys in summaries:
+            end = keys[obnamlib.REPO_GENERATION_ENDED]
             genlist.append((genid, dt.fromtimestamp(end)))
         return genlist
 
@@ -129,10 +138,28 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
         keepids = set(genid for genid, dt in keeplist)
         return [genid for genid, _ in genlist if genid not in keepids]
 
-    def remove(self, genid):
-        if self.app.settings['pretend']:
-            self.app.ts.notify(
-                'Pretending to remove generation %s' %
+    def remove_with_checkpoints(self, client_name, genids, interval):
+        # Removing all generations at once and committing only at the
+        # end is fastest, but if forget gets interrupted, all its work
+        # is lost. Committing now and then means it's not.
+        last_commit = time.time()
+        for genid in genids:
+            self.app.ts['gen'] = genid
+            self.remove([genid])
+            self.app.dump_memory_profile(
+                'after removing %s' %
                 self.repo.make_generation_spec(genid))
+            if time.time() - last_commit >= interval:
+                self.repo.commit_client(client_name)
+                self.repo.commit_chunk_indexes()
+                self.repo.remove_unused_chunks()
+                last_commit = time.time()
+
+    def remove(self, genids):
+        if self.app.settings['pretend']:
+            for genid in genids:
+                self.app.ts.notify(
+                    'Pretending to remove generation %s' %
+                    self.repo.make_generation_spec(genid))
         else:
-            self.repo.remove_generation(genid)
+            self.repo.remove_generations(genids)
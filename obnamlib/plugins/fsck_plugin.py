@@ -14,50 +14,92 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import hashlib
 import logging
+import os
+import random
 import stat
 import sys
+import time
 
 import obnamlib
 from obnamlib import WorkItem
 
 
-class CheckChunk(WorkItem):
+def generation_key(repo, client_name, genid):
+    return '%s\0%s' % (client_name, repo.make_generation_spec(genid))
 
-    def __init__(self, chunkid, checksummer):
-        self.chunkid = chunkid
-        self.checksummer = checksummer
-        self.name = 'chunk %s' % chunkid
 
-    def do(self):
-        logging.debug('Checking chunk %s', self.chunkid)
-        if not self.repo.has_chunk(self.chunkid):
-            self.error('chunk %s does not exist' % self.chunkid)
-        elif not self.settings['fsck-skip-checksums']:
-            data = self.repo.get_chunk_content(self.chunkid)
-            self.checksummer.update(data)
-
-            valid = self.repo.validate_chunk_content(self.chunkid)
-            if valid is False:
-                self.error('chunk %s is corrupted' % self.chunkid)
+def content_key(md5, chunkids):
+    return hashlib.sha1(
+        obnamlib.serialise_object([md5, list(chunkids)])).hexdigest()
 
-        self.chunkids_seen.add(self.chunkid)
 
+class CheckFileContent(WorkItem):
 
-class CheckFileChecksum(WorkItem):
+    parallel = True
 
-    def __init__(self, filename, correct, chunkids, checksummer):
-        self.filename = filename
-        self.name = '%s checksum' % filename
-        self.correct = correct
+    def __init__(self, file_name, chunkids, unchecked, correct):
+        self.file_name = file_name
+        self.name = '%s content' % file_name
         self.chunkids = chunkids
-        self.checksummer = checksummer
+        self.unchecked = unchecked
+        self.correct = correct
+        self.ok = None
 
     def do(self):
-        logging.debug('Checking whole-file checksum for %s', self.filename)
-        if self.correct != self.checksummer.digest():
-            self.error('%s whole-file checksum mismatch' % self.name)
+        # Chunks shared with files checked earlier have already been
+        # checked, and any problem with them reported, so we only
+        # need their data, for the whole-file checksum.
+        skip_checksums = self.settings['fsck-skip-checksums']
+        unchecked = set(self.unchecked)
+        checksummer = hashlib.md5()
+        ok = True
+        for chunkid in self.chunkids:
+            if chunkid in unchecked:
+                unchecked.remove(chunkid)
+                if not self.check_chunk(chunkid, checksummer):
+                    ok = False
+            elif not skip_checksums:
+                try:
+                    data = self.repo.get_chunk_content(chunkid)
+                except obnamlib.RepositoryChunkDoesNotExist:
+                    ok = False
+                    continue
+                checksummer.update(data)
+
+        if not skip_checksums:
+            logging.debug(
+                'Checking whole-file checksum for %s', self.file_name)
+            if self.correct != checksummer.digest():
+                self.error(
+                    '%s checksum whole-file checksum mismatch' %
+                    self.file_name)
+                ok = False
+            elif ok and self.fsck_state is not None:
+                self.fsck_state.mark_verified(
+                    'contents', content_key(self.correct, self.chunkids))
+        self.ok = ok
+
+    def check_chunk(self, chunkid, checksummer):
+        logging.debug('Checking chunk %s', chunkid)
+        if not self.repo.has_chunk(chunkid):
+            self.error('chunk %s does not exist' % chunkid)
+            return False
+        if self.settings['fsck-skip-checksums']:
+            return True
+
+        data = self.repo.get_chunk_content(chunkid)
+        checksummer.update(data)
+
+        valid = self.repo.validate_chunk_content(chunkid)
+        if valid is False:
+            self.error('chunk %s is corrupted' % chunkid)
+            return False
+        if self.fsck_state is not None:
+            self.fsck_state.mark_verified('chunks', chunkid)
+        return True
 
 
 class CheckFile(WorkItem):
@@ -67,23 +109,45 @@ class CheckFile(WorkItem):
         self.genid = genid
         self.filename = filename
         self.name = 'file %s:%s:%s' % (client_name, genid, filename)
+        self.verified_earlier = False
 
     def do(self):
         logging.debug(
             'Checking client=%s genid=%s filename=%s',
             self.client_name, self.genid, self.filename)
+        work = self.content_item()
+        if work is not None:
+            yield work
+
+    def content_item(self):
+        '''Return work item for checking file content, or None.'''
+
         mode = self.repo.get_file_key(
             self.genid, self.filename, obnamlib.REPO_FILE_MODE)
-        if stat.S_ISREG(mode) and not self.settings['fsck-ignore-chunks']:
-            chunkids = self.repo.get_file_chunk_ids(self.genid, self.filename)
-            checksummer = hashlib.md5()
-            for chunkid in chunkids:
-                yield CheckChunk(chunkid, checksummer)
-            if not self.settings['fsck-skip-checksums']:
-                md5 = self.repo.get_file_key(
-                    self.genid, self.filename, obnamlib.REPO_FILE_MD5)
-                yield CheckFileChecksum(
-                    self.name, md5, chunkids, checksummer)
+        if not stat.S_ISREG(mode) or self.settings['fsck-ignore-chunks']:
+            return None
+
+        chunkids = self.repo.get_file_chunk_ids(self.genid, self.filename)
+        md5 = None
+        if not self.settings['fsck-skip-checksums']:
+            md5 = self.repo.get_file_key(
+                self.genid, self.filename, obnamlib.REPO_FILE_MD5)
+
+        incremental = self.settings['fsck-incremental']
+        if incremental and self.fsck_state.is_verified(
+                'contents', content_key(md5, chunkids)):
+            logging.debug('%s content verified earlier', self.name)
+            self.chunkids_seen.update(chunkids)
+            self.verified_earlier = True
+            return None
+
+        unchecked = [
+            chunkid for chunkid in chunkids
+            if chunkid not in self.chunkids_seen and not (
+                incremental and
+                self.fsck_state.is_verified('chunks', chunkid))]
+        self.chunkids_seen.update(chunkids)
+        return CheckFileContent(self.name, chunkids, unchecked, md5)
 
 
 class CheckDirectory(WorkItem):
@@ -141,6 +205,17 @@ class CheckGeneration(WorkItem):
             self.error(
                 '%s:%s: no total data' % (self.client_name, self.genid))
 
+        # The fsck plugin forgets this if any problems are found
+        # during the run.
+        partial = any(
+            self.settings['fsck-' + s]
+            for s in ('skip-dirs', 'skip-files', 'ignore-chunks',
+                      'skip-checksums'))
+        if self.fsck_state is not None and not partial:
+            self.fsck_state.mark_verified(
+                'generations',
+                generation_key(self.repo, self.client_name, self.genid))
+
         if self.settings['fsck-skip-dirs']:
             return []
         else:
@@ -180,6 +255,13 @@ class CheckClient(WorkItem):
         elif self.settings['fsck-last-generation-only'] and genids:
             genids = genids[-1:]
         for genid in genids:
+            if self.settings['fsck-incremental']:
+                key = generation_key(self.repo, self.client_name, genid)
+                if self.fsck_state.is_verified('generations', key):
+                    logging.debug(
+                        'Generation %s:%s verified earlier',
+                        self.client_name, genid)
+                    continue
             yield CheckGeneration(self.client_name, genid)
 
 
@@ -203,8 +285,11 @@ class CheckForExtraChunks(WorkItem):
 
     def do(self):
         logging.debug('Checking for extra chunks')
+        # Chunks waiting to be removed after a forget aren't used by
+        # anyone either, but the repository knows about them.
+        pending = set(self.repo.get_pending_chunk_ids())
         for chunkid in self.repo.get_chunk_ids():
-            if chunkid not in self.chunkids_seen:
+            if chunkid not in self.chunkids_seen and chunkid not in pending:
                 if self.remove:
                     self.warning('chunk %s not used by anyone; deleting'
                                  % chunkid)
@@ -297,6 +382,53 @@ class FsckPlugin(obnamlib.ObnamPlugin):
             'do not check checksums of files',
             group=group)
 
+        self.app.settings.integer(
+            ['fsck-jobs'],
+            'check the contents of N files at once, each in a thread '
+            'with a connection to the repository of its own',
+            metavar='N',
+            default=1,
+            group=group)
+
+        self.app.settings.string(
+            ['fsck-state'],
+            'remember what fsck has verified in a file in DIR, '
+            'one file per repository; empty means do not remember',
+            metavar='DIR',
+            group=group)
+
+        self.app.settings.boolean(
+            ['fsck-incremental'],
+            'check only what --fsck-state does not say was verified '
+            'earlier, and the share of that which is due for '
+            're-checking; implies not checking for unused chunks',
+            group=group)
+
+        self.app.settings.integer(
+            ['fsck-recheck-cycle'],
+            'with --fsck-incremental, re-check things that were '
+            'verified earlier, so that each gets re-checked once '
+            'every N runs',
+            metavar='N',
+            default=30,
+            group=group)
+
+        self.app.settings.integer(
+            ['fsck-sample-time'],
+            'instead of checking everything, check randomly chosen '
+            'files from all clients and generations, for SECONDS '
+            'seconds, and estimate the share of files picked that way '
+            'that have problems',
+            metavar='SECONDS',
+            group=group)
+
+        self.app.settings.bytesize(
+            ['fsck-sample-size'],
+            'like --fsck-sample-time, but stop after checking files '
+            'of SIZE in total',
+            metavar='SIZE',
+            group=group)
+
     def configure_ttystatus(self):
         self.app.ts.clear()
         self.app.ts['this_item'] = 0
@@ -312,6 +444,8 @@ class FsckPlugin(obnamlib.ObnamPlugin):
         rm_unused_chunks = self.app.settings['fsck-rm-unused'] \
             or self.app.settings['fsck-fix']
 
+        self.fsck_state = self.open_fsck_state()
+
         self.configure_ttystatus()
 
         self.repo = self.app.get_repository_object()
@@ -320,52 +454,287 @@ class FsckPlugin(obnamlib.ObnamPlugin):
 
         self.errors = 0
         self.chunkids_seen = set()
-        self.work_items = []
-        self.add_item(CheckRepository(), append=True)
+        self.work_items = collections.deque()
 
         final_items = []
         if not any(self.app.settings['fsck-' + s] for s in
                    ('ignore-chunks', 'skip-files', 'skip-dirs',
                     'skip-generations', 'last-generation-only',
-                    'ignore-client')):
+                    'ignore-client', 'incremental')):
             final_items.append(CheckForExtraChunks(rm_unused_chunks))
 
-        while self.work_items:
-            work = self.work_items.pop(0)
-            logging.debug('doing: %s', str(work))
-            self.app.ts['item'] = work
-            self.app.ts.increase('this_item', 1)
-            pos = 0
-            for more in work.do() or []:
-                self.add_item(more, pos=pos)
-                pos += 1
-            if not self.work_items:
-                for work in final_items:
-                    self.add_item(work, append=True)
-                final_items = []
+        self.start_workers()
+
+        sample_seconds = self.app.settings['fsck-sample-time']
+        sample_bytes = self.app.settings['fsck-sample-size']
+        if sample_seconds or sample_bytes:
+            summary = self.check_samples(sample_seconds, sample_bytes)
+        else:
+            summary = None
+            self.check_work_items(final_items)
+
+        self.stop_workers()
 
         if rm_unused_chunks:
             self.repo.commit_chunk_indexes()
         self.repo.unlock_everything()
 
         self.repo.close()
+
+        if self.fsck_state is not None:
+            # A generation has been verified only if nothing in it
+            # was wrong. We don't keep track of where the problems
+            # were, so any problem at all means re-checking all of
+            # the generations next time. Chunks and file contents are
+            # only marked verified if they are correct.
+            if self.errors:
+                self.fsck_state.forget_verified('generations')
+            self.fsck_state.save()
+
         self.app.ts.finish()
 
+        if summary is not None:
+            self.app.output.write(summary)
+
         if self.errors:
             sys.exit(1)
 
-    def add_item(self, work, append=False, pos=0):
-        logging.debug('adding: %s', str(work))
-        work.warning = self.warning
-        work.error = self.error
+    def check_work_items(self, final_items):
+        self.add_item(CheckRepository())
+        while self.work_items:
+            work = self.work_items.popleft()
+            logging.debug('doing: %s', str(work))
+            self.app.ts['item'] = work
+            self.app.ts.increase('this_item', 1)
+            self.do_item(work)
+            if not self.work_items:
+                self.report_all()
+                for work in final_items:
+                    self.add_item(work)
+                final_items = []
+
+    # Sampling checks the content of randomly chosen files, until the
+    # time or byte budget is spent. To make sure every client, and
+    # both old and new backups, get their share, the generations of
+    # each client are grouped by age, and files are picked from each
+    # group in turn. A file is picked by descending from the root
+    # directory of a random generation in the group, choosing a
+    # random child at each level, so files in small directories are
+    # more likely to be picked than those in big ones. No file is
+    # picked twice from the same generation. With --fsck-incremental,
+    # files whose content was verified earlier are skipped, but they
+    # do not count as misses: in a mostly verified repository, most
+    # picks are such files.
+    #
+    # The sample is thus not uniform over all files, and the bound
+    # in the summary is only for files picked the way we pick them.
+
+    max_sample_misses = 100
+
+    def check_samples(self, max_seconds, max_bytes):
+        strata = []
+        for client_name in self.repo.get_client_names():
+            if client_name in self.app.settings['fsck-ignore-client']:
+                continue
+            genids = self.repo.get_client_generation_ids(client_name)
+            for group in obnamlib.stratify_generations(genids):
+                strata.append((client_name, group))
+        rng = random.Random()
+        rng.shuffle(strata)
+
+        started = time.time()
+        samples = []
+        picked = set()
+        total_bytes = 0
+        misses = 0
+        picks = 0
+        skipped = 0
+        while strata and misses < self.max_sample_misses:
+            if max_seconds and time.time() - started >= max_seconds:
+                break
+            if max_bytes and total_bytes >= max_bytes:
+                break
+
+            client_name, group = strata[picks % len(strata)]
+            picks += 1
+            genid = rng.choice(group)
+            filename = self.pick_random_file(rng, genid)
+            file_work = None
+            work = None
+            if filename is not None and (genid, filename) not in picked:
+                picked.add((genid, filename))
+                file_work = CheckFile(client_name, genid, filename)
+                self.prepare_item(file_work)
+                work = file_work.content_item()
+            if file_work is not None and file_work.verified_earlier:
+                skipped += 1
+                continue
+            if work is None:
+                misses += 1
+                continue
+            misses = 0
+
+            self.prepare_item(work)
+            self.app.ts['item'] = work
+            self.app.ts.increase('items', 1)
+            self.app.ts.increase('this_item', 1)
+            self.do_item(work)
+            samples.append((client_name, genid, work))
+
+            # Empty files count as one byte, so that a byte budget
+            # gets spent even if all files are empty.
+            size = self.repo.get_file_key(
+                genid, filename, obnamlib.REPO_FILE_SIZE)
+            total_bytes += max(1, size)
+
+        self.report_all()
+        return self.summarise_samples(
+            samples, skipped, total_bytes, time.time() - started)
+
+    def pick_random_file(self, rng, genid):
+        pathname = '/'
+        while True:
+            mode = self.repo.get_file_key(
+                genid, pathname, obnamlib.REPO_FILE_MODE)
+            if not stat.S_ISDIR(mode):
+                return pathname
+            children = self.repo.get_file_children(genid, pathname)
+            if not children:
+                return None
+            pathname = rng.choice(children)
+
+    def summarise_samples(self, samples, skipped, total_bytes, duration):
+        n = len(samples)
+        failures = len([x for x in samples if not x[2].ok])
+        generations = set((x[0], x[1]) for x in samples)
+        clients = set(x[0] for x in samples)
+        size_amount, size_unit = obnamlib.humanise_size(total_bytes)
+        bound = obnamlib.wilson_upper_bound(failures, n)
+        return (
+            'Sampled %d files from %d generations of %d clients: '
+            '%d %s in %s\n'
+            'Skipped %d files verified earlier\n'
+            'Files with problems: %d\n'
+            'Share of files with problems, among files picked at random '
+            'per client and age of generation, favouring files in small '
+            'directories: at most %.2f%% (95%% confidence)\n' %
+            (n, len(generations), len(clients), size_amount, size_unit,
+             obnamlib.humanise_duration(duration), skipped, failures,
+             100 * bound))
+
+    def add_item(self, work):
+        self.add_items([work], append=True)
+
+    def add_items(self, items, append=False):
+        for work in items:
+            logging.debug('adding: %s', str(work))
+            self.prepare_item(work)
+        if append:
+            self.work_items.extend(items)
+        else:
+            self.work_items.extendleft(reversed(items))
+        self.app.ts.increase('items', len(items))
+
+    def prepare_item(self, work):
+        work.warning = self.queue_warning
+        work.error = self.queue_error
         work.repo = self.repo
         work.settings = self.app.settings
         work.chunkids_seen = self.chunkids_seen
-        if append:
-            self.work_items.append(work)
+        work.fsck_state = self.fsck_state
+
+    def open_fsck_state(self):
+        if self.app.settings['fsck-incremental']:
+            self.app.settings.require('fsck-state')
+        dirname = self.app.settings['fsck-state']
+        if not dirname:
+            return None
+        repo_hash = hashlib.sha1(self.app.settings['repository']).hexdigest()
+        filename = os.path.join(os.path.expanduser(dirname), repo_hash)
+        state = obnamlib.FsckState(
+            filename, self.app.settings['fsck-recheck-cycle'])
+        logging.info('fsck state: %s, run %d', filename, state.run)
+        return state
+
+    # Problems found by work items in worker threads are reported in
+    # the order the items were started, once all the items before
+    # them have finished. Problems found in the main thread wait for
+    # the worker items started before them. Thus the output is the
+    # same however long the workers take.
+    #
+    # self.reports holds a WorkerPoolJob for each unfinished worker
+    # item, and lists of (report function, message) pairs from the
+    # main thread, in between.
+
+    def start_workers(self):
+        self.reports = collections.deque()
+        self.worker_repos = []
+        self.pool = None
+        jobs = self.app.settings['fsck-jobs']
+        if jobs > 1:
+            self.worker_repos = [
+                self.app.get_repository_object(spool=False)
+                for i in range(jobs)]
+            self.pool = obnamlib.WorkerPool(self.worker_repos)
+
+    def stop_workers(self):
+        self.report_all()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        for repo in self.worker_repos:
+            repo.close()
+        self.worker_repos = []
+
+    def do_item(self, work):
+        if getattr(work, 'parallel', False) and self.pool is not None:
+            self.reports.append(self.pool.submit(self.run_in_worker, work))
+            while len(self.reports) > 4 * len(self.pool):
+                self.report_first()
+        else:
+            self.add_items(list(work.do() or []))
+        self.report_finished()
+
+    def run_in_worker(self, repo, work):
+        messages = []
+        work.repo = repo
+        work.warning = lambda msg: messages.append((self.warning, msg))
+        work.error = lambda msg: messages.append((self.error, msg))
+        work.do()
+        return messages
+
+    def queue_warning(self, msg):
+        self.queue_message(self.warning, msg)
+
+    def queue_error(self, msg):
+        self.queue_message(self.error, msg)
+
+    def queue_message(self, func, msg):
+        if not self.reports:
+            func(msg)
         else:
-            self.work_items.insert(pos, work)
-        self.app.ts.increase('items', 1)
+            if not isinstance(self.reports[-1], list):
+                self.reports.append([])
+            self.reports[-1].append((func, msg))
+
+    def report_first(self):
+        report = self.reports.popleft()
+        if isinstance(report, obnamlib.WorkerPoolJob):
+            report = report.result()
+        for func, msg in report:
+            func(msg)
+
+    def report_finished(self):
+        while self.reports:
+            report = self.reports[0]
+            if isinstance(report, obnamlib.WorkerPoolJob):
+                if not report.done():
+                    break
+            self.report_first()
+
+    def report_all(self):
+        while self.reports:
+            self.report_first()
 
     def error(self, msg):
         logging.error(msg)
@@ -14,11 +14,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import bisect
+import collections
 import os
 import stat
 import logging
 import errno
 import struct
+import threading
+import Queue
 
 import tracing
 
@@ -74,6 +78,28 @@ class ObnamFuseOptParse(object):
         if not hasattr(self.fuse_args, 'ro'):
             self.fuse_args.add('ro')
 
+        # FUSE timeouts apply to the whole mount. Generations don't
+        # change, so the kernel may remember lookups for a long time.
+        # The attributes of the mount root and /latest do change when
+        # the root is refreshed, so attributes are cached only briefly;
+        # the metadata cache keeps getattr cheap. Failed lookups are
+        # not cached, so that new generations show up after a refresh.
+        settings = self.obnam.app.settings
+        timeouts = [
+            ('entry_timeout', settings['fuse-metadata-timeout']),
+            ('attr_timeout', 1),
+            ('negative_timeout', 0),
+        ]
+        for name, timeout in timeouts:
+            if not self.has_fuse_option(name):
+                self.fuse_args.add(name, str(timeout))
+
+    def has_fuse_option(self, name):
+        if name in self.fuse_args.optdict:
+            return True
+        prefix = name + '='
+        return any(opt.startswith(prefix) for opt in self.fuse_args.optlist)
+
 
 class ObnamFuseFile(object):
 
@@ -94,6 +120,9 @@ class ObnamFuseFile(object):
         tracing.trace('mode=%r', mode)
 
         self.path = path
+        self.chunk_offsets = None
+        self.next_offset = None
+        self.lock = threading.Lock()
 
         if flags & self.write_flags:
             raise IOError(errno.EROFS, 'Read only filesystem')
@@ -149,53 +178,64 @@ class ObnamFuseFile(object):
         if length == 0 or offset >= self.metadata.st_size:
             return ''
 
-        gen, repopath = self.fuse_fs.get_gen_path(self.path)
-
         # The file has a list of chunks, and we need to find the right
         # ones and return data from them. Note that we can't compute a
         # seek: there is no guarantee all the chunks are of the same
         # size. The user may have changed the chunk size setting
-        # between each backup run. Thus, we have to iterate over the
-        # list of chunk ids for the file, until we find the right
-        # place.
+        # between each backup run. Thus, we keep a table of where each
+        # chunk starts in the file, and look up the right chunk with a
+        # binary search. The table is built once per open file, from
+        # the chunk sizes stored in the repository, if any.
         #
-        # This is, obviously, not good for performance.
-        #
-        # Note that previous code here did the wrong thing by assuming
-        # the chunk size was fixed, except for the last chunk for any
-        # file.
+        # The table is shared by all threads reading this file, so
+        # we only use it while holding the file's lock.
+
+        with self.lock:
+            table = self.get_chunk_offset_table()
+            pieces = []
+            wanted = 0
+            index = table.find_chunk(offset)
+            while index is not None and wanted < length:
+                chunkid, chunk_start, size = table.get_chunk(index)
+                start = offset + wanted - chunk_start
+                n = min(length - wanted, size - start)
+                pieces.append((chunkid, start, n))
+                wanted += n
+                index = table.next_chunk(index)
+
+            sequential = offset == self.next_offset
+            self.next_offset = offset + wanted
+            if sequential and index is not None:
+                self.fuse_fs.obnam.prefetch_chunks(
+                    table.get_chunk_ids(
+                        index, self.fuse_fs.obnam.read_ahead))
 
-        chunkids = self.fuse_fs.obnam.repo.get_file_chunk_ids(gen, repopath)
         output = []
-        output_length = 0
-        chunk_pos_in_file = 0
-        size_cache = self.fuse_fs.obnam.chunk_sizes
-
-        for chunkid in chunkids:
-            if chunkid in size_cache:
-                # Don't read the contents of the chunk until later,
-                # in case it can be skipped completely.
-                contents = None
-            else:
-                contents = self.fuse_fs.obnam.repo.get_chunk_content(chunkid)
-                size_cache[chunkid] = len(contents)
-            size = size_cache[chunkid]
-
-            if chunk_pos_in_file + size > offset + output_length:
-                start = offset + output_length - chunk_pos_in_file
-                n = min(length - output_length, size - start)
-                if contents is None:
-                    contents = self.fuse_fs.obnam.repo.get_chunk_content(
-                        chunkid)
-                output.append(contents[start:start+n])
-                output_length += n
-                assert output_length <= length
-                if output_length == length:
-                    break
-            chunk_pos_in_file += size
-
+        for chunkid, start, n in pieces:
+            contents = self.fuse_fs.obnam.get_chunk_content(chunkid)
+            output.append(contents[start:start+n])
         return ''.join(output)
 
+    def get_chunk_offset_table(self):
+        if self.chunk_offsets is None:
+            gen, repopath = self.fuse_fs.get_gen_path(self.path)
+            repo = self.fuse_fs.obnam.repo
+            self.chunk_offsets = ChunkOffsetTable(
+                repo.get_file_chunk_ids(gen, repopath),
+                repo.get_file_chunk_sizes(gen, repopath),
+                self.get_chunk_size)
+        return self.chunk_offsets
+
+    def get_chunk_size(self, chunkid):
+        # Only used when the repository doesn't have the chunk sizes
+        # for this file. We store sizes in the plugin, so the cache
+        # survives a re-open.
+        size_cache = self.fuse_fs.obnam.chunk_sizes
+        if chunkid not in size_cache:
+            contents = self.fuse_fs.obnam.get_chunk_content(chunkid)
+            size_cache[chunkid] = len(contents)
+        return size_cache[chunkid]
+
     def release_data(self, flags):
         tracing.trace('flags=%r', flags)
         return 0
@@ -219,6 +259,239 @@ class ObnamFuseFile(object):
         raise IOError(errno.EOPNOTSUPP, 'Operation not supported')
 
 
+class ChunkOffsetTable(object):
+
+    '''Map file offsets to the chunks that contain them.
+
+    The table is built lazily: if chunk sizes are not known up front,
+    they are looked up, using the get_size callback, only as far into
+    the file as has been needed so far.
+
+    '''
+
+    def __init__(self, chunkids, sizes, get_size):
+        self._chunkids = chunkids
+        self._get_size = get_size
+        self._ends = []
+        if sizes is not None:
+            for size in sizes:
+                self._append_size(size)
+
+    def _append_size(self, size):
+        if self._ends:
+            self._ends.append(self._ends[-1] + size)
+        else:
+            self._ends.append(size)
+
+    def _extend_to(self, offset):
+        while (len(self._ends) < len(self._chunkids) and
+               (not self._ends or self._ends[-1] <= offset)):
+            chunkid = self._chunkids[len(self._ends)]
+            self._append_size(self._get_size(chunkid))
+
+    def find_chunk(self, offset):
+        '''Return index of chunk containing offset, or None.'''
+        self._extend_to(offset)
+        index = bisect.bisect_right(self._ends, offset)
+        if index >= len(self._ends):
+            return None
+        return index
+
+    def next_chunk(self, index):
+        '''Return index of chunk following a given one, or None.'''
+        if index + 1 >= len(self._chunkids):
+            return None
+        self._extend_to(self._ends[index])
+        return index + 1
+
+    def get_chunk_ids(self, index, count):
+        '''Return up to count chunk ids starting from a given index.'''
+        return self._chunkids[index:index + count]
+
+    def get_chunk(self, index):
+        '''Return chunk id, start offset, and size of a chunk.'''
+        end = self._ends[index]
+        if index == 0:
+            start = 0
+        else:
+            start = self._ends[index - 1]
+        return self._chunkids[index], start, end - start
+
+
+class LockedRepository(object):
+
+    '''Serialise all calls to a repository object.
+
+    The repository implementations are not thread safe, but a
+    multithreaded FUSE mount, and the read-ahead thread, call them
+    from several threads. This wrapper makes every method call hold
+    a lock for its duration.
+
+    '''
+
+    def __init__(self, repo, lock):
+        self._repo = repo
+        self._lock = lock
+
+    def __getattr__(self, name):
+        value = getattr(self._repo, name)
+        if not callable(value):
+            return value
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return value(*args, **kwargs)
+        return locked
+
+
+class ChunkCache(object):
+
+    '''A thread safe LRU cache of chunk contents, limited in bytes.'''
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._chunks = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, chunkid):
+        with self._lock:
+            return chunkid in self._chunks
+
+    def get(self, chunkid):
+        with self._lock:
+            contents = self._chunks.pop(chunkid, None)
+            if contents is not None:
+                self._chunks[chunkid] = contents
+            return contents
+
+    def put(self, chunkid, contents):
+        if len(contents) > self._max_bytes:
+            return
+        with self._lock:
+            old = self._chunks.pop(chunkid, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._chunks[chunkid] = contents
+            self._bytes += len(contents)
+            while self._bytes > self._max_bytes:
+                _, dropped = self._chunks.popitem(last=False)
+                self._bytes -= len(dropped)
+
+
+class ChunkPrefetcher(object):
+
+    '''Fetch chunks into a ChunkCache in a background thread.'''
+
+    def __init__(self, get_chunk_content, cache):
+        self._get_chunk_content = get_chunk_content
+        self._cache = cache
+        self._queue = Queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prefetch(self, chunkids):
+        for chunkid in chunkids:
+            with self._lock:
+                if chunkid in self._pending or chunkid in self._cache:
+                    continue
+                self._pending.add(chunkid)
+            self._queue.put(chunkid)
+
+    def _run(self):
+        while True:
+            chunkid = self._queue.get()
+            try:
+                if chunkid not in self._cache:
+                    self._cache.put(chunkid, self._get_chunk_content(chunkid))
+            except Exception as e:
+                # A failed prefetch is not fatal: the real read will
+                # fetch the chunk again and report any error then.
+                logging.debug('Prefetching chunk %s failed: %s', chunkid, e)
+            with self._lock:
+                self._pending.discard(chunkid)
+
+
+class MetadataCache(object):
+
+    '''Cache file metadata and directory listings for FUSE.
+
+    Generations never change once they're finished, so anything we
+    learn about a file in a generation stays true. The only exception
+    is /latest, which may point at a new generation after a re-open,
+    so the whole cache is cleared then.
+
+    We also remember which files do not exist, either because a lookup
+    failed, or because the file is not in its parent's listing.
+
+    The cache is limited in the number of entries, and drops the least
+    recently used ones first. It is thread safe.
+
+    '''
+
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._metadata = collections.OrderedDict()
+            self._listings = collections.OrderedDict()
+
+    def _get(self, entries, key):
+        value = entries.pop(key, None)
+        if value is not None:
+            entries[key] = value
+        return value
+
+    def _set(self, entries, key, value):
+        entries.pop(key, None)
+        entries[key] = value
+        while len(entries) > self._max_entries:
+            entries.popitem(last=False)
+
+    def get_metadata(self, path):
+        with self._lock:
+            value = self._get(self._metadata, path)
+        if value is _MISSING:
+            return None
+        return value
+
+    def set_metadata(self, path, metadata):
+        with self._lock:
+            self._set(self._metadata, path, metadata)
+
+    def is_missing(self, path):
+        with self._lock:
+            if self._get(self._metadata, path) is _MISSING:
+                return True
+            listing = self._get(self._listings, os.path.dirname(path))
+        return (listing is not None and
+                os.path.basename(path) not in listing)
+
+    def set_missing(self, path):
+        with self._lock:
+            self._set(self._metadata, path, _MISSING)
+
+    def get_listing(self, path):
+        with self._lock:
+            listing = self._get(self._listings, path)
+        if listing is None:
+            return None
+        return list(listing)
+
+    def set_listing(self, path, basenames):
+        with self._lock:
+            self._set(self._listings, path, frozenset(basenames))
+
+
+_MISSING = object()
+
+
 class ObnamFuse(fuse.Fuse):
 
     '''FUSE main class.'''
@@ -227,6 +500,8 @@ class ObnamFuse(fuse.Fuse):
         self.obnam = kw['obnam']
         ObnamFuseFile.fuse_fs = self
         self.file_class = ObnamFuseFile
+        self.metadata_cache = MetadataCache(
+            self.obnam.app.settings['fuse-metadata-cache-entries'])
         self.init_root()
         fuse.Fuse.__init__(self, *args, **kw)
 
@@ -285,21 +560,37 @@ class ObnamFuse(fuse.Fuse):
     def root_refresh(self):
         tracing.trace('called')
         self.obnam.reopen()
+        self.metadata_cache.clear()
         self.init_root()
 
     def get_metadata_in_generation(self, path):
         tracing.trace('path=%r', path)
 
-        gen, filename = self.get_gen_path(path)
-        metadata = self.obnam.repo.get_metadata_from_file_keys(gen, filename)
+        cached = self.metadata_cache.get_metadata(path)
+        if cached is not None:
+            return cached
+        if self.metadata_cache.is_missing(path):
+            raise FileNotFoundError(filename=path)
 
+        try:
+            gen, filename = self.get_gen_path(path)
+            metadata = self.obnam.repo.get_metadata_from_file_keys(
+                gen, filename)
+        except obnamlib.RepositoryFileDoesNotExistInGeneration:
+            self.metadata_cache.set_missing(path)
+            raise
+
+        self.set_metadata_in_generation(path, metadata)
+        return metadata
+
+    def set_metadata_in_generation(self, path, metadata):
         # FUSE does not allow negative timestamps, truncate to zero
         if metadata.st_atime_sec < 0:
             metadata.st_atime_sec = 0
         if metadata.st_mtime_sec < 0:
             metadata.st_mtime_sec = 0
 
-        return metadata
+        self.metadata_cache.set_metadata(path, metadata)
 
     def get_stat_in_generation(self, path):
         tracing.trace('path=%r', path)
@@ -353,10 +644,7 @@ class ObnamFuse(fuse.Fuse):
             if path == '/':
                 listdir = [x[1:] for x in self.rootlist.keys()]
             else:
-                listdir = [
-                    os.path.basename(x)
-                    for x in self.obnam.repo.get_file_children(
-                        *self.get_gen_path(path))]
+                listdir = self.list_directory(path)
             return [fuse.Direntry(name) for name in ['.', '..'] + listdir]
         except obnamlib.ObnamError:
             raise IOError(errno.EINVAL, 'Invalid argument')
@@ -364,6 +652,24 @@ class ObnamFuse(fuse.Fuse):
             logging.error('Unexpected exception', exc_info=True)
             raise
 
+    def list_directory(self, path):
+        listdir = self.metadata_cache.get_listing(path)
+        if listdir is None:
+            # The caller is very likely to stat the children next, so
+            # we get their metadata along with the listing. The
+            # repository can look it all up at once, since it keeps a
+            # directory's children together.
+            gen, dirname = self.get_gen_path(path)
+            listdir = []
+            for pathname, metadata in self.obnam.repo.get_directory_metadata(
+                    gen, dirname):
+                name = os.path.basename(pathname)
+                self.set_metadata_in_generation(
+                    os.path.join(path, name), metadata)
+                listdir.append(name)
+            self.metadata_cache.set_listing(path, listdir)
+        return listdir
+
     def readlink(self, path):
         try:
             statdata = self.rootlist.get(path)
@@ -546,6 +852,39 @@ class MountPlugin(obnamlib.ObnamPlugin):
             'options to pass directly to Fuse',
             metavar='FUSE',
             group=mount_group)
+        self.app.settings.boolean(
+            ['fuse-multithreaded'],
+            'let FUSE serve several requests at once; repository '
+            'access is still serialised, but decoding and copying '
+            'data to the kernel are done in parallel',
+            group=mount_group)
+        self.app.settings.bytesize(
+            ['fuse-chunk-cache-size'],
+            'keep up to SIZE bytes of recently read chunks in memory',
+            metavar='SIZE',
+            default=64 * 1024**2,
+            group=mount_group)
+        self.app.settings.integer(
+            ['fuse-read-ahead'],
+            'when a file is read sequentially, fetch the next N '
+            'chunks in the background; set to 0 to disable',
+            metavar='N',
+            default=4,
+            group=mount_group)
+        self.app.settings.integer(
+            ['fuse-metadata-timeout'],
+            'let the kernel cache file lookups for SECONDS seconds '
+            '(unless set explicitly with --fuse-opt)',
+            metavar='SECONDS',
+            default=3600,
+            group=mount_group)
+        self.app.settings.integer(
+            ['fuse-metadata-cache-entries'],
+            'remember metadata and directory listings for up to N '
+            'files in memory',
+            metavar='N',
+            default=100000,
+            group=mount_group)
 
     def mount(self, args):
         '''Mount a backup repository as a FUSE filesystem.
@@ -590,7 +929,11 @@ class MountPlugin(obnamlib.ObnamPlugin):
         # chdir to where we are now, so this doesn't break.
         self.cwd = os.getcwd()
 
-        self.repo = self.app.get_repository_object()
+        # All repository access goes through a LockedRepository, since
+        # there may be several threads using it at once.
+        self.repo_lock = threading.RLock()
+        self.repo = LockedRepository(
+            self.app.get_repository_object(), self.repo_lock)
 
         logging.debug(
             'FUSE Mounting %s@%s:/ to %s',
@@ -603,20 +946,49 @@ class MountPlugin(obnamlib.ObnamPlugin):
         # re-open.
         self.chunk_sizes = {}
 
+        # Decoded chunks are cached, and shared by all open files.
+        # Sequential reads get the next chunks fetched in the
+        # background.
+        self.chunk_cache = ChunkCache(
+            self.app.settings['fuse-chunk-cache-size'])
+        self.read_ahead = self.app.settings['fuse-read-ahead']
+        self.prefetcher = None
+        if self.read_ahead > 0:
+            self.prefetcher = ChunkPrefetcher(
+                self.fetch_chunk_content, self.chunk_cache)
+
         ObnamFuseOptParse.obnam = self
         fuse_fs = ObnamFuse(obnam=self, parser_class=ObnamFuseOptParse)
         fuse_fs.flags = 0
-        fuse_fs.multithreaded = 0
+        fuse_fs.multithreaded = int(self.app.settings['fuse-multithreaded'])
         fuse_fs.parse()
         fuse_fs.main()
 
         self.repo.close()
 
     def reopen(self):
-        self.repo.close()
-
-        # Change to original working directory, to allow relative paths
-        # for --repository to work correctly.
-        os.chdir(self.cwd)
-
-        self.repo = self.app.get_repository_object()
+        with self.repo_lock:
+            self.repo.close()
+
+            # Change to original working directory, to allow relative
+            # paths for --repository to work correctly.
+            os.chdir(self.cwd)
+
+            self.repo = LockedRepository(
+                self.app.get_repository_object(), self.repo_lock)
+
+    def fetch_chunk_content(self, chunkid):
+        # This is given to the prefetcher, so that it always uses the
+        # current repository object, even after a re-open.
+        return self.repo.get_chunk_content(chunkid)
+
+    def get_chunk_content(self, chunkid):
+        contents = self.chunk_cache.get(chunkid)
+        if contents is None:
+            contents = self.fetch_chunk_content(chunkid)
+            self.chunk_cache.put(chunkid, contents)
+        return contents
+
+    def prefetch_chunks(self, chunkids):
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(chunkids)
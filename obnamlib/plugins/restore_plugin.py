@@ -193,19 +193,18 @@ class RestorePlugin(obnamlib.ObnamPlugin):
             raise RestoreErrors()
 
     def restore_something(self, gen, root):
-        for pathname in self.repo.walk_generation(gen, root):
+        walker = self.repo.walk_generation_files(gen, root)
+        for pathname, metadata, chunkids in walker:
             self.file_count += 1
             self.app.ts['current'] = pathname
-            self.restore_safely(gen, pathname)
+            self.restore_safely(gen, pathname, metadata, chunkids)
 
-    def restore_safely(self, gen, pathname):
+    def restore_safely(self, gen, pathname, metadata, chunkids):
         try:
             dirname = os.path.dirname(pathname)
             if self.write_ok and not self.fs.exists('./' + dirname):
                 self.fs.makedirs('./' + dirname)
 
-            metadata = self.repo.get_metadata_from_file_keys(gen, pathname)
-
             set_metadata = True
             if metadata.isdir():
                 self.restore_dir(gen, pathname, metadata)
@@ -218,9 +217,10 @@ class RestorePlugin(obnamlib.ObnamPlugin):
                     set_metadata = False
                 else:
                     self.hardlinks.add(pathname, metadata)
-                    self.restore_first_link(gen, pathname, metadata)
+                    self.restore_first_link(
+                        gen, pathname, metadata, chunkids)
             else:
-                self.restore_first_link(gen, pathname, metadata)
+                self.restore_first_link(gen, pathname, metadata, chunkids)
             if set_metadata and self.write_ok:
                 always = self.app.settings['always-restore-setuid']
                 try:
@@ -255,9 +255,9 @@ class RestorePlugin(obnamlib.ObnamPlugin):
     def restore_symlink(self, gen, filename, metadata):
         logging.debug('restoring symlink %s', filename)
 
-    def restore_first_link(self, gen, filename, metadata):
+    def restore_first_link(self, gen, filename, metadata, chunkids):
         if stat.S_ISREG(metadata.st_mode):
-            self.restore_regular_file(gen, filename, metadata)
+            self.restore_regular_file(gen, filename, metadata, chunkids)
         elif stat.S_ISFIFO(metadata.st_mode):
             self.restore_fifo(gen, filename, metadata)
         elif stat.S_ISSOCK(metadata.st_mode):
@@ -270,14 +270,13 @@ class RestorePlugin(obnamlib.ObnamPlugin):
             logging.error(msg)
             self.app.ts.notify(msg)
 
-    def restore_regular_file(self, gen, filename, metadata):
+    def restore_regular_file(self, gen, filename, metadata, chunkids):
         logging.debug('restoring regular %s', filename)
         if self.write_ok:
             f = self.fs.open('./' + filename, 'wb')
             summer = hashlib.md5()
 
             try:
-                chunkids = self.repo.get_file_chunk_ids(gen, filename)
                 self.restore_chunks(f, chunkids, summer)
             except obnamlib.MissingFilterError, e:
                 msg = '%s: %s' % (filename, str(e))
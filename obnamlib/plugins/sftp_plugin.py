@@ -21,9 +21,11 @@ import logging
 import os
 import pwd
 import random
+import select
 import socket
 import stat
 import subprocess
+import threading
 import time
 import urlparse
 import getpass
@@ -122,9 +124,18 @@ class SSHChannelAdapter(object):
                 return ''
             raise
 
+    def recv_ready(self):
+        # paramiko asks this when pipelining writes, to see if it can
+        # read acknowledgements without blocking.
+        ready, _, _ = select.select([self.proc.stdout], [], [], 0)
+        return bool(ready)
+
     def get_name(self):
         return 'obnam SSHChannelAdapter'
 
+    def is_active(self):
+        return self.proc.poll() is None
+
     def close(self):
         logging.debug('SSHChannelAdapter.close called')
         for func in [self.proc.stdin.close, self.proc.stdout.close,
@@ -135,6 +146,93 @@ class SSHChannelAdapter(object):
                 pass
 
 
+class SftpConnectionPool(object):
+
+    '''A set of SFTP connections to the same server.
+
+    Each thread gets a connection of its own, opened when first
+    needed, until the maximum number of connections is reached. After
+    that, threads share the existing connections, which paramiko
+    allows. A connection that has died is replaced with a new one
+    the next time a thread asks for a connection.
+
+    The current working directory is kept the same for all
+    connections.
+
+    '''
+
+    def __init__(self, open_connection, max_connections):
+        self._open_connection = open_connection
+        self._max_connections = max_connections
+        self._connections = []
+        self._next = 0
+        self._cwd = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None or not self._is_healthy(conn):
+            with self._lock:
+                if conn is not None:
+                    self._discard(conn)
+                conn = self._checkout()
+            self._local.connection = conn
+        sftp, _ = conn
+        return sftp
+
+    def _is_healthy(self, conn):
+        sftp, transport = conn
+        if transport is not None:
+            return transport.is_active()
+        return sftp.sock.is_active()
+
+    def _discard(self, conn):
+        logging.warning('SFTP connection lost, opening a new one')
+        if conn in self._connections:
+            self._connections.remove(conn)
+        self._close_connection(conn)
+
+    def _checkout(self):
+        self._connections = [
+            conn for conn in self._connections if self._is_healthy(conn)]
+        if len(self._connections) < self._max_connections:
+            conn = self._open_connection()
+            sftp, _ = conn
+            if self._cwd is not None:
+                sftp.chdir(self._cwd)
+            self._connections.append(conn)
+            logging.debug(
+                'Opened SFTP connection %d', len(self._connections))
+            return conn
+        self._next = (self._next + 1) % len(self._connections)
+        return self._connections[self._next]
+
+    def chdir(self, pathname):
+        sftp = self.get()
+        sftp.chdir(pathname)
+        with self._lock:
+            self._cwd = sftp.getcwd()
+            for other, _ in self._connections:
+                if other is not sftp:
+                    other.chdir(self._cwd)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                self._close_connection(conn)
+            self._connections = []
+
+    def _close_connection(self, conn):
+        sftp, transport = conn
+        try:
+            sftp.close()
+            if transport is not None:
+                transport.close()
+        except (IOError, OSError, EOFError, paramiko.SSHException) as e:
+            logging.debug('Ignoring error closing SFTP connection: %s', e)
+
+
 class SftpFS(obnamlib.VirtualFileSystem):
 
     '''A VFS implementation for SFTP.
@@ -147,9 +245,15 @@ class SftpFS(obnamlib.VirtualFileSystem):
     # for sftp transfers. I don't know why the size matters.
     chunk_size = 32 * 1024
 
+    # Default number of outstanding read or write requests per file,
+    # if not set with --sftp-window.
+    default_window = 64
+
     def __init__(self, baseurl, create=False, settings=None):
         obnamlib.VirtualFileSystem.__init__(self, baseurl)
-        self.sftp = None
+        self._pool = None
+        self._known_dirs = set()
+        self._posix_rename_works = True
         self.settings = settings
         self._roundtrips = 0
         self._initial_dir = None
@@ -165,6 +269,23 @@ class SftpFS(obnamlib.VirtualFileSystem):
             if ms > 0:
                 time.sleep(ms * 0.001)
 
+    @property
+    def sftp(self):
+        '''The SFTP connection to use in the calling thread.'''
+        if self._pool is None:
+            return None
+        return self._pool.get()
+
+    def _get_max_connections(self):
+        if self.settings and self.settings['sftp-connections'] > 0:
+            return self.settings['sftp-connections']
+        return 1
+
+    def _get_window(self):
+        if self.settings and self.settings['sftp-window'] > 0:
+            return self.settings['sftp-window']
+        return self.default_window
+
     def log_stats(self):
         obnamlib.VirtualFileSystem.log_stats(self)
         logging.info(
@@ -186,15 +307,29 @@ class SftpFS(obnamlib.VirtualFileSystem):
         self.create_path_if_missing = False  # only create once
 
     def connect(self):
-        try_openssh = not self.settings or not self.settings['pure-paramiko']
-        if not try_openssh or not self._connect_openssh():
-            self._connect_paramiko()
+        self._pool = SftpConnectionPool(
+            self._open_connection, self._get_max_connections())
         if self.create_path_if_missing:
             self._create_root_if_missing()
         self.chdir('.')
         self._initial_dir = self.getcwd()
         self.chdir(self.path)
 
+    def _open_connection(self):
+        '''Open a new SFTP connection, return it and its transport.
+
+        The transport is None, if the connection goes via an OpenSSH
+        subprocess.
+
+        '''
+
+        try_openssh = not self.settings or not self.settings['pure-paramiko']
+        if try_openssh:
+            sftp = self._connect_openssh()
+            if sftp is not None:
+                return sftp, None
+        return self._connect_paramiko()
+
     def _connect_openssh(self):
         executable = 'ssh'
         args = ['-oForwardX11=no', '-oForwardAgent=no',
@@ -228,34 +363,32 @@ class SftpFS(obnamlib.VirtualFileSystem):
                                     stdout=subprocess.PIPE,
                                     close_fds=True)
         except OSError:
-            return False
+            return None
 
-        self.transport = None
-        self.sftp = paramiko.SFTPClient(SSHChannelAdapter(proc))
-        return True
+        return paramiko.SFTPClient(SSHChannelAdapter(proc))
 
     def _connect_paramiko(self):
         remote = (self.host, self.port or 22)
         logging.debug('connect_paramiko: host=%s port=%s', *remote)
-        self.transport = paramiko.Transport(remote)
-        self.transport.connect()
+        transport = paramiko.Transport(remote)
+        transport.connect()
         logging.debug('connect_paramiko: connected')
         try:
-            self._check_host_key(self.host)
+            self._check_host_key(transport, self.host)
+            logging.debug('connect_paramiko: host key checked')
+            self._authenticate(transport, self.user)
+            logging.debug('connect_paramiko: authenticated')
         except BaseException:
-            self.transport.close()
-            self.transport = None
+            transport.close()
             raise
-        logging.debug('connect_paramiko: host key checked')
-        self._authenticate(self.user)
-        logging.debug('connect_paramiko: authenticated')
-        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+        sftp = paramiko.SFTPClient.from_transport(transport)
         logging.debug('connect_paramiko: end')
+        return sftp, transport
 
-    def _check_host_key(self, hostname):
+    def _check_host_key(self, transport, hostname):
         logging.debug('checking ssh host key for %s', hostname)
 
-        offered_key = self.transport.get_remote_server_key()
+        offered_key = transport.get_remote_server_key()
 
         known_hosts_path = self.settings['ssh-known-hosts']
         known_hosts = paramiko.util.load_host_keys(known_hosts_path)
@@ -283,12 +416,12 @@ class SftpFS(obnamlib.VirtualFileSystem):
 
         logging.debug('Host key for %s OK', hostname)
 
-    def _authenticate(self, username):
+    def _authenticate(self, transport, username):
         if not username:
             username = self._get_username()
         for key in self._find_auth_keys():
             try:
-                self.transport.auth_publickey(username, key)
+                transport.auth_publickey(username, key)
                 return
             except paramiko.SSHException:
                 pass
@@ -315,11 +448,8 @@ class SftpFS(obnamlib.VirtualFileSystem):
 
     def close(self):
         logging.debug('SftpFS.close called')
-        self.sftp.close()
-        self.sftp = None
-        if self.transport:
-            self.transport.close()
-            self.transport = None
+        self._pool.close()
+        self._pool = None
         obnamlib.VirtualFileSystem.close(self)
         self._delay()
 
@@ -341,12 +471,12 @@ class SftpFS(obnamlib.VirtualFileSystem):
 
         self._delay()
 
-        if self.sftp:
+        if self._pool:
             if create:
                 self._create_root_if_missing()
             logging.debug('chdir to %s', path)
-            self.sftp.chdir(self._initial_dir)
-            self.sftp.chdir(path)
+            self._pool.chdir(self._initial_dir)
+            self._pool.chdir(path)
 
     def _get_username(self):
         return pwd.getpwuid(os.getuid()).pw_name
@@ -358,7 +488,8 @@ class SftpFS(obnamlib.VirtualFileSystem):
     @ioerror_to_oserror
     def chdir(self, pathname):
         self._delay()
-        self.sftp.chdir(pathname)
+        self._pool.chdir(pathname)
+        self._known_dirs.clear()
 
     @ioerror_to_oserror
     def listdir(self, pathname):
@@ -463,18 +594,39 @@ class SftpFS(obnamlib.VirtualFileSystem):
     def mkdir(self, pathname, mode=obnamlib.NEW_DIR_MODE):
         self._delay()
         self.sftp.mkdir(pathname, mode)
+        self._known_dirs.add(pathname)
 
     @ioerror_to_oserror
     def makedirs(self, pathname):
         parent = os.path.dirname(pathname)
-        if parent and parent != pathname and not self.exists(parent):
+        if (parent and parent != pathname and
+                parent not in self._known_dirs and not self.exists(parent)):
             self.makedirs(parent)
         self.mkdir(pathname, obnamlib.NEW_DIR_MODE)
 
+    def _makedirs_if_missing(self, pathname):
+        '''Like makedirs, but OK if the directory already exists.'''
+        if pathname and pathname not in self._known_dirs:
+            try:
+                self.makedirs(pathname)
+            except OSError:
+                # We ignore the error, on the assumption that it was
+                # due to the directory already existing. If it didn't
+                # exist and the error was for something else, then
+                # we'll catch that when we create a file in it.
+                pass
+
     @ioerror_to_oserror
     def rmdir(self, pathname):
         self._delay()
         self.sftp.rmdir(pathname)
+        self._forget_known_dirs(pathname)
+
+    def _forget_known_dirs(self, pathname):
+        prefix = pathname + '/'
+        self._known_dirs = set(
+            x for x in self._known_dirs
+            if x != pathname and not x.startswith(prefix))
 
     @ioerror_to_oserror
     def remove(self, pathname):
@@ -494,6 +646,30 @@ class SftpFS(obnamlib.VirtualFileSystem):
         self._delay()
         self._remove_if_exists(new)
         self.sftp.rename(old, new)
+        self._forget_known_dirs(old)
+
+    def _replace(self, old, new):
+        '''Rename a file, atomically replacing any existing file.
+
+        This uses the posix-rename@openssh.com extension, if the
+        server supports it, which does the replacement in one round
+        trip. Otherwise we fall back to removing the old file first.
+
+        '''
+
+        if self._posix_rename_works and hasattr(self.sftp, 'posix_rename'):
+            self._delay()
+            try:
+                self.sftp.posix_rename(old, new)
+                return
+            except IOError as e:
+                if e.errno is not None:
+                    raise
+                if 'unsupported' in str(e).lower():
+                    logging.debug(
+                        'SFTP server lacks posix-rename, not using it')
+                    self._posix_rename_works = False
+        self.rename(old, new)
 
     @ioerror_to_oserror
     def lstat(self, pathname):
@@ -552,10 +728,24 @@ class SftpFS(obnamlib.VirtualFileSystem):
         self._delay()
         return self.sftp.file(pathname, mode, bufsize=bufsize)
 
-    def cat(self, pathname):
+    def _prefetch(self, f):
+        # Ask paramiko to issue read requests for the whole file
+        # without waiting for responses, so the transfer is limited
+        # by bandwidth rather than latency. Older versions of paramiko
+        # don't let us limit the number of outstanding requests.
+        try:
+            f.prefetch(max_concurrent_requests=self._get_window())
+        except TypeError:
+            f.prefetch()
+
+    def open_reader(self, pathname):
         self._delay()
         f = self.open(pathname, 'rb')
-        f.prefetch()
+        self._prefetch(f)
+        return f
+
+    def cat(self, pathname):
+        f = self.open_reader(pathname)
         chunks = []
         while True:
             chunk = f.read(self.chunk_size)
@@ -568,9 +758,16 @@ class SftpFS(obnamlib.VirtualFileSystem):
 
     @ioerror_to_oserror
     def write_file(self, pathname, contents):
+        f = self._open_new_file(pathname)
+        self._write_helper(f, contents)
+        f.close()
+        if os.path.dirname(pathname):
+            self._known_dirs.add(os.path.dirname(pathname))
+
+    def _open_new_file(self, pathname):
         mode = 'wbx'
         try:
-            f = self.open(pathname, mode)
+            return self.open(pathname, mode)
         except (IOError, OSError), e:
             # When the path to the file to be written does not
             # exist, we try to create the directories below. Note that
@@ -582,24 +779,15 @@ class SftpFS(obnamlib.VirtualFileSystem):
                 raise
             dirname = os.path.dirname(pathname)
             self.makedirs(dirname)
-            f = self.open(pathname, mode)
+            return self.open(pathname, mode)
 
-        self._write_helper(f, contents)
-        f.close()
+    @ioerror_to_oserror
+    def open_writer(self, pathname, overwrite=False):
+        return SftpFSWriter(self, pathname, overwrite)
 
     def _tempfile(self, dirname):
         '''Create a new file with a random name, return handle and name.'''
 
-        if dirname:
-            try:
-                self.makedirs(dirname)
-            except OSError:
-                # We ignore the error, on the assumption that it was due
-                # to the directory already existing. If it didn't exist
-                # and the error was for something else, then we'll catch
-                # that when we open the file for writing.
-                pass
-
         # Create a file with a random filename. This is unfortunately
         # a bit tricky, since paramiko doesn't seem to provide enough
         # information in its exceptions as to the cause of the
@@ -607,28 +795,69 @@ class SftpFS(obnamlib.VirtualFileSystem):
         # whether creating a file failed because the file already
         # existed, or the connection to the ssh server was lost. Thus,
         # we try a maximum number of times and give up after that.
+        # If we get an error that clearly isn't about the file
+        # existing, we give up at once.
         #
         # The max try count is chosen arbitrarily. The likelihood of a
         # thousand tries hitting existing files seems to be low enough
         # that it's not worth making this user-settable.
+        #
+        # We don't check that the directory exists first, since it
+        # usually does. Instead, we create it if creating the file
+        # fails, and remember it exists for next time.
 
+        dir_created = not dirname or dirname in self._known_dirs
         max_tries = 1000
         for try_number in range(max_tries):
             i = random.randint(0, 2**64-1)
             basename = 'tmp.%x' % i
             pathname = os.path.join(dirname, basename)
             try:
-                f = self.open(pathname, 'wbx', bufsize=self.chunk_size)
-                # paramiko.SFTPClient doesn't allow setting the mode
-                # on creation, so we set it separately. This leaves a
-                # short window where the file is possible to open.
-                self.chmod_not_symlink(pathname, obnamlib.NEW_FILE_MODE)
-            except (IOError, OSError):
-                if try_number == max_tries - 1:
+                f = self._create_file(pathname, obnamlib.NEW_FILE_MODE)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.ENOENT, errno.EACCES):
+                    # Some SFTP servers return EACCES instead of
+                    # ENOENT when the directory does not exist.
+                    if dir_created:
+                        raise
+                    self._makedirs_if_missing(dirname)
+                    dir_created = True
+                elif try_number == max_tries - 1:
                     raise
             else:
+                if dirname:
+                    self._known_dirs.add(dirname)
                 return f, pathname
 
+    def _create_file(self, pathname, mode):
+        '''Create a new file with the given mode, open it for writing.'''
+
+        self._delay()
+        sftp = self.sftp
+        try:
+            # paramiko.SFTPClient.open doesn't allow setting the mode
+            # on creation, so we send the open request ourselves, with
+            # the mode in its attributes. This uses paramiko internals,
+            # so if they're missing, we fall back to open and chmod.
+            flags = (paramiko.sftp.SFTP_FLAG_WRITE |
+                     paramiko.sftp.SFTP_FLAG_CREATE |
+                     paramiko.sftp.SFTP_FLAG_EXCL)
+            attrs = paramiko.SFTPAttributes()
+            attrs.st_mode = mode
+            request = sftp._request
+            path = sftp._adjust_cwd(pathname)
+        except AttributeError:
+            f = sftp.file(pathname, 'wbx', bufsize=self.chunk_size)
+            self.chmod_not_symlink(pathname, mode)
+            return f
+
+        t, msg = request(paramiko.sftp.CMD_OPEN, path, flags, attrs)
+        if t != paramiko.sftp.CMD_HANDLE:
+            raise paramiko.SFTPError('Expected handle')
+        get_handle = getattr(msg, 'get_binary', None) or msg.get_string
+        return paramiko.SFTPFile(
+            sftp, get_handle(), 'wb', bufsize=self.chunk_size)
+
     @ioerror_to_oserror
     def overwrite_file(self, pathname, contents):
         self._delay()
@@ -636,13 +865,91 @@ class SftpFS(obnamlib.VirtualFileSystem):
         f, tempname = self._tempfile(dirname)
         self._write_helper(f, contents)
         f.close()
-        self.rename(tempname, pathname)
+        self._replace(tempname, pathname)
 
     def _write_helper(self, f, contents):
+        # With pipelining, paramiko sends write requests without
+        # waiting for each to be acknowledged. Any errors are reported
+        # when the file is closed, which the callers always do, or
+        # when we wait for acknowledgements to keep the number of
+        # outstanding requests within the window.
+        f.set_pipelined(True)
+        window = self._get_window()
         for pos in range(0, len(contents), self.chunk_size):
             chunk = contents[pos:pos + self.chunk_size]
             f.write(chunk)
             self.bytes_written += len(chunk)
+            self._wait_for_writes(f, window)
+
+    def _wait_for_writes(self, f, window):
+        '''Wait for acknowledgements until at most window are missing.'''
+
+        # paramiko keeps the outstanding write requests of a file in
+        # a queue, but only waits for them when the file is closed,
+        # or after more than a hundred, if the channel says a reply
+        # can be read at once. We wait for them ourselves, so that
+        # memory use and the amount of unacknowledged data stay
+        # bounded. Older versions of paramiko lack the queue; they
+        # don't pipeline writes.
+        reqs = getattr(f, '_reqs', None)
+        if reqs is None:
+            return
+        while len(reqs) > window:
+            req = reqs.popleft()
+            t, msg = f.sftp._read_response(req)
+            if t != paramiko.sftp.CMD_STATUS:
+                raise paramiko.SFTPError('Expected status')
+
+
+class SftpFSWriter(obnamlib.VfsWriter):
+
+    '''Write a file for SftpFS, sending it to the server as it comes.
+
+    New files are written in place, like SftpFS.write_file does, and
+    replacements are written to a temporary file that is renamed over
+    the old one when the writer is closed, like
+    SftpFS.overwrite_file does.
+
+    '''
+
+    def __init__(self, fs, pathname, overwrite):
+        self._fs = fs
+        self._pathname = pathname
+        self._dirname = os.path.dirname(pathname)
+        fs._delay()
+        if overwrite:
+            self._f, self._tempname = fs._tempfile(self._dirname)
+        else:
+            self._f = fs._open_new_file(pathname)
+            self._tempname = None
+
+    def write(self, data):
+        self._fs._write_helper(self._f, data)
+
+    def close(self):
+        f = self._f
+        self._f = None
+        try:
+            f.close()
+        except (IOError, OSError):
+            self._remove_written()
+            raise
+        if self._tempname is not None:
+            self._fs._replace(self._tempname, self._pathname)
+        elif self._dirname:
+            self._fs._known_dirs.add(self._dirname)
+
+    def abort(self):
+        if self._f is not None:
+            try:
+                self._f.close()
+            except (IOError, OSError):  # pragma: no cover
+                pass
+            self._f = None
+            self._remove_written()
+
+    def _remove_written(self):
+        self._fs._remove_if_exists(self._tempname or self._pathname)
 
 
 class SftpPlugin(obnamlib.ObnamPlugin):
@@ -656,6 +963,22 @@ class SftpPlugin(obnamlib.ObnamPlugin):
             'add an artificial delay (in milliseconds) to all SFTP transfers',
             group=devel_group)
 
+        self.app.settings.integer(
+            ['sftp-window'],
+            'allow up to N outstanding SFTP read or write requests per '
+            'file (default %d); larger values help on links with a '
+            'high latency' % SftpFS.default_window,
+            metavar='N',
+            group=obnamlib.option_group['perf'])
+
+        self.app.settings.integer(
+            ['sftp-connections'],
+            'open up to N SFTP connections to the repository server, '
+            'so that threads using the repository each get their own; '
+            'the default is one',
+            metavar='N',
+            group=obnamlib.option_group['perf'])
+
         self.app.settings.string(
             ['ssh-key'],
             'use FILENAME as the ssh RSA private key for sftp access '
@@ -105,17 +105,19 @@ class ShowPlugin(obnamlib.ObnamPlugin):
         '''List backup generations for client.'''
         self.open_repository()
         client_name = self.app.settings['client-name']
-        for gen_id in self.repo.get_client_generation_ids(client_name):
-            start = self.repo.get_generation_key(
-                gen_id, obnamlib.REPO_GENERATION_STARTED)
-            end = self.repo.get_generation_key(
-                gen_id, obnamlib.REPO_GENERATION_ENDED)
-            is_checkpoint = self.repo.get_generation_key(
-                gen_id, obnamlib.REPO_GENERATION_IS_CHECKPOINT)
-            file_count = self.repo.get_generation_key(
-                gen_id, obnamlib.REPO_GENERATION_FILE_COUNT)
-            data_size = self.repo.get_generation_key(
-                gen_id, obnamlib.REPO_GENERATION_TOTAL_DATA)
+        summaries = self.repo.get_client_generation_summaries(
+            client_name,
+            [obnamlib.REPO_GENERATION_STARTED,
+             obnamlib.REPO_GENERATION_ENDED,
+             obnamlib.REPO_GENERATION_IS_CHECKPOINT,
+             obnamlib.REPO_GENERATION_FILE_COUNT,
+             obnamlib.REPO_GENERATION_TOTAL_DATA])
+        for gen_id, keys in summaries:
+            start = keys[obnamlib.REPO_GENERATION_STARTED]
+            end = keys[obnamlib.REPO_GENERATION_ENDED]
+            is_checkpoint = keys[obnamlib.REPO_GENERATION_IS_CHECKPOINT]
+            file_count = keys[obnamlib.REPO_GENERATION_FILE_COUNT]
+            data_size = keys[obnamlib.REPO_GENERATION_TOTAL_DATA]
 
             if is_checkpoint:
                 checkpoint = ' (checkpoint)'
@@ -144,9 +146,10 @@ class ShowPlugin(obnamlib.ObnamPlugin):
         critical_age = self._convert_time(self.app.settings['critical-age'])
 
         client_name = self.app.settings['client-name']
-        for gen_id in self.repo.get_client_generation_ids(client_name):
-            start = self.repo.get_generation_key(
-                gen_id, obnamlib.REPO_GENERATION_STARTED)
+        summaries = self.repo.get_client_generation_summaries(
+            client_name, [obnamlib.REPO_GENERATION_STARTED])
+        for gen_id, keys in summaries:
+            start = keys[obnamlib.REPO_GENERATION_STARTED]
             if most_recent is None or start > most_recent:
                 most_recent = start
         self.repo.close()
@@ -323,45 +326,13 @@ class ShowPlugin(obnamlib.ObnamPlugin):
         else:
             self.app.output.write('%s %s\n' % (change_char, fullname))
 
-    def show_diff_for_common_file(self, gen_id1, gen_id2, fullname, subdirs):
-        changed = False
-        if self.isdir(gen_id1, fullname) != self.isdir(gen_id2, fullname):
-            changed = True
-        elif self.isdir(gen_id2, fullname):
-            subdirs.append(fullname)
-        else:
-            # Files are both present and neither is a directory.
-            # Compare md5
-            def get_md5(gen_id):
-                return self.repo.get_file_key(
-                    gen_id, fullname, obnamlib.REPO_FILE_MD5)
-            md5_1 = get_md5(gen_id1)
-            md5_2 = get_md5(gen_id2)
-            if md5_1 != md5_2:
-                changed = True
-        if changed:
-            self.show_diff_for_file(gen_id2, fullname, '*')
-
     def show_diff(self, gen_id1, gen_id2, dirname):
-        # This set contains the files from the old/src generation
-        set1 = self.repo.get_file_children(gen_id1, dirname)
-        subdirs = []
-        # These are the new/dst generation files
-        for filename in sorted(self.repo.get_file_children(gen_id2, dirname)):
-            if filename in set1:
-                # Its in both generations
-                set1.remove(filename)
-                self.show_diff_for_common_file(
-                    gen_id1, gen_id2, filename, subdirs)
+        for change_char, filename in self.repo.diff_generations(
+                gen_id1, gen_id2, dirname):
+            if change_char == '-':
+                self.show_diff_for_file(gen_id1, filename, change_char)
             else:
-                # Its only in set2 - the file/dir got added
-                self.show_diff_for_file(gen_id2, filename, '+')
-        for filename in sorted(set1):
-            # This was only in gen1 - it got removed
-            self.show_diff_for_file(gen_id1, filename, '-')
-
-        for subdir in subdirs:
-            self.show_diff(gen_id1, gen_id2, subdir)
+                self.show_diff_for_file(gen_id2, filename, change_char)
 
     def diff(self, args):
         '''Show difference between two generations.'''
@@ -14,6 +14,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+import hashlib
 import logging
 import os
 import random
@@ -34,6 +36,138 @@ class Fail(obnamlib.ObnamError):
     msg = '{filename}: {reason}'
 
 
+class FileVerifier(object):
+
+    '''Compare backed up files with live data.
+
+    A FileVerifier has a repository and a live filesystem of its own,
+    so that several of them can run at once, in different threads.
+
+    '''
+
+    def __init__(self, repo, fs, read_ahead, by_checksum):
+        self.repo = repo
+        self.fs = fs
+        self.read_ahead = read_ahead
+        self.by_checksum = by_checksum
+
+    def close(self):
+        self.fs.close()
+        self.repo.close()
+
+    def verify(self, filename, metadata, chunkids):
+        '''Verify a file.
+
+        Return a Fail exception for the first problem found, or None,
+        and the number of bytes of file data compared.
+
+        '''
+
+        try:
+            self.verify_metadata(filename, metadata)
+            if stat.S_ISREG(metadata.st_mode):
+                return None, self.verify_regular_file(
+                    filename, metadata, chunkids)
+        except Fail, e:
+            return e, 0
+        return None, 0
+
+    def verify_metadata(self, filename, metadata):
+        try:
+            live_data = obnamlib.read_metadata(self.fs, filename)
+        except OSError, e:
+            raise Fail(
+                filename=filename,
+                reason='missing or inaccessible: %s' % e.strerror)
+
+        def X(key, field_name):
+            v1 = getattr(metadata, field_name)
+            v2 = getattr(live_data, field_name)
+            # obnamlib.Metadata stores some fields as None, but
+            # RepositoryInterface returns 0 or '' instead. Convert
+            # the value from obnamlib.Metadata accordingly, for comparison.
+            if key in obnamlib.REPO_FILE_INTEGER_KEYS:
+                v2 = v2 or 0
+            else:
+                v2 = v2 or ''
+            if v1 != v2:
+                raise Fail(
+                    filename=filename,
+                    reason='metadata change: %s (%s vs %s)' %
+                    (field_name, repr(v1), repr(v2)))
+
+        X(obnamlib.REPO_FILE_MODE, 'st_mode')
+        X(obnamlib.REPO_FILE_MTIME_SEC, 'st_mtime_sec')
+        X(obnamlib.REPO_FILE_MTIME_NSEC, 'st_mtime_nsec')
+        X(obnamlib.REPO_FILE_NLINK, 'st_nlink')
+        X(obnamlib.REPO_FILE_GROUPNAME, 'groupname')
+        X(obnamlib.REPO_FILE_USERNAME, 'username')
+        X(obnamlib.REPO_FILE_SYMLINK_TARGET, 'target')
+        X(obnamlib.REPO_FILE_XATTR_BLOB, 'xattr')
+
+    def verify_regular_file(self, filename, metadata, chunkids):
+        logging.debug('verifying regular %s', filename)
+        f = self.fs.open(filename, 'r')
+        try:
+            if self.by_checksum and metadata.md5:
+                return self.verify_checksum(filename, f, metadata.md5)
+
+            num_bytes = self.verify_chunks(f, chunkids)
+            if num_bytes is None:
+                raise Fail(filename=filename, reason='data changed')
+
+            data = f.read(1)
+            if data:
+                raise Fail(
+                    filename=filename, reason='more data at end of file')
+            return num_bytes
+        finally:
+            f.close()
+
+    def verify_checksum(self, filename, f, md5):
+        summer = hashlib.md5()
+        num_bytes = 0
+        while True:
+            data = f.read(obnamlib.DEFAULT_CHUNK_SIZE)
+            if not data:
+                break
+            summer.update(data)
+            num_bytes += len(data)
+        if summer.digest() != md5:
+            raise Fail(filename=filename, reason='data changed')
+        return num_bytes
+
+    def verify_chunks(self, f, chunkids):
+        '''Compare file data with chunks.
+
+        Return number of bytes compared, or None if there was a
+        difference.
+
+        '''
+
+        if self.read_ahead > 0 and len(chunkids) > 1:
+            contents = obnamlib.ChunkReadAhead(
+                self.repo, chunkids, self.read_ahead)
+        else:
+            contents = None
+
+        try:
+            num_bytes = 0
+            for backed_up in contents or self.fetch_chunks(chunkids):
+                live_data = f.read(len(backed_up))
+                num_bytes += len(backed_up)
+                if backed_up != live_data:
+                    return None
+            return num_bytes
+        finally:
+            if contents is not None:
+                contents.close()
+
+    def fetch_chunks(self, chunkids):
+        for chunkid in chunkids:
+            yield self.repo.get_chunk_content(chunkid)
+
+
 class VerifyPlugin(obnamlib.ObnamPlugin):
 
     def enable(self):
@@ -44,6 +178,23 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
             'verify N files randomly from the backup '
             '(default is zero, meaning everything)',
             metavar='N')
+        self.app.settings.integer(
+            ['verify-jobs'],
+            'verify N files at once, each in a thread with connections '
+            'to the repository and live data of its own',
+            metavar='N',
+            default=1)
+        self.app.settings.integer(
+            ['verify-read-ahead'],
+            'fetch up to N chunks of a file from the repository while '
+            'reading the live data; set to 0 to disable',
+            metavar='N',
+            default=4)
+        self.app.settings.boolean(
+            ['verify-by-checksum'],
+            'compare live file data with the checksum stored at backup '
+            'time, instead of fetching the backed up data; this is '
+            'faster, but does not read the data in the repository')
 
     def verify(self, args):
         '''Verify that live data and backed up data match.'''
@@ -65,13 +216,11 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
 
         self.repo = self.app.get_repository_object()
         client_name = self.app.settings['client-name']
-        self.fs = self.app.fsf.new(args[0])
-        self.fs.connect()
         t = urlparse.urlparse(args[0])
         root_url = urlparse.urlunparse((t[0], t[1], '/', t[3], t[4], t[5]))
         logging.debug('t: %s', repr(t))
         logging.debug('root_url: %s', repr(root_url))
-        self.fs.reinit(root_url)
+        self.fs = self.open_live_fs(args[0], root_url)
 
         self.failed = False
         gen_id = self.repo.interpret_generation_spec(
@@ -91,6 +240,8 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
                 '%PercentDone(done_bytes,total_bytes): '
                 '%Pathname(filename)')
 
+        self.start_workers(args[0], root_url)
+
         num_randomly = self.app.settings['verify-randomly']
         if num_randomly == 0:
             self.app.ts['total'] = \
@@ -99,31 +250,16 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
             self.app.ts['total_bytes'] = \
                 self.repo.get_generation_key(
                     gen_id, obnamlib.REPO_GENERATION_TOTAL_DATA)
-            for filename in self.walk(gen_id, args):
-                self.app.ts['filename'] = filename
-                try:
-                    self.verify_metadata(gen_id, filename)
-                except Fail, e:
-                    self.log_fail(e)
-                else:
-                    mode = self.repo.get_file_key(
-                        gen_id, filename, obnamlib.REPO_FILE_MODE)
-                    if stat.S_ISREG(mode):
-                        try:
-                            self.verify_regular_file(gen_id, filename)
-                        except Fail, e:
-                            self.log_fail(e)
-                self.app.ts['done'] += 1
+            for filename, metadata, chunkids in self.walk(gen_id, args):
+                self.verify_file(filename, metadata, chunkids)
         else:
             logging.debug('verifying %d files randomly', num_randomly)
             self.app.ts['total'] = num_randomly
             self.app.ts.notify('finding all files to choose randomly')
 
             filenames = []
-            for filename in self.walk(gen_id, args):
-                mode = self.repo.get_file_key(
-                    gen_id, filename, obnamlib.REPO_FILE_MODE)
-                if stat.S_ISREG(mode):
+            for filename, metadata, _ in self.walk(gen_id, args):
+                if stat.S_ISREG(metadata.st_mode):
                     filenames.append(filename)
 
             chosen = []
@@ -132,13 +268,12 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
                 filenames.remove(filename)
                 chosen.append(filename)
             for filename in chosen:
-                self.app.ts['filename'] = filename
-                try:
-                    self.verify_metadata(gen_id, filename)
-                    self.verify_regular_file(gen_id, filename)
-                except Fail, e:
-                    self.log_fail(e)
-                self.app.ts['done'] += 1
+                metadata = self.repo.get_metadata_from_file_keys(
+                    gen_id, filename)
+                chunkids = self.repo.get_file_chunk_ids(gen_id, filename)
+                self.verify_file(filename, metadata, chunkids)
+
+        self.stop_workers()
 
         self.fs.close()
         self.repo.close()
@@ -148,6 +283,74 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
             sys.exit(1)
         print "Verify did not find problems."
 
+    def open_live_fs(self, url, root_url):
+        fs = self.app.fsf.new(url)
+        fs.connect()
+        fs.reinit(root_url)
+        return fs
+
+    def new_verifier(self, repo, fs):
+        return FileVerifier(
+            repo, fs,
+            self.app.settings['verify-read-ahead'],
+            self.app.settings['verify-by-checksum'])
+
+    # With --verify-jobs, files are verified by a pool of worker
+    # threads, each with a FileVerifier of its own. Results are
+    # reported in the order the files were found, so the output does
+    # not depend on how long each file takes. self.pending holds the
+    # filename and WorkerPoolJob of each file not yet reported.
+
+    def start_workers(self, url, root_url):
+        self.verifier = self.new_verifier(self.repo, self.fs)
+        self.worker_verifiers = []
+        self.pending = collections.deque()
+        self.pool = None
+        jobs = self.app.settings['verify-jobs']
+        if jobs > 1:
+            self.worker_verifiers = [
+                self.new_verifier(
+                    self.app.get_repository_object(spool=False),
+                    self.open_live_fs(url, root_url))
+                for i in range(jobs)]
+            self.pool = obnamlib.WorkerPool(self.worker_verifiers)
+
+    def stop_workers(self):
+        while self.pending:
+            self.report_first()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        for verifier in self.worker_verifiers:
+            verifier.close()
+        self.worker_verifiers = []
+
+    def verify_file(self, filename, metadata, chunkids):
+        self.app.ts['filename'] = filename
+        if self.pool is None:
+            self.report(filename, self.verifier.verify(
+                filename, metadata, chunkids))
+            return
+
+        job = self.pool.submit(
+            FileVerifier.verify, filename, metadata, chunkids)
+        self.pending.append((filename, job))
+        while len(self.pending) > 4 * len(self.pool):
+            self.report_first()
+        while self.pending and self.pending[0][1].done():
+            self.report_first()
+
+    def report_first(self):
+        filename, job = self.pending.popleft()
+        self.report(filename, job.result())
+
+    def report(self, filename, result):
+        fail, num_bytes = result
+        if fail is not None:
+            self.log_fail(fail)
+        self.app.ts['done'] += 1
+        self.app.ts['done_bytes'] += num_bytes
+
     def log_fail(self, e):
         msg = 'verify failure: %s' % str(e)
         logging.error(msg)
@@ -157,71 +360,16 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
             self.app.ts.notify(msg)
         self.failed = True
 
-    def verify_metadata(self, gen_id, filename):
-        try:
-            live_data = obnamlib.read_metadata(self.fs, filename)
-        except OSError, e:
-            raise Fail(
-                filename=filename,
-                reason='missing or inaccessible: %s' % e.strerror)
-
-        def X(key, field_name):
-            v1 = self.repo.get_file_key(gen_id, filename, key)
-            v2 = getattr(live_data, field_name)
-            # obnamlib.Metadata stores some fields as None, but
-            # RepositoryInterface returns 0 or '' instead. Convert
-            # the value from obnamlib.Metadata accordingly, for comparison.
-            if key in obnamlib.REPO_FILE_INTEGER_KEYS:
-                v2 = v2 or 0
-            else:
-                v2 = v2 or ''
-            if v1 != v2:
-                raise Fail(
-                    filename=filename,
-                    reason='metadata change: %s (%s vs %s)' %
-                    (field_name, repr(v1), repr(v2)))
-
-        X(obnamlib.REPO_FILE_MODE, 'st_mode')
-        X(obnamlib.REPO_FILE_MTIME_SEC, 'st_mtime_sec')
-        X(obnamlib.REPO_FILE_MTIME_NSEC, 'st_mtime_nsec')
-        X(obnamlib.REPO_FILE_NLINK, 'st_nlink')
-        X(obnamlib.REPO_FILE_GROUPNAME, 'groupname')
-        X(obnamlib.REPO_FILE_USERNAME, 'username')
-        X(obnamlib.REPO_FILE_SYMLINK_TARGET, 'target')
-        X(obnamlib.REPO_FILE_XATTR_BLOB, 'xattr')
-
-    def verify_regular_file(self, gen_id, filename):
-        logging.debug('verifying regular %s', filename)
-        f = self.fs.open(filename, 'r')
-
-        chunkids = self.repo.get_file_chunk_ids(gen_id, filename)
-        if not self.verify_chunks(f, chunkids):
-            raise Fail(filename=filename, reason='data changed')
-
-        data = f.read(1)
-        if data:
-            raise Fail(filename=filename, reason='more data at end of file')
-
-        f.close()
-
-    def verify_chunks(self, f, chunkids):
-        for chunkid in chunkids:
-            backed_up = self.repo.get_chunk_content(chunkid)
-            live_data = f.read(len(backed_up))
-            self.app.ts['done_bytes'] += len(backed_up)
-            if backed_up != live_data:
-                return False
-        return True
-
     def walk(self, gen_id, args):
-        '''Iterate over each pathname specified by arguments.
+        '''Iterate over each file specified by arguments.
 
-        This is a generator.
+        This is a generator. Each return value is a tuple of pathname,
+        metadata, and chunk ids, as from walk_generation_files.
 
         '''
 
         for arg in args:
             _, _, path, _, _ = urlparse.urlsplit(arg)
             arg = os.path.normpath(path)
-            for x in self.repo.walk_generation(gen_id, arg):
+            for x in self.repo.walk_generation_files(gen_id, arg):
                 yield x
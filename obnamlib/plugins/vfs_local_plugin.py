@@ -20,4 +20,16 @@ import obnamlib
 class VfsLocalPlugin(obnamlib.ObnamPlugin):
 
     def enable(self):
-        self.app.fsf.register('', obnamlib.LocalFS)
+        self.app.settings.choice(
+            ['local-fsync'],
+            list(obnamlib.LocalFS.fsync_modes),
+            'when to flush files written to a local repository to '
+            'disk: "never" leaves it to the operating system, '
+            '"group" flushes everything written at once when '
+            'committing changes, and "always" flushes every '
+            'file as soon as it is written',
+            metavar='MODE',
+            group=obnamlib.option_group['perf'])
+
+        self.app.fsf.register(
+            '', obnamlib.LocalFS, settings=self.app.settings)
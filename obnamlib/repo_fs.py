@@ -16,7 +16,11 @@
 # =*= License: GPL-3+ =*=
 
 
+import collections
+import errno
 import os
+import sys
+import threading
 
 import tracing
 
@@ -39,11 +43,22 @@ class RepositoryFS(object):
 
     '''
 
+    # How much to read from the underlying VFS at a time.
+    piece_size = 1024**2
+
     def __init__(self, repo, fs, hooks):
         self.repo = repo
         self.fs = fs
         self.hooks = hooks
 
+        # Over a network, every existence check is a round trip. We
+        # remember what we've learnt about what exists, and keep it up
+        # to date with our own changes. Other processes may only change
+        # things while holding a lock, so we forget everything whenever
+        # we take or release one.
+        self._known_toplevels = set()
+        self._exists_cache = {}
+
     def _get_toplevel(self, filename):
         parts = filename.split(os.sep)
         if len(parts) >= 1:
@@ -51,14 +66,51 @@ class RepositoryFS(object):
         else:  # pragma: no cover
             raise ToplevelIsFileError(filename=filename)
 
+    def clear_cache(self):
+        self._known_toplevels.clear()
+        self._exists_cache.clear()
+
+    def _is_lock_file(self, filename):
+        # Lock files come and go whenever other processes want, so
+        # we never cache whether they exist.
+        return os.path.basename(filename) == 'lock'
+
+    def _remember_exists(self, filename, exists):
+        filename = os.path.normpath(filename)
+        if not self._is_lock_file(filename):
+            self._exists_cache[filename] = exists
+        if exists:
+            # Parent directories obviously exist, too.
+            dirname = os.path.dirname(filename)
+            while dirname and dirname not in ('.', os.sep):
+                self._exists_cache[dirname] = True
+                dirname = os.path.dirname(dirname)
+
+    def _forget_tree(self, dirname):
+        dirname = os.path.normpath(dirname)
+        prefix = dirname + os.sep
+        for key in self._exists_cache.keys():
+            if key.startswith(prefix):
+                del self._exists_cache[key]
+        self._known_toplevels.discard(dirname)
+
     def exists(self, filename):
-        return self.fs.exists(filename)
+        key = os.path.normpath(filename)
+        if key in self._exists_cache:
+            return self._exists_cache[key]
+        exists = self.fs.exists(filename)
+        self._remember_exists(filename, exists)
+        return exists
 
     def lock(self, lockname):
-        return self.fs.lock(lockname)
+        result = self.fs.lock(lockname)
+        self.clear_cache()
+        return result
 
     def unlock(self, lockname):
-        return self.fs.unlock(lockname)
+        result = self.fs.unlock(lockname)
+        self.clear_cache()
+        return result
 
     def lstat(self, lockname):
         return self.fs.lstat(lockname)
@@ -67,16 +119,25 @@ class RepositoryFS(object):
         return self.fs.scan_tree(dirname)
 
     def remove(self, filename):
-        return self.fs.remove(filename)
+        result = self.fs.remove(filename)
+        self._remember_exists(filename, False)
+        return result
 
     def mkdir(self, dirname):
-        return self.fs.mkdir(dirname)
+        result = self.fs.mkdir(dirname)
+        self._remember_exists(dirname, True)
+        return result
 
     def makedirs(self, dirname):
-        return self.fs.makedirs(dirname)
+        result = self.fs.makedirs(dirname)
+        self._remember_exists(dirname, True)
+        return result
 
     def rmdir(self, dirname):
-        return self.fs.rmdir(dirname)
+        result = self.fs.rmdir(dirname)
+        self._forget_tree(dirname)
+        self._remember_exists(dirname, False)
+        return result
 
     def listdir(self, dirname):
         return self.fs.listdir(dirname)
@@ -85,22 +146,95 @@ class RepositoryFS(object):
         return self.fs.isdir(dirname)
 
     def rename(self, old_name, new_name):
-        return self.fs.rename(old_name, new_name)
+        result = self.fs.rename(old_name, new_name)
+        self._forget_tree(old_name)
+        self._forget_tree(new_name)
+        self._remember_exists(old_name, False)
+        self._remember_exists(new_name, True)
+        return result
 
     def cat(self, filename, runfilters=True):
-        data = self.fs.cat(filename)
-        if not runfilters:  # pragma: no cover
-            return data
-        toplevel = self._get_toplevel(filename)
-        return self.hooks.filter_read('repository-data', data,
-                                      repo=self.repo, toplevel=toplevel)
+        f = self.open_reader(filename, runfilters=runfilters)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def open_reader(self, filename, runfilters=True):
+        '''Open a file for reading, with read filters applied.
+
+        Return a file-like object. The file is read, and filtered,
+        piece by piece as the object is read from, so the whole file
+        never needs to be in memory at once.
+
+        '''
+
+        f = self.fs.open_reader(filename)
+        self._remember_exists(filename, True)
+        pieces = self._read_pieces(f)
+        if runfilters:
+            toplevel = self._get_toplevel(filename)
+            pieces = self.hooks.filter_read_stream(
+                'repository-data', pieces, repo=self.repo, toplevel=toplevel)
+        return obnamlib.PieceReader(pieces, close=f.close)
+
+    def _read_pieces(self, f):
+        while True:
+            data = f.read(self.piece_size)
+            if not data:
+                break
+            self.fs.bytes_read += len(data)
+            yield data
+
+    def open_reader_if_exists(self, filename, runfilters=True):
+        '''Like open_reader, but return None if the file doesn't exist.'''
+
+        key = os.path.normpath(filename)
+        if self._exists_cache.get(key) is False:
+            return None
+        try:
+            return self.open_reader(filename, runfilters=runfilters)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._remember_exists(filename, False)
+            return None
+
+    def open_writer(self, filename, overwrite=False, runfilters=True):
+        '''Return a VfsWriter for a file, with write filters applied.
+
+        The data is filtered and written out piece by piece, as it is
+        given, so the whole file never needs to be in memory at once.
+
+        '''
+
+        return RepositoryFSWriter(self, filename, overwrite, runfilters)
+
+    def cat_if_exists(self, filename, runfilters=True):
+        '''Like cat, but return None if the file doesn't exist.
+
+        This avoids a separate check for existence before reading
+        the file.
+
+        '''
+
+        f = self.open_reader_if_exists(filename, runfilters=runfilters)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
 
     def create_and_init_toplevel(self, filename):
         tracing.trace('filename=%s', filename)
         toplevel = self._get_toplevel(filename)
-        if not self.fs.exists(toplevel):
-            self.fs.mkdir(toplevel)
+        if toplevel in self._known_toplevels:
+            return
+        if not self.exists(toplevel):
+            self.mkdir(toplevel)
             self.hooks.call('repository-toplevel-init', self.repo, toplevel)
+        self._known_toplevels.add(toplevel)
 
     def write_file(self, filename, data, runfilters=True):
         toplevel = self._get_toplevel(filename)
@@ -108,6 +242,7 @@ class RepositoryFS(object):
             data = self.hooks.filter_write('repository-data', data,
                                            repo=self.repo, toplevel=toplevel)
         self.fs.write_file(filename, data)
+        self._remember_exists(filename, True)
 
     def overwrite_file(self, filename, data, runfilters=True):
         toplevel = self._get_toplevel(filename)
@@ -115,6 +250,104 @@ class RepositoryFS(object):
             data = self.hooks.filter_write('repository-data', data,
                                            repo=self.repo, toplevel=toplevel)
         self.fs.overwrite_file(filename, data)
+        self._remember_exists(filename, True)
+
+    def sync(self):
+        return self.fs.sync()
+
+
+class RepositoryFSWriter(obnamlib.VfsWriter):
+
+    '''Write a file via RepositoryFS, with write filters applied.
+
+    The write filters take their input as an iterator, so they run in
+    a background thread, which is fed each piece as it is written.
+    Only a few pieces are queued up at a time, and writing waits
+    until the filters catch up.
+
+    '''
+
+    max_queued = 4
+
+    def __init__(self, repofs, filename, overwrite, runfilters):
+        self._repofs = repofs
+        self._filename = filename
+        self._writer = repofs.fs.open_writer(filename, overwrite=overwrite)
+        self._queue = collections.deque()
+        self._ended = False
+        self._done = False
+        self._exc_info = None
+        self._cond = threading.Condition()
+        self._thread = None
+        if runfilters:
+            self._thread = threading.Thread(target=self._filter_pieces)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _queued_pieces(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._ended:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                piece = self._queue.popleft()
+                self._cond.notify_all()
+            yield piece
+
+    def _filter_pieces(self):
+        repofs = self._repofs
+        try:
+            toplevel = repofs._get_toplevel(self._filename)
+            for piece in repofs.hooks.filter_write_stream(
+                    'repository-data', self._queued_pieces(),
+                    repo=repofs.repo, toplevel=toplevel):
+                self._writer.write(piece)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _raise_filter_error(self):
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+
+    def write(self, data):
+        if self._thread is None:
+            self._writer.write(data)
+            return
+        with self._cond:
+            while len(self._queue) >= self.max_queued and not self._done:
+                self._cond.wait()
+            if not self._done:
+                self._queue.append(data)
+                self._cond.notify_all()
+        self._raise_filter_error()
+
+    def _finish_filtering(self):
+        if self._thread is not None:
+            with self._cond:
+                self._ended = True
+                self._cond.notify_all()
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        try:
+            self._finish_filtering()
+            self._raise_filter_error()
+        except BaseException:
+            self._writer.abort()
+            raise
+        self._writer.close()
+        self._repofs._remember_exists(self._filename, True)
+
+    def abort(self):
+        self._finish_filtering()
+        self._writer.abort()
 
 
 class ToplevelIsFileError(obnamlib.ObnamError):
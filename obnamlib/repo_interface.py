@@ -20,6 +20,7 @@
 
 import os
 import stat
+import sys
 import unittest
 
 import obnamlib
@@ -629,6 +630,41 @@ class RepositoryInterface(object):
         '''Set a key/value pair for a given generation.'''
         raise NotImplementedError()
 
+    def get_client_generation_summaries(self, client_name, keys=None):
+        '''Return the generations of a client, with some of their keys.
+
+        The return value is a list of (generation id, dict) pairs, in
+        the same order as from get_client_generation_ids. Each dict
+        maps each of the given generation keys to its value, as
+        returned by get_generation_key. If keys is None, every allowed
+        generation key, except the test key, is included. Callers
+        should give just the keys they use, since some formats look
+        up each key separately.
+
+        Listing generations, or checking how old the latest one is,
+        should use this instead of calling get_generation_key for each
+        key of each generation: a format can usually read the keys of
+        all generations at once, without loading any file metadata.
+
+        Sub-classes do not need to define this method; the base class
+        provides a generic implementation, which looks up each key
+        separately.
+
+        '''
+
+        keys = self._get_generation_summary_keys(keys)
+        return [
+            (gen_id,
+             dict((key, self.get_generation_key(gen_id, key)) for key in keys))
+            for gen_id in self.get_client_generation_ids(client_name)]
+
+    def _get_generation_summary_keys(self, keys):
+        if keys is not None:
+            return keys
+        return [
+            key for key in self.get_allowed_generation_keys()
+            if key != obnamlib.REPO_GENERATION_TEST_KEY]
+
     def remove_generation(self, generation_id):
         '''Remove an existing generation.
 
@@ -637,6 +673,18 @@ class RepositoryInterface(object):
         '''
         raise NotImplementedError()
 
+    def remove_generations(self, generation_ids):
+        '''Remove several existing generations at once.
+
+        This is the same as calling remove_generation for each
+        generation in turn, but lets the implementation do the work
+        that is common to all of them, such as finding out which
+        chunks become unused, only once.
+
+        '''
+        for generation_id in generation_ids:
+            self.remove_generation(generation_id)
+
     def get_generation_chunk_ids(self, generation_id):
         '''Return list of chunk ids used by a generation.
 
@@ -765,12 +813,32 @@ class RepositoryInterface(object):
         '''Clear the list of chunk ids for a file.'''
         raise NotImplementedError()
 
-    def append_file_chunk_id(self, generation_id, filename, chunk_id):
+    def get_file_chunk_sizes(self, generation_id, filename):
+        '''Get the list of chunk sizes for a file.
+
+        The list is parallel to the one returned by get_file_chunk_ids.
+        If the sizes are not known for every chunk (the repository
+        format doesn't store them, or the file was backed up by an
+        older version), None is returned instead, and the caller needs
+        to find out the sizes from the chunks themselves.
+
+        Sub-classes do not need to define this method; the base class
+        provides an implementation that always returns None.
+
+        '''
+
+        return None
+
+    def append_file_chunk_id(self, generation_id, filename, chunk_id,
+                             chunk_size=None):
         '''Add a chunk id for a file.
 
         The chunk id is added to the end of the list of chunk ids,
         so file data ordering is preserved..
 
+        The size of the chunk may be given as well, for formats that
+        store it (see get_file_chunk_sizes).
+
         '''
         raise NotImplementedError()
 
@@ -785,27 +853,161 @@ class RepositoryInterface(object):
         '''
         raise NotImplementedError()
 
-    def walk_generation(self, gen_id, dirname):  # pragma: no cover
+    def list_directory(self, generation_id, dirname):
+        '''List contents of a directory, and which are directories.
+
+        This returns a list of (pathname, is_dir) pairs, one for each
+        child of the given directory, in the same order as
+        get_file_children returns them. is_dir is true if the child's
+        REPO_FILE_MODE is that of a directory.
+
+        Sub-classes do not need to define this method; the base class
+        provides a generic implementation, which looks up the mode of
+        each child separately. A format that keeps a directory's
+        children together should look them up all at once.
+
+        '''
+
+        return [
+            (pathname, stat.S_ISDIR(self.get_file_key(
+                generation_id, pathname, obnamlib.REPO_FILE_MODE)))
+            for pathname in self.get_file_children(generation_id, dirname)]
+
+    def get_directory_metadata(self, generation_id, dirname):
+        '''Return the metadata of each child of a directory.
+
+        This returns a list of (pathname, metadata) pairs, one for
+        each child of the given directory, in the same order as
+        get_file_children returns them. Each metadata is what
+        get_metadata_from_file_keys returns for the child.
+
+        Sub-classes do not need to define this method; the base class
+        provides a generic implementation, which looks up each child
+        separately. A format that keeps a directory's children
+        together should look them up all at once.
+
+        '''
+
+        return [
+            (pathname,
+             self.get_metadata_from_file_keys(generation_id, pathname))
+            for pathname in self.get_file_children(generation_id, dirname)]
+
+    def walk_generation(self, gen_id, dirname, depth_first=True):
         '''Like os.walk, but for a generation.
 
         This is a generator. Each return value is a pathname.
         Directories are recursed into. If depth_first is set to
-        Children of a directory are returned before the directory
-        itself.
+        True (the default), children of a directory are returned
+        before the directory itself; otherwise the directory is
+        returned first.
 
         Sub-classes do not need to define this method; the base
         class provides a generic implementation.
 
         '''
 
+        # The walk uses an explicit stack rather than recursion, so
+        # that deep trees cost neither a generator per level, nor
+        # passing every pathname up through all of them. The stack
+        # holds (pathname, is_dir, done) tuples, where done is true
+        # for directories whose children have already been pushed.
+        # Whether the children of a directory are directories comes
+        # from list_directory, which a format can do in bulk.
+
         arg = os.path.normpath(dirname)
-        mode = self.get_file_key(gen_id, dirname, obnamlib.REPO_FILE_MODE)
-        if stat.S_ISDIR(mode):
-            kidpaths = self.get_file_children(gen_id, dirname)
-            for kp in kidpaths:
-                for x in self.walk_generation(gen_id, kp):
-                    yield x
-        yield arg
+        mode = self.get_file_key(gen_id, arg, obnamlib.REPO_FILE_MODE)
+        stack = [(arg, stat.S_ISDIR(mode), False)]
+        while stack:
+            pathname, is_dir, done = stack.pop()
+            if done or not is_dir:
+                yield pathname
+                continue
+
+            kids = self.list_directory(gen_id, pathname)
+            if depth_first:
+                stack.append((pathname, is_dir, True))
+            else:
+                yield pathname
+            for kp, kid_is_dir in reversed(kids):
+                stack.append((kp, kid_is_dir, False))
+
+    def walk_generation_files(self, generation_id, dirname):
+        '''Like walk_generation, but also give each file's keys and chunks.
+
+        This is a generator. Each return value is a tuple of pathname,
+        an obnamlib.Metadata as returned by get_metadata_from_file_keys,
+        and the list of chunk ids as returned by get_file_chunk_ids.
+        Files come in the same order as from walk_generation.
+
+        Anything that needs the keys for every file in a generation,
+        or a subtree of it, should use this instead of calling
+        get_file_key for each key of each file: a format can usually
+        get everything about a file in one lookup, and everything
+        about a directory's files at once.
+
+        Sub-classes do not need to define this method; the base class
+        provides a generic implementation, which looks up each file
+        separately.
+
+        '''
+
+        for pathname in self.walk_generation(generation_id, dirname):
+            metadata = self.get_metadata_from_file_keys(
+                generation_id, pathname)
+            chunk_ids = self.get_file_chunk_ids(generation_id, pathname)
+            yield pathname, metadata, chunk_ids
+
+    def diff_generations(self, gen_id1, gen_id2, dirname):
+        '''Find what has changed in a directory between two generations.
+
+        This is a generator. Each return value is a tuple of a change
+        character and a pathname. The change is '+' for a file that
+        is only in gen_id2, '-' for one only in gen_id1, and '*' for
+        one that is in both, but is a directory in only one of them,
+        or is not a directory and has a different REPO_FILE_MD5.
+        Directories in both are compared recursively.
+
+        For each directory, the added and changed files come first,
+        sorted by pathname, then the removed files, sorted, and then
+        the contents of the subdirectories in both generations.
+
+        Sub-classes do not need to define this method; the base class
+        provides a generic implementation, which looks up each file in
+        both generations separately. A format that can tell that a
+        subtree has not changed, without looking at its files, should
+        skip it.
+
+        '''
+
+        def isdir(gen_id, pathname):
+            mode = self.get_file_key(
+                gen_id, pathname, obnamlib.REPO_FILE_MODE)
+            return stat.S_ISDIR(mode)
+
+        def get_md5(gen_id, pathname):
+            return self.get_file_key(gen_id, pathname, obnamlib.REPO_FILE_MD5)
+
+        stack = [dirname]
+        while stack:
+            dir_path = stack.pop()
+            old = set(self.get_file_children(gen_id1, dir_path))
+            subdirs = []
+            for pathname in sorted(self.get_file_children(gen_id2, dir_path)):
+                if pathname not in old:
+                    yield '+', pathname
+                    continue
+                old.remove(pathname)
+                is_dir = isdir(gen_id2, pathname)
+                if isdir(gen_id1, pathname) != is_dir:
+                    yield '*', pathname
+                elif is_dir:
+                    subdirs.append(pathname)
+                elif get_md5(gen_id1, pathname) != get_md5(gen_id2, pathname):
+                    yield '*', pathname
+            for pathname in sorted(old):
+                yield '-', pathname
+            stack.extend(reversed(subdirs))
 
     # Chunks.
 
@@ -829,6 +1031,19 @@ class RepositoryInterface(object):
         '''Generate all chunk ids in repository.'''
         raise NotImplementedError()
 
+    def get_pending_chunk_ids(self):
+        '''Return the chunks that are waiting to be removed.
+
+        Such chunks are no longer in the chunk indexes, and no
+        generation uses them, but they are kept until every backup
+        that might have found them has finished. See register_backup.
+
+        The default implementation returns an empty list, which is
+        fine for a format that removes no chunks later.
+
+        '''
+        return []
+
     def flush_chunks(self):
         '''Write any pending new chunks to repository.'''
         raise NotImplementedError()
@@ -842,6 +1057,22 @@ class RepositoryInterface(object):
         '''
         raise NotImplementedError()
 
+    def register_backup(self, client_name):
+        '''Tell the repository a backup for a client is starting.
+
+        A backup looks up chunks it can re-use in the chunk indexes,
+        but only adds its use of them to the indexes when it commits.
+        Registering the backup stops chunks the backup may have found
+        from being removed, even if the chunk indexes say nobody uses
+        them, for as long as the client stays locked. The chunk
+        indexes must be locked, and the registration committed, before
+        the backup looks up any chunks.
+
+        The default implementation does nothing, which is fine for a
+        format that doesn't remove chunks.
+
+        '''
+
     def lock_chunk_indexes(self):
         '''Locks chunk indexes for updates.'''
         raise NotImplementedError()
@@ -910,6 +1141,35 @@ class RepositoryInterface(object):
         '''
         raise NotImplementedError()
 
+    def queue_chunks_for_indexes(self, chunks, client_name):
+        '''Arrange for chunks to be put into the chunk indexes.
+
+        chunks is a list of (chunk_id, token) pairs, as they would be
+        given to put_chunk_into_indexes. Only the client needs to be
+        locked, not the chunk indexes, so that clients making backups
+        at the same time don't need to wait for each other. The chunks
+        are in the indexes for anyone who locks them afterwards.
+
+        The default implementation locks the chunk indexes, unless
+        they're locked already, and puts the chunks into them right
+        away. A format may instead store the chunks elsewhere, and
+        merge them into the indexes later.
+
+        '''
+
+        if not self.got_client_lock(client_name):
+            raise obnamlib.RepositoryClientNotLocked(client_name=client_name)
+
+        if self.got_chunk_indexes_lock():
+            for chunk_id, token in chunks:
+                self.put_chunk_into_indexes(chunk_id, token, client_name)
+        else:
+            self.lock_chunk_indexes()
+            for chunk_id, token in chunks:
+                self.put_chunk_into_indexes(chunk_id, token, client_name)
+            self.commit_chunk_indexes()
+            self.unlock_chunk_indexes()
+
     def remove_chunk_from_indexes(self, chunk_id, client_name):
         '''Removes a chunk from indexes, given its id, for a given client.'''
         raise NotImplementedError()
@@ -1548,6 +1808,68 @@ class RepositoryInterfaceTests(unittest.TestCase):  # pragma: no cover
             self.repo.unlock_client('fooclient')
             self.assertEqual(value, 'bar')
 
+    def test_new_client_has_no_generation_summaries(self):
+        self.setup_client()
+        self.assertEqual(
+            self.repo.get_client_generation_summaries('fooclient'), [])
+
+    def test_gets_generation_summaries(self):
+        gen_id_1 = self.create_generation()
+        self.repo.set_generation_key(
+            gen_id_1, obnamlib.REPO_GENERATION_FILE_COUNT, 12)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        self.repo.lock_client('fooclient')
+        gen_id_2 = self.repo.create_generation('fooclient')
+        self.repo.set_generation_key(
+            gen_id_2, obnamlib.REPO_GENERATION_FILE_COUNT, 34)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+
+        summaries = self.repo.get_client_generation_summaries('fooclient')
+        self.assertEqual(
+            [gen_id for gen_id, _ in summaries], [gen_id_1, gen_id_2])
+        self.assertEqual(
+            [keys[obnamlib.REPO_GENERATION_FILE_COUNT]
+             for _, keys in summaries],
+            [12, 34])
+        for gen_id, keys in summaries:
+            self.assertEqual(
+                sorted(keys),
+                sorted(set(self.repo.get_allowed_generation_keys()) -
+                       set([obnamlib.REPO_GENERATION_TEST_KEY])))
+            for key, value in keys.items():
+                self.assertEqual(
+                    value, self.repo.get_generation_key(gen_id, key))
+
+    def test_gets_generation_summaries_after_removing_generation(self):
+        gen_id_1 = self.create_generation()
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        self.repo.lock_client('fooclient')
+        gen_id_2 = self.repo.create_generation('fooclient')
+        self.repo.set_generation_key(
+            gen_id_2, obnamlib.REPO_GENERATION_FILE_COUNT, 34)
+        self.repo.remove_generation(gen_id_1)
+        summaries = self.repo.get_client_generation_summaries('fooclient')
+        self.assertEqual(
+            [(gen_id, keys[obnamlib.REPO_GENERATION_FILE_COUNT])
+             for gen_id, keys in summaries],
+            [(gen_id_2, 34)])
+
+    def test_gets_only_given_keys_in_generation_summaries(self):
+        gen_id = self.create_generation()
+        self.repo.set_generation_key(
+            gen_id, obnamlib.REPO_GENERATION_FILE_COUNT, 12)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+
+        summaries = self.repo.get_client_generation_summaries(
+            'fooclient', [obnamlib.REPO_GENERATION_FILE_COUNT])
+        self.assertEqual(
+            summaries,
+            [(gen_id, {obnamlib.REPO_GENERATION_FILE_COUNT: 12})])
+
     def test_removes_unfinished_generation(self):
         gen_id = self.create_generation()
         self.repo.remove_generation(gen_id)
@@ -1587,6 +1909,28 @@ class RepositoryInterfaceTests(unittest.TestCase):  # pragma: no cover
             self.repo.get_client_generation_ids('fooclient'),
             [gen_id])
 
+    def test_removes_several_generations(self):
+        gen_id_1 = self.create_generation()
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        self.repo.lock_client('fooclient')
+        gen_id_2 = self.repo.create_generation('fooclient')
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        self.repo.lock_client('fooclient')
+        gen_id_3 = self.repo.create_generation('fooclient')
+        self.repo.remove_generations([gen_id_1, gen_id_3])
+        self.assertEqual(
+            self.repo.get_client_generation_ids('fooclient'), [gen_id_2])
+
+    def test_removing_several_generations_without_client_lock_fails(self):
+        gen_id = self.create_generation()
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        self.assertRaises(
+            obnamlib.RepositoryClientNotLocked,
+            self.repo.remove_generations, [gen_id])
+
     def test_committing_client_actually_removes_generation(self):
         gen_id = self.create_generation()
         self.repo.remove_generation(gen_id)
@@ -1975,6 +2319,22 @@ class RepositoryInterfaceTests(unittest.TestCase):  # pragma: no cover
         self.repo.clear_file_chunk_ids(gen_id, '/foo/bar')
         self.assertEqual(self.repo.get_file_chunk_ids(gen_id, '/foo/bar'), [])
 
+    def test_file_chunk_sizes_are_unknown_or_match_appended_sizes(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/foo/bar')
+        self.repo.append_file_chunk_id(gen_id, '/foo/bar', 1, chunk_size=10)
+        self.repo.append_file_chunk_id(gen_id, '/foo/bar', 2, chunk_size=20)
+        sizes = self.repo.get_file_chunk_sizes(gen_id, '/foo/bar')
+        self.assertTrue(sizes in (None, [10, 20]))
+
+    def test_file_chunk_sizes_are_unknown_if_any_size_is_missing(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/foo/bar')
+        self.repo.append_file_chunk_id(gen_id, '/foo/bar', 1, chunk_size=10)
+        self.repo.append_file_chunk_id(gen_id, '/foo/bar', 2)
+        self.assertEqual(
+            self.repo.get_file_chunk_sizes(gen_id, '/foo/bar'), None)
+
     def test_clearing_file_chunk_ids_in_nonexistent_generation_fails(self):
         gen_id = self.create_generation()
         self.repo.remove_generation(gen_id)
@@ -2071,6 +2431,305 @@ class RepositoryInterfaceTests(unittest.TestCase):  # pragma: no cover
             self.repo.get_file_children(gen_id, '/'),
             ['/foo'])
 
+    def test_lists_directory(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.assertEqual(
+            sorted(self.repo.list_directory(gen_id, '/foo')),
+            [('/foo/bar', False), ('/foo/empty', True),
+             ('/foo/link', False)])
+
+    def test_lists_directory_in_order_of_children(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.assertEqual(
+            [pathname for pathname, _ in
+             self.repo.list_directory(gen_id, '/foo')],
+            self.repo.get_file_children(gen_id, '/foo'))
+
+    def test_lists_committed_directory_like_generic_listing(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        generic = obnamlib.RepositoryInterface.list_directory
+        for dirname in ['/', '/foo', '/foo/empty']:
+            self.assertEqual(
+                self.repo.list_directory(gen_id, dirname),
+                generic(self.repo, gen_id, dirname))
+
+    def test_gets_directory_metadata(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        result = dict(self.repo.get_directory_metadata(gen_id, '/foo'))
+        self.assertEqual(
+            sorted(result.keys()), ['/foo/bar', '/foo/empty', '/foo/link'])
+        self.assertEqual(result['/foo/bar'].st_size, 123)
+        self.assertEqual(result['/foo/empty'].st_mode, stat.S_IFDIR | 0700)
+        self.assertEqual(result['/foo/link'].target, 'bar')
+
+    def test_gets_committed_directory_metadata_like_generic_lookup(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        generic = obnamlib.RepositoryInterface.get_directory_metadata
+        for dirname in ['/', '/foo', '/foo/empty']:
+            self.assertEqual(
+                self.metadata_fields(
+                    self.repo.get_directory_metadata(gen_id, dirname)),
+                self.metadata_fields(generic(self.repo, gen_id, dirname)))
+
+    def metadata_fields(self, pairs):
+        return [
+            (pathname,
+             [getattr(metadata, field)
+              for _, field in obnamlib.metadata_file_key_mapping])
+            for pathname, metadata in pairs]
+
+    def add_tree_to_generation(self, gen_id):
+        files = [
+            ('/', stat.S_IFDIR | 0755),
+            ('/foo', stat.S_IFDIR | 0700),
+            ('/foo/bar', stat.S_IFREG | 0644),
+            ('/foo/link', stat.S_IFLNK | 0777),
+            ('/foo/empty', stat.S_IFDIR | 0700),
+            ('/top', stat.S_IFREG | 0600),
+        ]
+        for filename, mode in files:
+            self.repo.add_file(gen_id, filename)
+            self.repo.set_file_key(
+                gen_id, filename, obnamlib.REPO_FILE_MODE, mode)
+        self.repo.set_file_key(
+            gen_id, '/foo/bar', obnamlib.REPO_FILE_SIZE, 123)
+        self.repo.append_file_chunk_id(gen_id, '/foo/bar', 1)
+        self.repo.append_file_chunk_id(gen_id, '/foo/bar', 2)
+        self.repo.set_file_key(
+            gen_id, '/foo/link', obnamlib.REPO_FILE_SYMLINK_TARGET, 'bar')
+
+    def assertSameFiles(self, walked, expected):
+        self.assertEqual(
+            [pathname for pathname, _, _ in walked],
+            [pathname for pathname, _, _ in expected])
+        allowed = self.repo.get_allowed_file_keys()
+        for (_, metadata, chunk_ids), (_, metadata2, chunk_ids2) in \
+                zip(walked, expected):
+            for key, field in obnamlib.metadata_file_key_mapping:
+                if key in allowed:
+                    self.assertEqual(
+                        getattr(metadata, field), getattr(metadata2, field))
+            self.assertEqual(list(chunk_ids), list(chunk_ids2))
+
+    def test_walks_generation_depth_first(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        walked = list(self.repo.walk_generation(gen_id, '/'))
+        self.assertEqual(
+            sorted(walked),
+            ['/', '/foo', '/foo/bar', '/foo/empty', '/foo/link', '/top'])
+        self.assertEqual(walked[-1], '/')
+        self.assertTrue(walked.index('/foo/bar') < walked.index('/foo'))
+        self.assertTrue(walked.index('/foo/empty') < walked.index('/foo'))
+
+    def test_walks_generation_directories_first(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        walked = list(
+            self.repo.walk_generation(gen_id, '/', depth_first=False))
+        self.assertEqual(
+            sorted(walked),
+            ['/', '/foo', '/foo/bar', '/foo/empty', '/foo/link', '/top'])
+        self.assertEqual(walked[0], '/')
+        self.assertTrue(walked.index('/foo') < walked.index('/foo/bar'))
+        self.assertTrue(walked.index('/foo') < walked.index('/foo/empty'))
+
+    def test_walks_generation_in_same_order_both_ways_for_siblings(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        post = list(self.repo.walk_generation(gen_id, '/'))
+        pre = list(self.repo.walk_generation(gen_id, '/', depth_first=False))
+        self.assertEqual(
+            [x for x in post if x.startswith('/foo/')],
+            [x for x in pre if x.startswith('/foo/')])
+
+    def test_walks_generation_of_single_file(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.assertEqual(
+            list(self.repo.walk_generation(gen_id, '/foo/bar')),
+            ['/foo/bar'])
+
+    def test_walks_deep_generation(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/')
+        self.repo.set_file_key(
+            gen_id, '/', obnamlib.REPO_FILE_MODE, stat.S_IFDIR | 0755)
+        pathnames = ['/']
+        for i in range(300):
+            pathname = os.path.join(pathnames[-1], 'd')
+            self.repo.add_file(gen_id, pathname)
+            self.repo.set_file_key(
+                gen_id, pathname, obnamlib.REPO_FILE_MODE,
+                stat.S_IFDIR | 0755)
+            pathnames.append(pathname)
+
+        # The tree must be deeper than the recursion limit, but
+        # creating a tree of the default limit's depth would be slow,
+        # so the limit is lowered for the walk instead.
+        walker = self.repo.walk_generation(gen_id, '/')
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(200)
+        try:
+            walked = list(walker)
+        finally:
+            sys.setrecursionlimit(old_limit)
+        self.assertTrue(len(pathnames) > 200)
+        self.assertEqual(walked, list(reversed(pathnames)))
+
+    def test_walks_files_of_deep_generation(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/')
+        self.repo.set_file_key(
+            gen_id, '/', obnamlib.REPO_FILE_MODE, stat.S_IFDIR | 0755)
+        pathnames = ['/']
+        for i in range(300):
+            pathname = os.path.join(pathnames[-1], 'd')
+            self.repo.add_file(gen_id, pathname)
+            self.repo.set_file_key(
+                gen_id, pathname, obnamlib.REPO_FILE_MODE,
+                stat.S_IFDIR | 0755)
+            pathnames.append(pathname)
+
+        # See test_walks_deep_generation.
+        walker = self.repo.walk_generation_files(gen_id, '/')
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(200)
+        try:
+            walked = [pathname for pathname, _, _ in walker]
+        finally:
+            sys.setrecursionlimit(old_limit)
+        self.assertEqual(walked, list(reversed(pathnames)))
+
+    def test_walks_generation_files(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        walked = list(self.repo.walk_generation_files(gen_id, '/'))
+        self.assertEqual(
+            sorted(pathname for pathname, _, _ in walked),
+            ['/', '/foo', '/foo/bar', '/foo/empty', '/foo/link', '/top'])
+        files = dict(
+            (pathname, (metadata, chunk_ids))
+            for pathname, metadata, chunk_ids in walked)
+        metadata, chunk_ids = files['/foo/bar']
+        self.assertEqual(metadata.st_mode, stat.S_IFREG | 0644)
+        self.assertEqual(metadata.st_size, 123)
+        self.assertEqual(list(chunk_ids), [1, 2])
+        metadata, chunk_ids = files['/foo/link']
+        self.assertEqual(metadata.target, 'bar')
+        self.assertEqual(list(chunk_ids), [])
+
+    def test_walks_generation_files_in_walk_generation_order(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.assertEqual(
+            [pathname for pathname, _, _ in
+             self.repo.walk_generation_files(gen_id, '/')],
+            list(self.repo.walk_generation(gen_id, '/')))
+
+    def test_walks_files_of_subtree(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.assertEqual(
+            sorted(pathname for pathname, _, _ in
+                   self.repo.walk_generation_files(gen_id, '/foo')),
+            ['/foo', '/foo/bar', '/foo/empty', '/foo/link'])
+
+    def test_walks_single_file(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        walked = list(self.repo.walk_generation_files(gen_id, '/foo/bar'))
+        self.assertEqual(len(walked), 1)
+        pathname, metadata, chunk_ids = walked[0]
+        self.assertEqual(pathname, '/foo/bar')
+        self.assertEqual(metadata.st_size, 123)
+        self.assertEqual(list(chunk_ids), [1, 2])
+
+    def test_walks_committed_generation_files_like_generic_walk(self):
+        gen_id = self.create_generation()
+        self.add_tree_to_generation(gen_id)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        generic = obnamlib.RepositoryInterface.walk_generation_files
+        self.assertSameFiles(
+            list(self.repo.walk_generation_files(gen_id, '/')),
+            list(generic(self.repo, gen_id, '/')))
+
+    def test_walking_files_of_nonexistent_file_fails(self):
+        gen_id = self.create_generation()
+        self.assertRaises(
+            obnamlib.RepositoryFileDoesNotExistInGeneration,
+            lambda: list(self.repo.walk_generation_files(gen_id, '/foo')))
+
+    def set_file_md5(self, gen_id, filename, md5):
+        self.repo.set_file_key(gen_id, filename, obnamlib.REPO_FILE_MD5, md5)
+
+    def create_generations_to_diff(self):
+        gen_id1 = self.create_generation()
+        self.add_tree_to_generation(gen_id1)
+        self.set_file_md5(gen_id1, '/foo/bar', 'bar')
+        self.set_file_md5(gen_id1, '/top', 'top')
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+
+        self.repo.lock_client('fooclient')
+        gen_id2 = self.repo.create_generation('fooclient')
+        self.set_file_md5(gen_id2, '/foo/bar', 'changed')
+        self.repo.remove_file(gen_id2, '/foo/link')
+        self.repo.add_file(gen_id2, '/foo/new')
+        self.repo.set_file_key(
+            gen_id2, '/foo/new', obnamlib.REPO_FILE_MODE, stat.S_IFREG)
+        self.repo.set_file_key(
+            gen_id2, '/top', obnamlib.REPO_FILE_MODE, stat.S_IFREG | 0644)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        return gen_id1, gen_id2
+
+    def test_diffs_generations(self):
+        gen_id1, gen_id2 = self.create_generations_to_diff()
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id1, gen_id2, '/')),
+            [('*', '/foo/bar'), ('+', '/foo/new'), ('-', '/foo/link')])
+
+    def test_diffs_generations_backwards(self):
+        gen_id1, gen_id2 = self.create_generations_to_diff()
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id2, gen_id1, '/')),
+            [('*', '/foo/bar'), ('+', '/foo/link'), ('-', '/foo/new')])
+
+    def test_diffs_generation_with_itself(self):
+        gen_id1, gen_id2 = self.create_generations_to_diff()
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id2, gen_id2, '/')), [])
+
+    def test_diffs_generations_like_generic_diff(self):
+        gen_id1, gen_id2 = self.create_generations_to_diff()
+        generic = obnamlib.RepositoryInterface.diff_generations
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id1, gen_id2, '/')),
+            list(generic(self.repo, gen_id1, gen_id2, '/')))
+
+    def test_diff_reports_file_that_became_directory(self):
+        gen_id1, gen_id2 = self.create_generations_to_diff()
+        self.repo.lock_client('fooclient')
+        gen_id3 = self.repo.create_generation('fooclient')
+        self.repo.set_file_key(
+            gen_id3, '/top', obnamlib.REPO_FILE_MODE, stat.S_IFDIR | 0755)
+        self.repo.commit_client('fooclient')
+        self.repo.unlock_client('fooclient')
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id2, gen_id3, '/')),
+            [('*', '/top')])
+
     # Chunk and chunk indexes.
 
     def test_puts_chunk_into_repository(self):
@@ -2084,6 +2743,9 @@ class RepositoryInterfaceTests(unittest.TestCase):  # pragma: no cover
         self.assertTrue(self.repo.has_chunk(chunk_id))
         self.assertEqual(self.repo.get_chunk_content(chunk_id), 'foochunk')
 
+    def test_has_no_pending_chunks_initially(self):
+        self.assertEqual(list(self.repo.get_pending_chunk_ids()), [])
+
     def test_get_chunk_ids_returns_nothing_initially(self):
         self.assertEqual(list(self.repo.get_chunk_ids()), [])
 
@@ -2137,6 +2799,35 @@ class RepositoryInterfaceTests(unittest.TestCase):  # pragma: no cover
             set(self.repo.find_chunk_ids_by_content('foochunk')),
             set([chunk_id_1, chunk_id_2]))
 
+    def test_queues_chunks_for_indexes(self):
+        self.setup_client()
+        self.repo.lock_client('fooclient')
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        token = self.repo.prepare_chunk_for_indexes('foochunk')
+        self.repo.queue_chunks_for_indexes([(chunk_id, token)], 'fooclient')
+        self.repo.lock_chunk_indexes()
+        self.assertEqual(
+            self.repo.find_chunk_ids_by_content('foochunk'), [chunk_id])
+
+    def test_queues_chunks_for_indexes_while_they_are_locked(self):
+        self.setup_client()
+        self.repo.lock_client('fooclient')
+        self.repo.lock_chunk_indexes()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        token = self.repo.prepare_chunk_for_indexes('foochunk')
+        self.repo.queue_chunks_for_indexes([(chunk_id, token)], 'fooclient')
+        self.assertEqual(
+            self.repo.find_chunk_ids_by_content('foochunk'), [chunk_id])
+
+    def test_queueing_chunks_without_client_lock_fails(self):
+        self.setup_client()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        token = self.repo.prepare_chunk_for_indexes('foochunk')
+        self.assertRaises(
+            obnamlib.RepositoryClientNotLocked,
+            self.repo.queue_chunks_for_indexes,
+            [(chunk_id, token)], 'fooclient')
+
     def test_removes_chunk_from_indexes(self):
         self.setup_client()
         self.repo.lock_chunk_indexes()
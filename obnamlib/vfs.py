@@ -257,6 +257,38 @@ class VirtualFileSystem(object):
     def overwrite_file(self, pathname, contents):
         '''Like write_file, but overwrites existing file.'''
 
+    def open_reader(self, pathname):
+        '''Open a file for reading it from start to end.
+
+        Return a file-like object. Unlike open, this is meant for
+        reading whole files, and implementations may optimise for that.
+
+        '''
+
+        return self.open(pathname, 'rb')
+
+    def open_writer(self, pathname, overwrite=False):
+        '''Return a VfsWriter for writing a new file piece by piece.
+
+        Once the writer is closed, the result is the same as calling
+        write_file, or overwrite_file if overwrite is true, with all
+        the data given to the writer. The default implementation keeps
+        the data in memory until then; implementations should write it
+        out as it comes in.
+
+        '''
+
+        return BufferedVfsWriter(self, pathname, overwrite)
+
+    def sync(self):
+        '''Make sure everything written so far is on stable storage.
+
+        Implementations that delay flushing written files to disk
+        must do it here. This gets called at commit points, so that
+        the cost of flushing is paid once per commit.
+
+        '''
+
     def scan_tree(self, dirname, ok=None, dirst=None, log=logging.error,
                   error_handler=None):
         '''Scan a tree for files.
@@ -338,6 +370,119 @@ class VirtualFileSystem(object):
                 yield filename, metadata
 
 
+class VfsWriter(object):
+
+    '''Write a file piece by piece.
+
+    Data is given to the write method, and the file is put in place
+    when the close method is called. If something goes wrong before
+    that, the abort method removes anything that was written. A
+    writer can be used in a with statement: the file is closed at
+    the end of the block, or aborted if the block raises an exception.
+
+    '''
+
+    def write(self, data):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+    def abort(self):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class BufferedVfsWriter(VfsWriter):
+
+    '''A VfsWriter that writes the whole file at once when closed.'''
+
+    def __init__(self, fs, pathname, overwrite):
+        self._fs = fs
+        self._pathname = pathname
+        self._overwrite = overwrite
+        self._pieces = []
+
+    def write(self, data):
+        self._pieces.append(data)
+
+    def close(self):
+        contents = ''.join(self._pieces)
+        self._pieces = []
+        if self._overwrite:
+            self._fs.overwrite_file(self._pathname, contents)
+        else:
+            self._fs.write_file(self._pathname, contents)
+
+    def abort(self):
+        self._pieces = []
+
+
+class PieceReader(object):
+
+    '''A read-only file-like object for data given as pieces.
+
+    pieces is an iterable of strings, and reading returns the data in
+    them, in order. Pieces are consumed only as needed, so the data
+    never needs to be in memory all at once. If close is given, it
+    gets called when the reader is closed.
+
+    '''
+
+    def __init__(self, pieces, close=None):
+        self._pieces = iter(pieces)
+        self._close = close
+        self._buffer = ''
+        self._pos = 0
+
+    def read(self, num_bytes=-1):
+        if num_bytes is None or num_bytes < 0:
+            parts = [self._buffer[self._pos:]]
+            parts.extend(self._pieces)
+            self._buffer = ''
+            self._pos = 0
+            return ''.join(parts)
+
+        # We index into the current piece, rather than slicing off
+        # the part that was read, so that reading a large piece in
+        # small amounts doesn't copy the rest of it over and over.
+        parts = []
+        while num_bytes > 0:
+            if self._pos >= len(self._buffer):
+                piece = next(self._pieces, None)
+                if piece is None:
+                    break
+                self._buffer = piece
+                self._pos = 0
+                continue
+            data = self._buffer[self._pos:self._pos + num_bytes]
+            self._pos += len(data)
+            num_bytes -= len(data)
+            parts.append(data)
+        return ''.join(parts)
+
+    def close(self):
+        # If the pieces come from a generator, closing it lets it
+        # clean up after itself.
+        close_pieces = getattr(self._pieces, 'close', None)
+        if close_pieces is not None:
+            close_pieces()
+        self._buffer = ''
+        self._pieces = iter([])
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
 class VfsFactory(object):
 
     '''Create new instances of VirtualFileSystem.'''
@@ -736,6 +881,51 @@ class VfsTests(object):  # pragma: no cover
         self.fs.overwrite_file('foo', 'foo')
         self.assertEqual(self.fs.bytes_written, 3)
 
+    def test_open_reader_reads_whole_file(self):
+        self.fs.write_file('foo', 'bar')
+        f = self.fs.open_reader('foo')
+        self.assertEqual(f.read(), 'bar')
+        f.close()
+
+    def test_open_reader_fails_for_nonexistent_file(self):
+        self.assertRaises((IOError, OSError), self.fs.open_reader, 'foo')
+
+    def test_open_writer_writes_new_file_in_pieces(self):
+        with self.fs.open_writer('foo/bar') as writer:
+            writer.write('foo')
+            writer.write('bar')
+        self.assertEqual(self.fs.cat('foo/bar'), 'foobar')
+
+    def test_open_writer_fails_if_file_exists_already(self):
+        self.fs.write_file('foo', 'bar')
+
+        def write():
+            with self.fs.open_writer('foo') as writer:
+                writer.write('foobar')
+
+        self.assertRaises(OSError, write)
+        self.assertEqual(self.fs.cat('foo'), 'bar')
+
+    def test_open_writer_overwrites_existing_file(self):
+        self.fs.write_file('foo', 'bar')
+        with self.fs.open_writer('foo', overwrite=True) as writer:
+            writer.write('foo')
+            writer.write('bar')
+        self.assertEqual(self.fs.cat('foo'), 'foobar')
+
+    def test_aborted_writer_leaves_existing_file_intact(self):
+        self.fs.write_file('foo', 'bar')
+        writer = self.fs.open_writer('foo', overwrite=True)
+        writer.write('foobar')
+        writer.abort()
+        self.assertEqual(self.fs.cat('foo'), 'bar')
+        self.assertEqual(self.fs.listdir('.'), ['foo'])
+
+    def test_open_writer_updates_written(self):
+        with self.fs.open_writer('foo') as writer:
+            writer.write('foo')
+        self.assertEqual(self.fs.bytes_written, 3)
+
     def set_up_scan_tree(self):
         self.dirs = ['foo', 'foo/bar', 'foobar']
         self.dirs = [os.path.join(self.basepath, x) for x in self.dirs]
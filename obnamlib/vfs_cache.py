@@ -0,0 +1,297 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import tracing
+
+import obnamlib
+
+
+class CachingFS(object):
+
+    '''A VFS wrapper that caches repository files on local disk.
+
+    This wraps another VFS instance, typically an SftpFS, and keeps
+    copies of files read from it in a local cache directory, so that
+    they don't need to be fetched again, by this or later runs.
+
+    Only files that never change once written are cached: B-tree
+    nodes, bags, and format 6 chunk files. Bags, and the bag ids
+    reserved for them, are written over an empty file, so an empty
+    file is never cached. Other files, such as a B-tree's metadata
+    file or the green-albatross chunk indexes, may be overwritten by
+    us or by another client, and neither size nor modification time
+    tell reliably whether they have changed: a replacement of the
+    same size may be written within the same second, and SFTP only
+    has whole seconds. So they are always read from the wrapped VFS.
+
+    The total size of the cache is limited. When it grows too big,
+    the least recently used files are removed.
+
+    All methods not explicitly defined here are passed on to the
+    wrapped VFS as is.
+
+    '''
+
+    # Directory components for files that are written once and never
+    # modified. A B-tree node gets a new identifier whenever it is
+    # changed.
+    immutable_dirs = ('nodes',)
+
+    # Suffixes of files that are written once, with all their
+    # content, and never modified: the bags holding chunks and
+    # directory objects in green-albatross repositories.
+    immutable_suffixes = ('.bag',)
+
+    # Format 6 keeps each chunk in a file of its own, in a directory
+    # tree below this directory. Files right in it, such as the
+    # encryption keys, may change.
+    chunk_dir = 'chunks'
+
+    # How much to copy at a time when filling the cache.
+    copy_size = 1024**2
+
+    def __init__(self, fs, cache_dir, max_bytes):
+        self.fs = fs
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # Uploads may happen in other threads, see SpoolingFS, so
+        # the bookkeeping needs to be protected.
+        self._lock = threading.Lock()
+
+        self._cache_root = cache_dir
+        self._open_cache_dir()
+
+    def _open_cache_dir(self):
+        # Each repository gets its own sub-directory in the cache.
+        url_hash = hashlib.sha1(self.fs.baseurl).hexdigest()
+        self.cache_dir = os.path.join(self._cache_root, url_hash)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, obnamlib.NEW_DIR_MODE)
+
+        self._sizes = {}
+        self._total_bytes = 0
+        for basename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, basename)
+            try:
+                st = os.stat(path)
+            except OSError:  # pragma: no cover
+                continue
+            self._sizes[path] = st.st_size
+            self._total_bytes += st.st_size
+
+    def __getattr__(self, name):
+        return getattr(self.fs, name)
+
+    # Statistics are kept by the wrapped VFS, even when callers update
+    # them via us.
+
+    def _get_bytes_read(self):
+        return self.fs.bytes_read
+
+    def _set_bytes_read(self, value):
+        self.fs.bytes_read = value
+
+    bytes_read = property(_get_bytes_read, _set_bytes_read)
+
+    def _get_bytes_written(self):
+        return self.fs.bytes_written
+
+    def _set_bytes_written(self, value):
+        self.fs.bytes_written = value
+
+    bytes_written = property(_get_bytes_written, _set_bytes_written)
+
+    def close(self):
+        logging.debug(
+            'CachingFS: %s: hits=%d misses=%d cached=%d bytes',
+            self.fs.baseurl, self.hits, self.misses, self._total_bytes)
+        self.fs.close()
+
+    def reinit(self, new_baseurl, create=False):
+        self.fs.reinit(new_baseurl, create=create)
+        self._open_cache_dir()
+
+    def _entry_path(self, pathname):
+        key = os.path.normpath(self.fs.abspath(pathname))
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+
+    def _is_cacheable(self, pathname):
+        parts = os.path.normpath(pathname).split(os.sep)
+        return (
+            any(x in parts[:-1] for x in self.immutable_dirs) or
+            parts[-1].endswith(self.immutable_suffixes) or
+            self.chunk_dir in parts[:-2])
+
+    def _lookup(self, pathname):
+        # Return the path to a cached copy of pathname, or None.
+
+        entry = self._entry_path(pathname)
+        if entry not in self._sizes:
+            return None
+
+        try:
+            cached = os.stat(entry)
+        except OSError:  # pragma: no cover
+            # Someone else removed it. Forget it.
+            self._forget(entry)
+            return None
+
+        # The access time is what we use for finding the least
+        # recently used entries.
+        os.utime(entry, (time.time(), cached.st_mtime))
+        return entry
+
+    def _fill(self, pathname):
+        # Copy pathname into the cache, and return the path to the
+        # cached copy, or None if it can't be cached.
+
+        try:
+            st = self.fs.lstat(pathname)
+        except OSError:
+            # Let the real VFS report the problem in its usual way.
+            return None
+        if st.st_size == 0 or st.st_size > self.max_bytes:
+            return None
+
+        entry = self._entry_path(pathname)
+        fd, tempname = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            f = self.fs.open_reader(pathname)
+            try:
+                size = 0
+                while True:
+                    data = f.read(self.copy_size)
+                    if not data:
+                        break
+                    os.write(fd, data)
+                    size += len(data)
+            finally:
+                f.close()
+        except BaseException:
+            os.close(fd)
+            os.remove(tempname)
+            raise
+        os.close(fd)
+
+        now = time.time()
+        os.utime(tempname, (now, now))
+        os.rename(tempname, entry)
+        self._add(entry, size)
+        return entry
+
+    def _add(self, entry, size):
+        with self._lock:
+            if entry in self._sizes:
+                self._total_bytes -= self._sizes.pop(entry)
+            self._sizes[entry] = size
+            self._total_bytes += size
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+
+    def _forget_size(self, entry):
+        with self._lock:
+            if entry in self._sizes:
+                self._total_bytes -= self._sizes.pop(entry)
+
+    def _forget(self, entry):
+        self._forget_size(entry)
+        try:
+            os.remove(entry)
+        except OSError, e:  # pragma: no cover
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _evict(self):
+        # Remove least recently used entries until we're within the
+        # size limit again.
+        by_atime = []
+        for entry in list(self._sizes):
+            try:
+                by_atime.append((os.stat(entry).st_atime, entry))
+            except OSError:  # pragma: no cover
+                by_atime.append((0, entry))
+        by_atime.sort()
+        for _, entry in by_atime:
+            if self._total_bytes <= self.max_bytes:
+                break
+            tracing.trace('evicting %s', entry)
+            self._forget(entry)
+
+    def invalidate(self, pathname):
+        '''Forget any cached copy of pathname.'''
+        entry = self._entry_path(pathname)
+        if entry in self._sizes:
+            self._forget(entry)
+
+    def _cached_entry(self, pathname):
+        # Return path to a cached copy of pathname, filling the cache
+        # if needed, or None if the file is not to be cached.
+        if not self._is_cacheable(pathname) or self.max_bytes <= 0:
+            return None
+        entry = self._lookup(pathname)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return self._fill(pathname)
+
+    def open_reader(self, pathname):
+        entry = self._cached_entry(pathname)
+        if entry is None:
+            return self.fs.open_reader(pathname)
+        return open(entry, 'rb')
+
+    def cat(self, pathname):
+        f = self.open_reader(pathname)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self.fs.bytes_read += len(data)
+        return data
+
+    def write_file(self, pathname, contents):
+        self.fs.write_file(pathname, contents)
+        self.invalidate(pathname)
+
+    def overwrite_file(self, pathname, contents):
+        self.fs.overwrite_file(pathname, contents)
+        self.invalidate(pathname)
+
+    def open_writer(self, pathname, overwrite=False):
+        self.invalidate(pathname)
+        return self.fs.open_writer(pathname, overwrite=overwrite)
+
+    def remove(self, pathname):
+        self.invalidate(pathname)
+        return self.fs.remove(pathname)
+
+    def rename(self, old, new):
+        self.invalidate(old)
+        self.invalidate(new)
+        return self.fs.rename(old, new)
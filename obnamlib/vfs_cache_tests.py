@@ -0,0 +1,187 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class CountingFS(obnamlib.LocalFS):
+
+    def __init__(self, *args, **kwargs):
+        obnamlib.LocalFS.__init__(self, *args, **kwargs)
+        self.opened = []
+
+    def open_reader(self, pathname):
+        self.opened.append(pathname)
+        return obnamlib.LocalFS.open_reader(self, pathname)
+
+
+class CachingFSVfsTests(unittest.TestCase, obnamlib.VfsTests):
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.cachedir = tempfile.mkdtemp()
+        self.fs = obnamlib.CachingFS(
+            obnamlib.LocalFS(self.basepath), self.cachedir, 1024**2)
+
+    def tearDown(self):
+        self.fs.close()
+        shutil.rmtree(self.basepath)
+        shutil.rmtree(self.cachedir)
+
+    def test_scan_tree_returns_nothing_if_listdir_fails(self):
+        # scan_tree is done by the wrapped VFS, so that's where the
+        # failing listdir2 needs to go.
+        self.set_up_scan_tree()
+
+        def raiser(dirname):
+            raise OSError(123, 'oops', dirname)
+
+        def logerror(msg):
+            pass
+
+        self.fs.fs.listdir2 = raiser
+        result = list(self.fs.scan_tree(self.basepath, log=logerror))
+        self.assertEqual(len(result), 1)
+        pathname, _ = result[0]
+        self.assertEqual(pathname, self.basepath)
+
+
+class CachingFSTests(unittest.TestCase):
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.cachedir = tempfile.mkdtemp()
+        self.real = CountingFS(self.basepath)
+        self.fs = self.new_fs(1024)
+
+    def new_fs(self, max_bytes):
+        return obnamlib.CachingFS(self.real, self.cachedir, max_bytes)
+
+    def tearDown(self):
+        self.fs.close()
+        shutil.rmtree(self.basepath)
+        shutil.rmtree(self.cachedir)
+
+    def test_reads_file_only_once(self):
+        self.real.write_file('nodes/foo', 'data')
+        self.assertEqual(self.fs.cat('nodes/foo'), 'data')
+        self.assertEqual(self.fs.cat('nodes/foo'), 'data')
+        self.assertEqual(self.real.opened, ['nodes/foo'])
+
+    def test_cache_persists_across_instances(self):
+        self.real.write_file('nodes/foo', 'data')
+        self.fs.cat('nodes/foo')
+        fs2 = self.new_fs(1024)
+        self.assertEqual(fs2.cat('nodes/foo'), 'data')
+        self.assertEqual(self.real.opened, ['nodes/foo'])
+
+    def test_does_not_cache_files_that_may_change(self):
+        self.real.write_file('tree/metadata', 'data')
+        self.fs.cat('tree/metadata')
+        self.real.overwrite_file('tree/metadata', 'atad')
+        self.assertEqual(self.fs.cat('tree/metadata'), 'atad')
+        self.assertEqual(
+            self.real.opened, ['tree/metadata', 'tree/metadata'])
+
+    def test_trusts_tree_nodes_without_checking(self):
+        self.real.write_file('tree/nodes/1', 'data')
+        self.fs.cat('tree/nodes/1')
+        self.real.lstat = None
+        self.assertEqual(self.fs.cat('tree/nodes/1'), 'data')
+
+    def test_overwrite_file_invalidates_cached_copy(self):
+        self.real.write_file('tree/nodes/1', 'data')
+        self.fs.cat('tree/nodes/1')
+        self.fs.overwrite_file('tree/nodes/1', 'new')
+        self.assertEqual(self.fs.cat('tree/nodes/1'), 'new')
+
+    def test_remove_invalidates_cached_copy(self):
+        self.real.write_file('tree/nodes/1', 'data')
+        self.fs.cat('tree/nodes/1')
+        self.fs.remove('tree/nodes/1')
+        self.assertRaises(IOError, self.fs.cat, 'tree/nodes/1')
+
+    def test_caches_bags(self):
+        self.real.write_file('chunk-store/12/34/123456.bag', 'data')
+        self.fs.cat('chunk-store/12/34/123456.bag')
+        self.fs.cat('chunk-store/12/34/123456.bag')
+        self.assertEqual(self.real.opened, ['chunk-store/12/34/123456.bag'])
+
+    def test_does_not_cache_empty_bag(self):
+        # An empty bag is a placeholder, which is going to be filled.
+        self.real.write_file('chunk-store/123456.bag', '')
+        self.fs.cat('chunk-store/123456.bag')
+        self.real.overwrite_file('chunk-store/123456.bag', 'data')
+        self.assertEqual(self.fs.cat('chunk-store/123456.bag'), 'data')
+
+    def test_caches_chunk_files(self):
+        self.real.write_file('chunks/12/34/123456', 'data')
+        self.fs.cat('chunks/12/34/123456')
+        self.fs.cat('chunks/12/34/123456')
+        self.assertEqual(self.real.opened, ['chunks/12/34/123456'])
+
+    def test_does_not_cache_files_at_top_of_chunk_tree(self):
+        self.real.write_file('chunks/key', 'data')
+        self.fs.cat('chunks/key')
+        self.fs.cat('chunks/key')
+        self.assertEqual(self.real.opened, ['chunks/key', 'chunks/key'])
+
+    def test_does_not_cache_chunk_indexes(self):
+        self.real.write_file('chunk-indexes/data.dat', 'data')
+        self.fs.cat('chunk-indexes/data.dat')
+        self.real.overwrite_file('chunk-indexes/data.dat', 'atad')
+        self.assertEqual(self.fs.cat('chunk-indexes/data.dat'), 'atad')
+
+    def test_does_not_cache_lock_files(self):
+        self.real.write_file('lock', 'data')
+        self.fs.cat('lock')
+        self.fs.cat('lock')
+        self.assertEqual(self.real.opened, ['lock', 'lock'])
+
+    def test_does_not_cache_file_bigger_than_cache(self):
+        self.real.write_file('nodes/foo', 'x' * 2000)
+        self.fs.cat('nodes/foo')
+        self.fs.cat('nodes/foo')
+        self.assertEqual(self.real.opened, ['nodes/foo', 'nodes/foo'])
+        self.assertEqual(os.listdir(self.fs.cache_dir), [])
+
+    def test_evicts_least_recently_used_file(self):
+        self.real.write_file('nodes/foo', 'x' * 400)
+        self.real.write_file('nodes/bar', 'x' * 400)
+        self.real.write_file('nodes/foobar', 'x' * 400)
+        self.fs.cat('nodes/foo')
+        self.fs.cat('nodes/bar')
+        entry = self.fs._entry_path('nodes/foo')
+        os.utime(entry, (0, os.stat(entry).st_mtime))
+        self.fs.cat('nodes/foobar')
+        self.fs.cat('nodes/bar')
+        self.fs.cat('nodes/foo')
+        self.assertEqual(
+            self.real.opened,
+            ['nodes/foo', 'nodes/bar', 'nodes/foobar', 'nodes/foo'])
+
+    def test_counts_hits_and_misses(self):
+        self.real.write_file('nodes/foo', 'data')
+        self.fs.cat('nodes/foo')
+        self.fs.cat('nodes/foo')
+        self.assertEqual((self.fs.hits, self.fs.misses), (1, 1))
@@ -64,16 +64,69 @@ class LocalFSFile(file):
         obnamlib._obnam.fadvise_dontneed(fd, offset, len(data))
 
 
+class LocalFSWriter(obnamlib.VfsWriter):
+
+    '''Write a file for LocalFS, straight into a temporary file.'''
+
+    def __init__(self, fs, path, overwrite):
+        self._fs = fs
+        self._path = path
+        self._overwrite = overwrite
+        self._fd, self._tempname = fs._create_tempfile(path)
+        self._offset = 0
+
+    def write(self, data):
+        self._offset = self._fs._write_to_fd(self._fd, data, self._offset)
+        self._fs.bytes_written += len(data)
+
+    def close(self):
+        fd = self._fd
+        self._fd = None
+        try:
+            self._fs._close_tempfile(fd)
+        except BaseException:  # pragma: no cover
+            os.remove(self._tempname)
+            raise
+        self._fs._put_tempfile_in_place(
+            self._tempname, self._path, self._overwrite)
+
+    def abort(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            os.remove(self._tempname)
+
+
 class LocalFS(obnamlib.VirtualFileSystem):
 
     """A VFS implementation for local filesystems."""
 
     chunk_size = 1024 * 1024
 
-    def __init__(self, baseurl, create=False):
+    # When are written files flushed to disk? "never" leaves it to the
+    # kernel, "always" does fsync(2) on every file and its directory
+    # when it is written, and "group" remembers what has been written
+    # and flushes it all at once when sync is called, at commit points.
+    fsync_modes = ('never', 'group', 'always')
+
+    def __init__(self, baseurl, create=False, settings=None):
         tracing.trace('baseurl=%s', baseurl)
         tracing.trace('create=%s', create)
         obnamlib.VirtualFileSystem.__init__(self, baseurl)
+
+        # Directories we know exist, so we don't need to check for
+        # them for every file we write.
+        self._known_dirs = set()
+
+        # Files and directories written in group mode, but not yet
+        # flushed to disk.
+        self._pending_files = set()
+        self._pending_dirs = set()
+
+        self.fsync_mode = 'never'
+        if settings is not None:
+            self.set_fsync_mode(settings['local-fsync'])
+
         self.reinit(baseurl, create=create)
 
         # For checking that we do not unlock something we didn't lock
@@ -96,12 +149,18 @@ class LocalFS(obnamlib.VirtualFileSystem):
                     'Crashing as requested after %d writes' %
                     self.crash_counter)
 
+    def set_fsync_mode(self, mode):
+        assert mode in self.fsync_modes, mode
+        self.fsync_mode = mode
+
     def reinit(self, baseurl, create=False):
         # We fake chdir so that it doesn't mess with the caller's
         # perception of current working directory. This also benefits
         # unit tests. To do this, we store the baseurl as the cwd.
         tracing.trace('baseurl=%s', baseurl)
         tracing.trace('create=%s', create)
+        self.sync()
+        self._known_dirs.clear()
         self.cwd = os.path.abspath(baseurl)
         if os.path.exists(self.cwd):  # pragma: no cover
             if not os.path.isdir(self.cwd):
@@ -133,7 +192,7 @@ class LocalFS(obnamlib.VirtualFileSystem):
     def lock(self, lockname):
         tracing.trace('attempting lockname=%s', lockname)
         try:
-            tempname = self._create_tempfile(lockname)
+            tempname = self._write_tempfile(self.join(lockname), '')
             self._rename_temp_to_real(tempname, lockname)
         except OSError, e:
             if e.errno == errno.EEXIST:
@@ -145,10 +204,15 @@ class LocalFS(obnamlib.VirtualFileSystem):
         tracing.trace('time=%f' % time.time())
         self.our_locks.add(lockname)
 
-    def _create_tempfile(self, pathname):  # pragma: no cover
-        path = self.join(pathname)
-        dirname = os.path.dirname(path)
-        if not os.path.exists(dirname):
+    def _makedirs_if_missing(self, dirname):
+        if dirname in self._known_dirs:
+            return
+        created = []
+        parent = dirname
+        while parent not in self._known_dirs and not os.path.isdir(parent):
+            created.append(parent)
+            parent = os.path.dirname(parent)
+        if created:
             tracing.trace('os.makedirs(%s)' % dirname)
             try:
                 os.makedirs(dirname, mode=obnamlib.NEW_DIR_MODE)
@@ -159,14 +223,134 @@ class LocalFS(obnamlib.VirtualFileSystem):
                 # the directory exists, all's good.
                 if e.errno != errno.EEXIST:
                     raise
-
-        fd, tempname = tempfile.mkstemp(dir=dirname)
-        os.fchmod(fd, obnamlib.NEW_FILE_MODE)
-        os.close(fd)
-        f = self.open(tempname, 'wb')
-        f.close()
+            for path in created:
+                self._dir_changed(os.path.dirname(path))
+        self._known_dirs.add(dirname)
+
+    def _forget_known_dirs(self, path):
+        prefix = path + os.sep
+        self._known_dirs = set(
+            x for x in self._known_dirs
+            if x != path and not x.startswith(prefix))
+
+    def _write_tempfile(self, path, contents):
+        # Create a temporary file next to path, and write contents to
+        # it, using a single file descriptor. Return the name of the
+        # temporary file. The caller is expected to rename it to its
+        # real name.
+
+        fd, tempname = self._create_tempfile(path)
+        try:
+            self._write_to_fd(fd, contents, 0)
+        except BaseException:
+            os.close(fd)
+            os.remove(tempname)
+            raise
+        self._close_tempfile(fd)
         return tempname
 
+    def _create_tempfile(self, path):
+        # Create a temporary file next to path. Return an open file
+        # descriptor for writing, and the name of the file.
+
+        dirname = os.path.dirname(path)
+        self._makedirs_if_missing(dirname)
+        try:
+            fd, tempname = tempfile.mkstemp(dir=dirname)
+        except OSError as e:
+            # Someone else may have removed the directory since we
+            # last looked. Forget it, and try again from scratch.
+            if e.errno != errno.ENOENT:
+                raise  # pragma: no cover
+            self._forget_known_dirs(dirname)
+            self._makedirs_if_missing(dirname)
+            fd, tempname = tempfile.mkstemp(dir=dirname)
+
+        try:
+            os.fchmod(fd, obnamlib.NEW_FILE_MODE)
+        except BaseException:  # pragma: no cover
+            os.close(fd)
+            os.remove(tempname)
+            raise
+        return fd, tempname
+
+    def _write_to_fd(self, fd, data, offset):
+        # Write data to fd, which is at offset in its file. Return the
+        # new offset. We write via buffer objects so that the data
+        # doesn't get copied.
+        pos = 0
+        while pos < len(data):
+            n = os.write(fd, buffer(data, pos, self.chunk_size))
+            obnamlib._obnam.fadvise_dontneed(fd, offset + pos, n)
+            pos += n
+        return offset + pos
+
+    def _close_tempfile(self, fd):
+        try:
+            if self.fsync_mode == 'always':
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _put_tempfile_in_place(self, tempname, path, overwrite):
+        if overwrite:
+            os.rename(tempname, path)
+            self._file_written(path)
+        else:
+            self._rename_temp_to_real(tempname, path)
+        self.maybe_crash()
+
+    def _file_written(self, path):
+        # Record that a file was written, for flushing to disk later,
+        # or flush it right now.
+        if self.fsync_mode == 'group':
+            self._pending_files.add(path)
+        self._dir_changed(os.path.dirname(path))
+
+    def _dir_changed(self, dirname):
+        if self.fsync_mode == 'always':
+            self._fsync_path(dirname)
+        elif self.fsync_mode == 'group':
+            self._pending_dirs.add(dirname)
+
+    def _fsync_path(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync(self):
+        if not self._pending_files and not self._pending_dirs:
+            return
+        tracing.trace(
+            'flushing %d files, %d directories',
+            len(self._pending_files), len(self._pending_dirs))
+
+        # A single syncfs(2) flushes everything on the filesystem the
+        # repository is on, which is much cheaper than an fsync(2) per
+        # file. Where it isn't available, fall back to fsync.
+        ret = errno.ENOSYS
+        if os.path.isdir(self.cwd):
+            fd = os.open(self.cwd, os.O_RDONLY)
+            try:
+                ret = obnamlib._obnam.syncfs(fd)
+            finally:
+                os.close(fd)
+        if ret != 0:
+            tracing.trace('syncfs failed: %s', os.strerror(ret))
+            for path in sorted(self._pending_files) + \
+                    sorted(self._pending_dirs):
+                try:
+                    self._fsync_path(path)
+                except OSError as e:
+                    # Files may have been removed or renamed since.
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        self._pending_files.clear()
+        self._pending_dirs.clear()
+
     def _rename_temp_to_real(self, tempname, pathname):  # pragma: no cover
         # This is tricky. We need to at least try to support NFS, and
         # various filesystems that do not support hardlinks. On NFS,
@@ -194,6 +378,7 @@ class LocalFS(obnamlib.VirtualFileSystem):
         else:
             os.remove(tempname)
             tracing.trace('link+remove worked')
+            self._file_written(path)
             return
 
         # Nope, didn't work. Now try with O_EXCL instead.
@@ -208,6 +393,7 @@ class LocalFS(obnamlib.VirtualFileSystem):
             os.remove(tempname)
             raise
         tracing.trace('O_EXCL+rename worked')
+        self._file_written(path)
 
     def unlock(self, lockname):
         tracing.trace('lockname=%s', lockname)
@@ -221,12 +407,22 @@ class LocalFS(obnamlib.VirtualFileSystem):
 
     def remove(self, pathname):
         tracing.trace('remove %s', pathname)
-        os.remove(self.join(pathname))
+        path = self.join(pathname)
+        os.remove(path)
+        self._pending_files.discard(path)
         self.maybe_crash()
 
     def rename(self, old, new):
         tracing.trace('rename %s %s', old, new)
-        os.rename(self.join(old), self.join(new))
+        old_path = self.join(old)
+        new_path = self.join(new)
+        os.rename(old_path, new_path)
+        self._forget_known_dirs(old_path)
+        if old_path in self._pending_files:
+            self._pending_files.discard(old_path)
+            self._pending_files.add(new_path)
+        self._dir_changed(os.path.dirname(old_path))
+        self._dir_changed(os.path.dirname(new_path))
         self.maybe_crash()
 
     def lstat(self, pathname):
@@ -356,17 +552,24 @@ class LocalFS(obnamlib.VirtualFileSystem):
 
     def mkdir(self, pathname, mode=obnamlib.NEW_DIR_MODE):
         tracing.trace('mkdir %s', pathname)
-        os.mkdir(self.join(pathname), obnamlib.NEW_DIR_MODE)
+        path = self.join(pathname)
+        os.mkdir(path, obnamlib.NEW_DIR_MODE)
+        self._dir_changed(os.path.dirname(path))
         self.maybe_crash()
 
     def makedirs(self, pathname):
         tracing.trace('makedirs %s', pathname)
-        os.makedirs(self.join(pathname), obnamlib.NEW_DIR_MODE)
+        path = self.join(pathname)
+        os.makedirs(path, obnamlib.NEW_DIR_MODE)
+        self._dir_changed(os.path.dirname(path))
         self.maybe_crash()
 
     def rmdir(self, pathname):
         tracing.trace('rmdir %s', pathname)
-        os.rmdir(self.join(pathname))
+        path = self.join(pathname)
+        os.rmdir(path)
+        self._forget_known_dirs(path)
+        self._pending_dirs.discard(path)
         self.maybe_crash()
 
     def cat(self, pathname):
@@ -384,29 +587,22 @@ class LocalFS(obnamlib.VirtualFileSystem):
         data = ''.join(chunks)
         return data
 
-    def write_file(self, pathname, contents):  # pragma: no cover
-        tempname = self._create_tempfile(pathname)
-        f = self.open(tempname, 'wb')
-        f.write(contents)
-        f.close()
-        self.bytes_written += len(contents)
-
+    def write_file(self, pathname, contents):
         path = self.join(pathname)
-        self._rename_temp_to_real(tempname, path)
-        self.maybe_crash()
+        tempname = self._write_tempfile(path, contents)
+        self.bytes_written += len(contents)
+        self._put_tempfile_in_place(tempname, path, False)
 
     def overwrite_file(self, pathname, contents):
         tracing.trace('overwrite_file %s', pathname)
-
-        tempname = self._create_tempfile(pathname)
-        f = self.open(tempname, 'wb')
-        f.write(contents)
-        f.close()
+        path = self.join(pathname)
+        tempname = self._write_tempfile(path, contents)
         self.bytes_written += len(contents)
+        self._put_tempfile_in_place(tempname, path, True)
 
-        path = self.join(pathname)
-        os.rename(tempname, path)
-        self.maybe_crash()
+    def open_writer(self, pathname, overwrite=False):
+        tracing.trace('open_writer %s overwrite=%s', pathname, overwrite)
+        return LocalFSWriter(self, self.join(pathname), overwrite)
 
     def listdir(self, dirname):
         return os.listdir(self.join(dirname))
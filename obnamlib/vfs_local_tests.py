@@ -57,6 +57,77 @@ class LocalFSTests(unittest.TestCase, obnamlib.VfsTests):
         self.assertTrue(self.fs.get_groupname(0) in ['root', 'wheel'])
 
 
+class LocalFSWriteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.fs = obnamlib.LocalFS(self.basepath)
+
+    def tearDown(self):
+        self.fs.close()
+        shutil.rmtree(self.basepath)
+
+    def test_fsync_mode_is_never_by_default(self):
+        self.assertEqual(self.fs.fsync_mode, 'never')
+
+    def test_sets_fsync_mode_from_settings(self):
+        settings = {'local-fsync': 'group'}
+        fs = obnamlib.LocalFS(self.basepath, settings=settings)
+        self.assertEqual(fs.fsync_mode, 'group')
+
+    def test_write_file_creates_file_with_new_file_mode(self):
+        self.fs.write_file('foo/bar', 'data')
+        self.assertEqual(self.fs.cat('foo/bar'), 'data')
+        st = os.stat(os.path.join(self.basepath, 'foo', 'bar'))
+        self.assertEqual(st.st_mode & 0777, obnamlib.NEW_FILE_MODE)
+
+    def test_write_file_leaves_no_temporary_files(self):
+        self.fs.write_file('foo/bar', 'data')
+        self.fs.overwrite_file('foo/bar', 'new data')
+        self.assertEqual(self.fs.listdir('foo'), ['bar'])
+
+    def test_write_file_remembers_created_directories(self):
+        self.fs.write_file('foo/bar/1', 'data')
+        self.assertTrue(
+            os.path.join(self.basepath, 'foo', 'bar') in self.fs._known_dirs)
+
+    def test_write_file_recreates_directory_removed_behind_its_back(self):
+        self.fs.write_file('foo/1', 'data')
+        shutil.rmtree(os.path.join(self.basepath, 'foo'))
+        self.fs.write_file('foo/2', 'data')
+        self.assertEqual(self.fs.cat('foo/2'), 'data')
+
+    def test_rmdir_forgets_directory(self):
+        self.fs.write_file('foo/1', 'data')
+        self.fs.remove('foo/1')
+        self.fs.rmdir('foo')
+        self.assertEqual(self.fs._known_dirs, set())
+
+    def test_write_file_does_not_remember_writes_by_default(self):
+        self.fs.write_file('foo/1', 'data')
+        self.assertEqual(self.fs._pending_files, set())
+
+    def test_group_mode_remembers_writes_until_sync(self):
+        self.fs.set_fsync_mode('group')
+        self.fs.write_file('foo/1', 'data')
+        self.fs.overwrite_file('foo/2', 'data')
+        self.assertEqual(
+            self.fs._pending_files,
+            set([os.path.join(self.basepath, 'foo', '1'),
+                 os.path.join(self.basepath, 'foo', '2')]))
+        self.assertTrue(
+            os.path.join(self.basepath, 'foo') in self.fs._pending_dirs)
+        self.fs.sync()
+        self.assertEqual(self.fs._pending_files, set())
+        self.assertEqual(self.fs._pending_dirs, set())
+
+    def test_always_mode_flushes_writes_immediately(self):
+        self.fs.set_fsync_mode('always')
+        self.fs.write_file('foo/1', 'data')
+        self.assertEqual(self.fs._pending_files, set())
+        self.assertEqual(self.fs.cat('foo/1'), 'data')
+
+
 class XAttrTests(unittest.TestCase):
     '''Tests for extended attributes.'''
 
@@ -0,0 +1,420 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import errno
+import fcntl
+import hashlib
+import itertools
+import logging
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+
+import tracing
+
+import obnamlib
+
+
+class UploadFailedError(obnamlib.ObnamError):
+
+    msg = 'Could not upload {filename} to repository: {error}'
+
+
+class SpoolingFS(object):
+
+    '''A VFS wrapper that uploads written files in the background.
+
+    Files written via this class are first written to a local spool
+    directory, and then uploaded to the wrapped VFS, typically an
+    SftpFS, by a pool of background threads. This lets a backup
+    proceed at the speed of the local disk rather than that of the
+    network, as long as the spool has room.
+
+    Reads see spooled files as if they had already been uploaded.
+    Any other operation on a file that is waiting to be uploaded
+    first waits for the upload, as do operations on directories,
+    and only one upload per file is in flight at a time, so changes
+    happen in the repository in the order they were made.
+
+    The sync method is the commit point: it waits for all uploads
+    to finish, and reports any upload that failed. The unlock method
+    does the same, so that nothing gets written to the repository
+    without a lock being held. Overwriting a whole file with
+    overwrite_file also waits for all earlier uploads first, since
+    that is how commit records, such as a B-tree's metadata file, are
+    written, and they must not reach the repository before the files
+    they refer to. Replacing a file with open_writer does not wait,
+    since new bags are written that way, over the empty files that
+    reserve their names; a caller that writes a commit record with
+    open_writer must call sync first.
+
+    Each run uses a sub-directory of its own in the spool, locked
+    with flock. If a run dies before its uploads are done, the next
+    run for the same repository removes the files that were left
+    over. They were never referred to by a finished commit, and
+    uploading them later, without the repository lock the dead run
+    held, might undo someone else's changes.
+
+    All methods not explicitly defined here are passed on to the
+    wrapped VFS as is.
+
+    '''
+
+    def __init__(self, fs, spool_dir, max_bytes, num_threads):
+        self.fs = fs
+        self.bytes_written = 0
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending = {}
+        self._spooled_bytes = 0
+        self._errors = []
+        self._counter = itertools.count()
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(max(1, num_threads)):
+            thread = threading.Thread(target=self._upload_jobs)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        self._spool_root = spool_dir
+        self._open_session()
+
+    def __getattr__(self, name):
+        return getattr(self.fs, name)
+
+    def _get_bytes_read(self):
+        return self.fs.bytes_read
+
+    def _set_bytes_read(self, value):
+        self.fs.bytes_read = value
+
+    bytes_read = property(_get_bytes_read, _set_bytes_read)
+
+    def _open_session(self):
+        # Each repository gets its own sub-directory in the spool, and
+        # each run a sub-directory in that.
+        url_hash = hashlib.sha1(self.fs.baseurl).hexdigest()
+        repo_dir = os.path.join(self._spool_root, url_hash)
+        if not os.path.exists(repo_dir):
+            os.makedirs(repo_dir, obnamlib.NEW_DIR_MODE)
+        self._session_dir = tempfile.mkdtemp(dir=repo_dir)
+        self._session_lock = self._lock_session(self._session_dir)
+        self._recover(repo_dir)
+
+    def _close_session(self):
+        shutil.rmtree(self._session_dir)
+        os.close(self._session_lock)
+
+    def _lock_session(self, session_dir):
+        # Return a file descriptor that holds the lock, or None if
+        # someone else holds it.
+        fd = os.open(
+            os.path.join(session_dir, 'lock'), os.O_WRONLY | os.O_CREAT,
+            obnamlib.NEW_FILE_MODE)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise  # pragma: no cover
+        return fd
+
+    def _recover(self, repo_dir):
+        for basename in os.listdir(repo_dir):
+            session_dir = os.path.join(repo_dir, basename)
+            if session_dir == self._session_dir:
+                continue
+            fd = self._lock_session(session_dir)
+            if fd is None:
+                # Another run is using it.
+                continue
+            for job_name in sorted(os.listdir(session_dir)):
+                if job_name.endswith('.job'):
+                    self._drop_job(os.path.join(session_dir, job_name))
+            shutil.rmtree(session_dir)
+            os.close(fd)
+
+    def _drop_job(self, job_name):
+        with open(job_name) as f:
+            unused_kind, unused_size, pathname = f.read().split('\n', 2)
+        logging.warning(
+            'Dropping unfinished upload of %s from spool', pathname)
+
+    def _new_data_name(self):
+        return os.path.join(
+            self._session_dir, '%d.data' % self._counter.next())
+
+    def _enqueue(self, kind, pathname, data_name, size):
+        # Only one upload per file may be queued at a time, so that
+        # they happen in the right order.
+        self._wait_for(pathname)
+        self._wait_for_room(size)
+
+        job_name = data_name[:-len('.data')] + '.job'
+        with open(job_name + '.tmp', 'w') as f:
+            f.write('%s\n%d\n%s' % (kind, size, pathname))
+        os.rename(job_name + '.tmp', job_name)
+
+        with self._lock:
+            self._pending[pathname] = (data_name, size)
+            self._spooled_bytes += size
+        self._queue.put((kind, pathname, data_name, job_name))
+        tracing.trace('spooled %s (%d bytes)', pathname, size)
+
+    def _upload_jobs(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            kind, pathname, data_name, job_name = job
+            try:
+                self._upload(kind, pathname, data_name)
+            except BaseException, e:
+                logging.error('Upload of %s failed: %s', pathname, e)
+                with self._lock:
+                    self._errors.append((pathname, e))
+                    self._forget(pathname)
+            else:
+                with self._lock:
+                    self._forget(pathname)
+                os.remove(data_name)
+                os.remove(job_name)
+
+    def _upload(self, kind, pathname, data_name):
+        writer = self.fs.open_writer(
+            pathname, overwrite=(kind == 'overwrite'))
+        with writer:
+            with open(data_name, 'rb') as f:
+                while True:
+                    data = f.read(obnamlib.RepositoryFS.piece_size)
+                    if not data:
+                        break
+                    writer.write(data)
+
+    def _forget(self, pathname):
+        # Called with self._lock held.
+        unused_data_name, size = self._pending.pop(pathname)
+        self._spooled_bytes -= size
+        self._changed.notify_all()
+
+    def _wait(self, condition):
+        # Wait until condition() is false. The timeout lets the main
+        # thread notice a KeyboardInterrupt while waiting.
+        with self._lock:
+            while condition():
+                self._changed.wait(1.0)
+
+    def _wait_for(self, pathname):
+        self._wait(lambda: pathname in self._pending)
+        self._raise_errors()
+
+    def _wait_for_room(self, size):
+        self._wait(
+            lambda: (self._pending and
+                     self._spooled_bytes + size > self.max_bytes))
+
+    def _wait_for_all(self):
+        self._wait(lambda: self._pending)
+        self._raise_errors()
+
+    def _raise_errors(self):
+        with self._lock:
+            errors = self._errors
+            self._errors = []
+        if errors:
+            pathname, e = errors[0]
+            raise UploadFailedError(filename=pathname, error=str(e))
+
+    def _open_pending(self, pathname):
+        # Return an open spooled copy of pathname, or None if it
+        # isn't waiting to be uploaded. The file is opened while the
+        # lock is held so that the upload can't remove it first.
+        with self._lock:
+            if pathname in self._pending:
+                data_name, unused_size = self._pending[pathname]
+                return open(data_name, 'rb')
+        return None
+
+    def flush(self):
+        '''Wait for all spooled files to be uploaded.'''
+        self._wait_for_all()
+
+    def sync(self):
+        self.flush()
+        self.fs.sync()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._close_session()
+            self.fs.close()
+
+    def reinit(self, new_baseurl, create=False):
+        self.flush()
+        self.fs.reinit(new_baseurl, create=create)
+        self._close_session()
+        self._open_session()
+
+    def unlock(self, lockname):
+        self.flush()
+        self.fs.unlock(lockname)
+
+    def exists(self, pathname):
+        with self._lock:
+            if pathname in self._pending:
+                return True
+        return self.fs.exists(pathname)
+
+    def open_reader(self, pathname):
+        f = self._open_pending(pathname)
+        if f is None:
+            return self.fs.open_reader(pathname)
+        return f
+
+    def cat(self, pathname):
+        f = self._open_pending(pathname)
+        if f is None:
+            return self.fs.cat(pathname)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self.bytes_read += len(data)
+        return data
+
+    def open_writer(self, pathname, overwrite=False):
+        if not overwrite and self.exists(pathname):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), pathname)
+        return SpoolWriter(self, pathname, overwrite)
+
+    def write_file(self, pathname, contents):
+        if not contents:
+            # Empty files are used for reserving names, which only
+            # works if we find out right away if the name is taken.
+            self._wait_for(pathname)
+            self.fs.write_file(pathname, contents)
+            return
+        with self.open_writer(pathname) as writer:
+            writer.write(contents)
+
+    def overwrite_file(self, pathname, contents):
+        self.flush()
+        with self.open_writer(pathname, overwrite=True) as writer:
+            writer.write(contents)
+
+    def remove(self, pathname):
+        self._wait_for(pathname)
+        self.fs.remove(pathname)
+
+    def rename(self, old, new):
+        self._wait_for(old)
+        self._wait_for(new)
+        self.fs.rename(old, new)
+
+    def lstat(self, pathname):
+        self._wait_for(pathname)
+        return self.fs.lstat(pathname)
+
+    def chmod_symlink(self, pathname, mode):
+        self._wait_for(pathname)
+        self.fs.chmod_symlink(pathname, mode)
+
+    def chmod_not_symlink(self, pathname, mode):
+        self._wait_for(pathname)
+        self.fs.chmod_not_symlink(pathname, mode)
+
+    def lutimes(self, pathname, atime_sec, atime_nsec, mtime_sec, mtime_nsec):
+        self._wait_for(pathname)
+        self.fs.lutimes(
+            pathname, atime_sec, atime_nsec, mtime_sec, mtime_nsec)
+
+    def link(self, existing_path, new_path):
+        self._wait_for(existing_path)
+        self._wait_for(new_path)
+        self.fs.link(existing_path, new_path)
+
+    def symlink(self, source, destination):
+        self._wait_for(destination)
+        self.fs.symlink(source, destination)
+
+    # Directory operations wait for all uploads, since any of them
+    # might create or be in the directory.
+
+    def isdir(self, pathname):
+        self._wait_for_all()
+        return self.fs.isdir(pathname)
+
+    def listdir(self, pathname):
+        self._wait_for_all()
+        return self.fs.listdir(pathname)
+
+    def listdir2(self, pathname):
+        self._wait_for_all()
+        return self.fs.listdir2(pathname)
+
+    def rmdir(self, pathname):
+        self._wait_for_all()
+        self.fs.rmdir(pathname)
+
+    def rmtree(self, pathname):
+        self._wait_for_all()
+        self.fs.rmtree(pathname)
+
+
+class SpoolWriter(obnamlib.VfsWriter):
+
+    '''Write a file into the spool, and queue it for upload.'''
+
+    def __init__(self, spool, pathname, overwrite):
+        self._spool = spool
+        self._pathname = pathname
+        self._overwrite = overwrite
+        self._data_name = spool._new_data_name()
+        self._fd = os.open(
+            self._data_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            obnamlib.NEW_FILE_MODE)
+        self._size = 0
+
+    def write(self, data):
+        self._size += len(data)
+        data = buffer(data)
+        while data:
+            n = os.write(self._fd, data)
+            data = buffer(data, n)
+
+    def close(self):
+        os.close(self._fd)
+        kind = 'overwrite' if self._overwrite else 'write'
+        self._spool._enqueue(kind, self._pathname, self._data_name, self._size)
+        self._spool.bytes_written += self._size
+
+    def abort(self):
+        os.close(self._fd)
+        os.remove(self._data_name)
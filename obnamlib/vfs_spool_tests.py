@@ -0,0 +1,193 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import obnamlib
+
+
+class GatedFS(obnamlib.LocalFS):
+
+    '''A LocalFS whose uploads wait until the gate is opened.'''
+
+    def __init__(self, *args, **kwargs):
+        obnamlib.LocalFS.__init__(self, *args, **kwargs)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail = False
+
+    def open_writer(self, pathname, overwrite=False):
+        self.gate.wait()
+        if self.fail:
+            raise OSError(errno.EIO, os.strerror(errno.EIO), pathname)
+        return obnamlib.LocalFS.open_writer(
+            self, pathname, overwrite=overwrite)
+
+
+class SpoolingFSVfsTests(unittest.TestCase, obnamlib.VfsTests):
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.spooldir = tempfile.mkdtemp()
+        self.fs = obnamlib.SpoolingFS(
+            obnamlib.LocalFS(self.basepath), self.spooldir, 1024**2, 2)
+
+    def tearDown(self):
+        self.fs.close()
+        shutil.rmtree(self.basepath)
+        shutil.rmtree(self.spooldir)
+
+    def test_scan_tree_returns_nothing_if_listdir_fails(self):
+        # scan_tree is done by the wrapped VFS, so that's where the
+        # failing listdir2 needs to go.
+        self.set_up_scan_tree()
+
+        def raiser(dirname):
+            raise OSError(123, 'oops', dirname)
+
+        def logerror(msg):
+            pass
+
+        self.fs.fs.listdir2 = raiser
+        result = list(self.fs.scan_tree(self.basepath, log=logerror))
+        self.assertEqual(len(result), 1)
+        pathname, _ = result[0]
+        self.assertEqual(pathname, self.basepath)
+
+
+class SpoolingFSTests(unittest.TestCase):
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.spooldir = tempfile.mkdtemp()
+        self.real = GatedFS(self.basepath)
+        self.real.gate.clear()
+        self.fs = self.new_fs()
+
+    def new_fs(self):
+        return obnamlib.SpoolingFS(self.real, self.spooldir, 1024, 2)
+
+    def tearDown(self):
+        self.real.gate.set()
+        self.fs.close()
+        shutil.rmtree(self.basepath)
+        shutil.rmtree(self.spooldir)
+
+    def test_write_returns_before_upload(self):
+        self.fs.write_file('foo', 'data')
+        self.assertFalse(self.real.exists('foo'))
+
+    def test_spooled_file_is_readable(self):
+        self.fs.write_file('foo', 'data')
+        self.assertTrue(self.fs.exists('foo'))
+        self.assertEqual(self.fs.cat('foo'), 'data')
+
+    def test_write_fails_if_spooled_file_exists(self):
+        self.fs.write_file('foo', 'data')
+        self.assertRaises(OSError, self.fs.write_file, 'foo', 'other')
+
+    def test_sync_waits_for_uploads(self):
+        self.fs.overwrite_file('bar', 'other')
+        self.fs.write_file('foo', 'data')
+        self.real.gate.set()
+        self.fs.sync()
+        self.assertEqual(self.real.cat('foo'), 'data')
+        self.assertEqual(self.real.cat('bar'), 'other')
+
+    def test_writes_empty_files_right_away(self):
+        self.fs.write_file('foo', '')
+        self.assertTrue(self.real.exists('foo'))
+
+    def test_sync_reports_failed_upload(self):
+        self.real.fail = True
+        self.fs.write_file('foo', 'data')
+        self.real.gate.set()
+        self.assertRaises(obnamlib.UploadFailedError, self.fs.sync)
+
+    def test_unlock_waits_for_uploads(self):
+        self.fs.lock('lock')
+        self.fs.write_file('foo', 'data')
+        self.real.gate.set()
+        self.fs.unlock('lock')
+        self.assertEqual(self.real.cat('foo'), 'data')
+
+    def test_overwrite_file_waits_for_earlier_uploads(self):
+        self.fs.write_file('foo', 'data')
+        thread = threading.Thread(
+            target=self.fs.overwrite_file, args=('bar', 'other'))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertFalse(self.fs.exists('bar'))
+        self.real.gate.set()
+        thread.join()
+        self.fs.sync()
+        self.assertEqual(self.real.cat('foo'), 'data')
+        self.assertEqual(self.real.cat('bar'), 'other')
+
+    def test_overwriting_writer_after_sync_lands_after_earlier_uploads(self):
+        # This is how chunk indexes are committed: they must not reach
+        # the repository before the bags holding their chunks.
+        self.fs.write_file('foo', 'data')
+
+        def commit():
+            self.fs.sync()
+            with self.fs.open_writer('bar', overwrite=True) as writer:
+                writer.write('other')
+
+        thread = threading.Thread(target=commit)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertFalse(self.fs.exists('bar'))
+        self.assertFalse(self.real.exists('foo'))
+        self.real.gate.set()
+        thread.join()
+        self.fs.sync()
+        self.assertEqual(self.real.cat('foo'), 'data')
+        self.assertEqual(self.real.cat('bar'), 'other')
+
+    def test_next_run_drops_unfinished_uploads(self):
+        # Leave behind what a run that died before its uploads were
+        # done would have left.
+        repo_dir = os.path.dirname(self.fs._session_dir)
+        dead_dir = tempfile.mkdtemp(dir=repo_dir)
+        with open(os.path.join(dead_dir, '0.data'), 'w') as f:
+            f.write('data')
+        with open(os.path.join(dead_dir, '0.job'), 'w') as f:
+            f.write('write\n4\nfoo')
+
+        fs2 = self.new_fs()
+        self.real.gate.set()
+        fs2.close()
+        self.assertFalse(os.path.exists(dead_dir))
+        self.assertFalse(self.real.exists('foo'))
+
+    def test_leaves_nothing_in_spool_after_close(self):
+        self.fs.write_file('foo', 'data')
+        self.real.gate.set()
+        self.fs.close()
+        self.fs = self.new_fs()
+        repo_dir = os.path.dirname(self.fs._session_dir)
+        self.assertEqual(
+            os.listdir(repo_dir), [os.path.basename(self.fs._session_dir)])
@@ -0,0 +1,110 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import Queue
+import sys
+import threading
+
+
+class WorkerPool(object):
+
+    '''Run functions in a fixed set of worker threads.
+
+    The pool is created with a list of state objects, one per worker
+    thread, such as a separately opened repository for each. A worker
+    passes its own state object as the first argument to every
+    function it runs. Since no two threads ever use the same state
+    object, the state objects need not be thread safe.
+
+    Submitting a function returns a WorkerPoolJob, which the caller
+    can later ask for the result. Jobs are started in the order they
+    were submitted, but may finish in any order: a caller that wants
+    results in a predictable order should keep the jobs in a list
+    and ask each for its result in turn.
+
+    '''
+
+    def __init__(self, states):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for state in states:
+            thread = threading.Thread(target=self._run_jobs, args=(state,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __len__(self):
+        return len(self._threads)
+
+    def submit(self, func, *args):
+        '''Run func(state, *args) in a worker thread.'''
+        job = WorkerPoolJob(func, args)
+        self._queue.put(job)
+        return job
+
+    def close(self):
+        '''Wait for all submitted jobs, then stop the worker threads.'''
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run_jobs(self, state):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run(state)
+
+
+class WorkerPoolJob(object):
+
+    '''A function call submitted to a WorkerPool.'''
+
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._finished = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def run(self, state):
+        try:
+            self._value = self._func(state, *self._args)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        self._finished.set()
+
+    def done(self):
+        '''Has the job finished?'''
+        return self._finished.is_set()
+
+    def result(self):
+        '''Wait for the job to finish, and return its result.
+
+        If the function raised an exception, it is raised again here,
+        in the caller's thread.
+
+        '''
+
+        self._finished.wait()
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+        return self._value
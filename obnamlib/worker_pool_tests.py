@@ -0,0 +1,83 @@
+# Copyright 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-3+ =*=
+
+
+import threading
+import unittest
+
+import obnamlib
+
+
+def record_thread(state, value):
+    state.append(threading.current_thread().ident)
+    return value
+
+
+def fail(state):
+    raise ZeroDivisionError()
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.states = [[], [], []]
+        self.pool = obnamlib.WorkerPool(self.states)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_has_one_worker_per_state(self):
+        self.assertEqual(len(self.pool), 3)
+
+    def test_returns_result(self):
+        job = self.pool.submit(record_thread, 'foo')
+        self.assertEqual(job.result(), 'foo')
+        self.assertTrue(job.done())
+
+    def test_returns_results_of_many_jobs(self):
+        jobs = [self.pool.submit(record_thread, i) for i in range(100)]
+        self.assertEqual([job.result() for job in jobs], range(100))
+
+    def test_gives_each_thread_its_own_state(self):
+        jobs = [self.pool.submit(record_thread, i) for i in range(100)]
+        for job in jobs:
+            job.result()
+        self.assertEqual(sum(len(state) for state in self.states), 100)
+        idents = [set(state) for state in self.states]
+        for ident_set in idents:
+            self.assertTrue(len(ident_set) <= 1)
+        self.assertEqual(
+            len(set.union(*idents)), sum(len(s) for s in idents))
+
+    def test_raises_exception_in_caller(self):
+        job = self.pool.submit(fail)
+        self.assertRaises(ZeroDivisionError, job.result)
+        self.assertTrue(job.done())
+
+    def test_keeps_working_after_exception(self):
+        self.pool.submit(fail)
+        job = self.pool.submit(record_thread, 'foo')
+        self.assertEqual(job.result(), 'foo')
+
+    def test_close_waits_for_jobs(self):
+        gate = threading.Event()
+        job = self.pool.submit(lambda state: gate.wait())
+        self.assertFalse(job.done())
+        gate.set()
+        self.pool.close()
+        self.assertTrue(job.done())
+        self.assertEqual(len(self.pool), 0)